@@ -38,5 +38,10 @@ definition = {
         {'parent_comment': ['parent', 'id']},
         'comment_count',
         'like_count'
-    ]
+    ],
+    'csv_types': {
+        'created_time': 'timestamp',
+        'comment_count': 'int',
+        'like_count': 'int'
+    }
 }
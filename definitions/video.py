@@ -55,5 +55,9 @@ definition = {
         'content_category',
         ['privacy', 'description'],
         'icon'
-    ]
+    ],
+    'csv_types': {
+        'created_time': 'timestamp',
+        'updated_time': 'timestamp'
+    }
 }
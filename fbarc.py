@@ -3,6 +3,7 @@
 from __future__ import print_function
 
 import requests
+import urllib3
 import json
 import logging
 import pkgutil
@@ -11,12 +12,31 @@ import sys
 import os
 import collections
 import copy
+import abc
+import functools
 from datetime import datetime, timedelta, timezone
 import iso8601
 import time
 import fileinput
 import contextlib
 import csv
+import heapq
+import random
+import sqlite3
+import operator
+import bisect
+import itertools
+import math
+import threading
+import queue
+import gzip
+import zlib
+import hashlib
+import shutil
+import tempfile
+import concurrent.futures
+import asyncio
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 
 import definitions
 import local_definitions
@@ -26,6 +46,37 @@ try:
 except ImportError:
     import ConfigParser as configparser  # Python 2
 
+# Optional faster JSON decoding
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional streaming JSON decoding
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Optional zstd compression
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional async API
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Optional Parquet output
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 __version__ = '0.1.0'  # also in setup.py
 
 if sys.version_info[:2] <= (2, 7):
@@ -38,11 +89,119 @@ else:
 GRAPH_URL = "https://graph.facebook.com/v2.11"
 DEFAULT_EDGE_SIZE = 100
 DEFAULT_NODE_BATCH_SIZE = 20
+# Earliest time for time-sliced edges when the node has no created time (2004-02-04, when Facebook launched)
+FACEBOOK_EPOCH = 1075852800
+# Leaf profile for definitions without one when pruning leaves: fields only.
+DEFAULT_LEAF_PROFILE = {'edges': [], 'get_pages': False}
 PAGE_BATCH_SIZE = 50
+DISCOVER_BATCH_SIZE = 50
+# Errors reading a streamed response that is truncated or times out. Requests does not wrap the urllib3 errors raised
+# when reading the raw response.
+STREAM_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, ValueError) + (
+    (ijson.JSONError,) if ijson is not None else ())
+# Nodes of a definition are requested without the fields omitted for an error once the error rate for the definition
+# reaches OMIT_ERROR_RATE after at least OMIT_MIN_REQUESTS requests.
+OMIT_MIN_REQUESTS = 20
+OMIT_ERROR_RATE = .5
+# While the fields are omitted for all nodes of a definition, every OMIT_SAMPLE_INTERVAL-th request is made with the
+# fields, so that the error rate continues to be measured.
+OMIT_SAMPLE_INTERVAL = 10
+# Limits for tuning node batch and edge sizes. Sizes are reduced after responses that are slower or larger than these.
+TUNE_MAX_LATENCY_SECS = 10
+TUNE_MAX_RESPONSE_BYTES = 5 * 1024 * 1024
+# Tuned sizes are at most TUNE_MAX_FACTOR times the size of the definition.
+TUNE_MAX_FACTOR = 4
+# Maximum number of ids in a request
+MAX_NODE_BATCH_SIZE = 50
+# Number of nodes of each definition sampled at each level when planning
+PLAN_SAMPLE_SIZE = 5
+# Fields with the urls of media (images and videos) to download
+MEDIA_FIELDS = ('picture', 'full_picture', 'source')
+MEDIA_WORKERS = 8
+# Maximum number of concurrent downloads from a host
+MEDIA_HOST_WORKERS = 2
+# Maximum number of graphs waiting for their media to be downloaded before being output
+MEDIA_WINDOW_SIZE = 100
+MEDIA_TIMEOUT_SECS = 60
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Maximum number of concurrent requests for the async API
+ASYNC_CONCURRENCY = 4
+# HTTP statuses that are (possibly) transient and retried
+RETRY_STATUS_CODES = (408, 429, 502, 503, 504)
+# Facebook error codes for application, user and page rate limits
+RATE_LIMIT_ERROR_CODES = (4, 17, 32, 613)
+WRITE_BUFFER_SIZE = 1024 * 1024
+JSON_ENCODERS = ('json', 'orjson')
+# Map of compressions to file extensions
+COMPRESSION_EXTENSIONS = collections.OrderedDict((('gzip', '.gz'), ('zstd', '.zst')))
+# Uncompressed size after which a compressed frame is ended.
+FRAME_SIZE = 1024 * 1024
+# Offsets of lines in compressed archives are the frame offset shifted by this number of bits
+# plus the offset of the line within the frame.
+FRAME_OFFSET_BITS = 24
+# Segmented archives are described by a manifest, e.g., <node id>.manifest.json, and written to
+# segments, e.g., <node id>.00001.jsonl.
+MANIFEST_EXTENSION = '.manifest.json'
+SEGMENT_NUMBER_DIGITS = 5
+# Size of the chunks of archives exported by each process
+EXPORT_CHUNK_SIZE = 64 * 1024 * 1024
+# Types that can be declared for CSV fields in columnar output
+CSV_TYPES = ('string', 'int', 'float', 'bool', 'timestamp', 'json')
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+# Maximum number of rows buffered across all types for Parquet output
+PARQUET_MAX_BUFFERED_ROWS = 256 * 1024
+# Number of rows inserted into SQLite per transaction
+SQLITE_BATCH_SIZE = 10000
+# Map of CSV types to SQLite column types
+SQLITE_COLUMN_TYPES = {'string': 'TEXT', 'int': 'INTEGER', 'float': 'REAL', 'bool': 'INTEGER', 'timestamp': 'TEXT',
+                       'json': 'TEXT'}
 
 log = logging.getLogger(__name__)
 
 
+def json_loads(data):
+    """
+    Decode JSON from a str or bytes, using orjson if available.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, pretty=False, encoder='json'):
+    """
+    Encode JSON as a str.
+
+    orjson is faster, but does not escape non-ASCII characters and does not support pretty printing.
+    """
+    if encoder == 'orjson' and not pretty:
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, indent=4 if pretty else None)
+
+
+def iter_json_array(response):
+    """
+    Returns an iterator of the items of a JSON array response.
+
+    If ijson is available, the items are decoded as the response is streamed so that
+    the entire response is not buffered. Otherwise, the response is decoded all at once.
+
+    The response is closed once the iterator is exhausted, fails or is closed.
+    """
+    try:
+        if ijson is not None:
+            response.raw.decode_content = True
+            for item in ijson.items(response.raw, 'item', use_float=True):
+                yield item
+        else:
+            for item in json_loads(response.content):
+                yield item
+    finally:
+        response.close()
+
+
 def load_definition(definition_package):
     """
     Returns a map of node_types to importers loaded from a package.
@@ -144,6 +303,13 @@ def input_keys(args):
 def main():
     parser = get_argparser()
     args = parser.parse_args()
+    # Checked before loading keys or making any requests
+    if getattr(args, 'parquet_output_dir', None) and pyarrow is None:
+        parser.error('--parquet-output-dir requires pyarrow')
+    if getattr(args, 'normalize', False) and not args.output_dir:
+        parser.error('--normalize requires --output-dir')
+    if args.command == 'plan' and args.levels < 1:
+        parser.error('plan requires --levels of at least 1')
 
     logging.basicConfig(
         filename=args.log,
@@ -165,7 +331,21 @@ def main():
     elif args.command == 'url':
         fb = Fbarc()
         print(fb.generate_url(args.node, args.definition, escape=args.escape))
+    elif args.command == 'export':
+        if not args.csv_output_dir and not args.parquet_output_dir:
+            parser.error('export requires --csv-output-dir or --parquet-output-dir')
+        export_command(args.files, csv_output_dir=args.csv_output_dir, parquet_output_dir=args.parquet_output_dir,
+                       processes=args.processes, chunk_size=int(args.chunk_mb * 1024 * 1024))
     else:
+        budget_limits = {}
+        if args.command in ('graph', 'graphs', 'resume', 'plan'):
+            try:
+                budget_limits = dict(max_edge_pages=parse_limits(args.max_edge_pages),
+                                     max_edge_items=parse_limits(args.max_edge_items),
+                                     max_definition_nodes=parse_limits(args.max_nodes),
+                                     max_level_nodes=parse_limits(args.max_level_nodes, key_type=int))
+            except ValueError as e:
+                parser.error(str(e))
         # Load keys
         app_id, app_secret, short_access_token, long_access_token, expires_at = load_keys(args)
         if short_access_token:
@@ -182,8 +362,32 @@ def main():
             token = get_app_token(app_id, app_secret)
             print('Warning: Using an app token. You may encounter authorization problems.', file=sys.stderr)
         node_id = None
+        seen_index = None
+        if getattr(args, 'seen_index', None):
+            seen_index = PersistentIndex(args.seen_index)
+        type_cache = None
+        if getattr(args, 'type_cache', None):
+            type_cache = PersistentIndex(args.type_cache)
+        omit_cache = None
+        if getattr(args, 'omit_cache', None):
+            omit_cache = OmitCache(args.omit_cache)
+        size_tuner = None
+        if getattr(args, 'tune_sizes', None):
+            size_tuner = SizeTuner(args.tune_sizes if args.tune_sizes is not True else None)
+        media_store = None
+        if getattr(args, 'media_dir', None):
+            media_store = MediaStore(args.media_dir, max_workers=args.media_workers,
+                                     max_host_workers=args.media_host_workers)
+        budget = None
+        if args.command in ('graph', 'graphs', 'resume', 'plan'):
+            budget = CrawlBudget(max_requests=args.max_requests, max_secs=args.max_secs,
+                                 stopped_edges_filepath=args.stopped_edges, **budget_limits)
         try:
-            fb = Fbarc(token=token, delay_secs=args.delay)
+            fb = Fbarc(token=token, delay_secs=args.delay, seen_index=seen_index, budget=budget,
+                       type_cache=type_cache, stream_edges=getattr(args, 'stream_edges', False),
+                       prune_leaves=getattr(args, 'prune_leaves', False), omit_cache=omit_cache,
+                       size_tuner=size_tuner, fetch_workers=getattr(args, 'fetch_workers', 1),
+                       fetch_queue_size=getattr(args, 'fetch_queue', None), defer_seen=True)
             if args.command == 'metadata':
                 if args.update:
                     node_type, fields, connections = fb.get_parsed_metadata(args.node)
@@ -200,17 +404,33 @@ def main():
                     print_graph(fb.get_metadata(node_id), pretty=args.pretty)
             elif args.command == 'search':
                 print_graph(fb.search(args.node_type, args.query))
+            elif args.command == 'plan':
+                node_id = args.node
+                print_graph(fb.plan(node_id, args.definition, levels=args.levels, exclude_definition_names=args.exclude,
+                                    sample_size=args.sample_size), pretty=args.pretty)
             elif args.command == 'graphs':
                 graph_command(args.definition, [line.rstrip('\n') for line in fileinput.input(
                     files=args.node_files if len(args.node_files) > 0 else ('-',))], args.levels, args.exclude,
                               args.pretty,
-                              args.output_dir, args.csv_output_dir, fb, skip=args.skip)
+                              args.output_dir, args.csv_output_dir, fb, skip=args.skip, scheduler_name=args.schedule,
+                              priority_definition_names=args.priority, write_queue_size=args.write_queue,
+                              json_output_options=get_json_output_options(args), compression=args.compress,
+                              max_segment_size=get_segment_size(args), max_segment_nodes=args.segment_nodes,
+                              parquet_output_dir=args.parquet_output_dir, sqlite_output=args.sqlite_output,
+                              normalize=args.normalize, media_store=media_store)
             elif args.command == 'resume':
-                fb.resume(args.file, args.levels, args.exclude)
+                fb.resume(args.file, args.levels, args.exclude,
+                          scheduler=create_scheduler(args.schedule, args.priority), write_queue_size=args.write_queue,
+                          json_output_options=get_json_output_options(args), media_store=media_store)
             else:
                 node_id = args.node
                 graph_command(args.definition, (node_id,), args.levels, args.exclude, args.pretty, args.output_dir,
-                              args.csv_output_dir, fb)
+                              args.csv_output_dir, fb, scheduler_name=args.schedule,
+                              priority_definition_names=args.priority, write_queue_size=args.write_queue,
+                              json_output_options=get_json_output_options(args), compression=args.compress,
+                              max_segment_size=get_segment_size(args), max_segment_nodes=args.segment_nodes,
+                              parquet_output_dir=args.parquet_output_dir, sqlite_output=args.sqlite_output,
+                              normalize=args.normalize, media_store=media_store)
         except FbException as e:
             error_msg = 'Error:'
             if node_id:
@@ -221,42 +441,253 @@ def main():
             elif e.code == 190 and e.subcode == 490:
                 print('Hint: Security check triggered. Log into your Facebook account.')
             quit(1)
+        finally:
+            if seen_index is not None:
+                seen_index.close()
+            if type_cache is not None:
+                type_cache.close()
+            if omit_cache is not None:
+                omit_cache.close()
+            if size_tuner is not None:
+                size_tuner.close()
+            if media_store is not None:
+                media_store.close()
+            if budget is not None:
+                budget.close()
+
+
+def get_json_output_options(args):
+    """
+    Returns the keyword arguments for JsonGraphOutput from the command line arguments.
+    """
+    return {
+        'encoder': args.json_encoder,
+        'flush_secs': args.flush_secs,
+        'fsync_secs': args.fsync_secs
+    }
+
+
+def get_segment_size(args):
+    """
+    Returns the maximum segment size in characters from the command line arguments.
+    """
+    if args.segment_mb:
+        return int(args.segment_mb * 1024 * 1024)
+    return None
+
+
+def get_output_filepath(output_dir, node_id, compression=None, segmented=False):
+    """
+    Returns the filepath of the JSON output for a root node. For segmented output, this is the manifest.
+    """
+    if segmented:
+        return os.path.join(output_dir, '{}{}'.format(node_id, MANIFEST_EXTENSION))
+    filepath = os.path.join(output_dir, '{}.jsonl'.format(node_id))
+    if compression:
+        filepath += COMPRESSION_EXTENSIONS[compression]
+    return filepath
 
 
 def graph_command(definition_name, node_iter, levels, exclude_definition_name, pretty, output_dir, csv_output_dir, fb,
-                  skip=False):
+                  skip=False, scheduler_name='bfs', priority_definition_names=None, write_queue_size=0,
+                  json_output_options=None, compression=None, max_segment_size=None, max_segment_nodes=None,
+                  parquet_output_dir=None, sqlite_output=None, normalize=False, media_store=None):
+    json_output_options = json_output_options or {}
+    segmented = bool(max_segment_size or max_segment_nodes)
     graph_outputs = []
     # Optional context
     with contextlib.ExitStack() as csv_output_stack:
         if csv_output_dir:
             os.makedirs(csv_output_dir, exist_ok=True)
             graph_outputs.append(csv_output_stack.enter_context(CsvGraphOutput(csv_output_dir, fb)))
+        if parquet_output_dir:
+            os.makedirs(parquet_output_dir, exist_ok=True)
+            graph_outputs.append(csv_output_stack.enter_context(ParquetGraphOutput(parquet_output_dir, fb)))
+        if sqlite_output:
+            graph_outputs.append(csv_output_stack.enter_context(SqliteGraphOutput(
+                sqlite_output, fb, encoder=json_output_options.get('encoder', 'json'))))
+
+        def should_skip(node_id):
+            if skip and output_dir and os.path.exists(get_output_filepath(output_dir, node_id, compression,
+                                                                                  segmented=segmented)):
+                log.info('Skipping %s', node_id)
+                return True
+            return False
+
+        node_ids = (node_id for node_id in node_iter if node_id and not should_skip(node_id))
+        if definition_name == 'discover':
+            node_definition_names = discover_definition_names(list(node_ids), fb)
+        else:
+            node_definition_names = ((node_id, definition_name) for node_id in node_ids)
 
-        for node_id in node_iter:
-            if not node_id:
-                continue
-            if definition_name == 'discover':
-                definition_name = fb.discover_type(node_id)
-
+        for node_id, node_definition_name in node_definition_names:
             with contextlib.ExitStack() as json_output_stack:
+                output_filepath = None
                 if output_dir:
-                    output_filepath = os.path.join(output_dir, '{}.jsonl'.format(node_id))
-                    if skip and os.path.exists(output_filepath):
-                        log.info('Skipping %s', node_id)
-                        continue
+                    output_filepath = get_output_filepath(output_dir, node_id, compression, segmented=segmented)
                     os.makedirs(output_dir, exist_ok=True)
-                    graph_outputs.append(
-                        json_output_stack.enter_context(JsonGraphOutput(pretty=pretty, filepath=output_filepath)))
+                if output_filepath and segmented:
+                    json_output = json_output_stack.enter_context(SegmentedJsonGraphOutput(
+                        output_filepath, max_segment_size=max_segment_size, max_segment_nodes=max_segment_nodes,
+                        compression=compression, pretty=pretty, **json_output_options))
                 else:
-                    graph_outputs.append(json_output_stack.enter_context(JsonGraphOutput(pretty=pretty)))
+                    json_output = json_output_stack.enter_context(JsonGraphOutput(
+                        pretty=pretty, filepath=output_filepath, **json_output_options))
+                if output_filepath and normalize:
+                    json_output = json_output_stack.enter_context(NormalizedGraphOutput(
+                        json_output, fb, get_edges_filepath(output_filepath)))
+                graph_outputs.append(json_output)
 
                 print('Getting graph for node {}'.format(node_id), file=sys.stderr)
-                print_graphs(fb.get_nodes(node_id, definition_name, levels=levels,
-                                          exclude_definition_names=exclude_definition_name), graph_outputs)
+                print_graphs(fb.get_nodes(node_id, node_definition_name, levels=levels,
+                                          exclude_definition_names=exclude_definition_name,
+                                          scheduler=create_scheduler(scheduler_name, priority_definition_names)),
+                             graph_outputs + [SeenGraphOutput(fb)], write_queue_size=write_queue_size,
+                             media_store=media_store)
                 graph_outputs.pop()
 
 
-def print_graphs(graph_iter, graph_outputs):
+def discover_definition_names(node_ids, fb):
+    """
+    Returns a list of (node id, definition name) with the definition names discovered from the API.
+
+    Nodes are grouped by definition name. Nodes that are missing or for which there is no
+    definition are skipped.
+    """
+    node_types = fb.discover_types(node_ids)
+    nodes_by_definition_name = collections.OrderedDict()
+    for node_id in node_ids:
+        node_type = node_types.get(node_id)
+        if node_type is None:
+            continue
+        if node_type not in definition_importers:
+            log.warning('Skipping %s since no definition for %s', node_id, node_type)
+            continue
+        nodes_by_definition_name.setdefault(node_type, []).append(node_id)
+    node_definition_names = []
+    for definition_name, definition_node_ids in nodes_by_definition_name.items():
+        log.info('Discovered %s %s nodes', len(definition_node_ids), definition_name)
+        node_definition_names.extend((node_id, definition_name) for node_id in definition_node_ids)
+    return node_definition_names
+
+
+def export_command(paths, csv_output_dir=None, parquet_output_dir=None, processes=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Exports archives to CSV files and/or Parquet datasets for each node type, using the csv_fields of
+    the definitions.
+
+    Archives are divided into chunks that are exported by a pool of processes. Each chunk is exported
+    to CSV part files, which are concatenated in order, and to a Parquet file in the dataset for each
+    node type. If no paths are provided, stdin is exported in this process.
+    """
+    for output_dir in (csv_output_dir, parquet_output_dir):
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+    if not paths:
+        node_counter = _export_lines(fileinput.input(files=('-',)), csv_dirpath=csv_output_dir,
+                                     csv_mode='w', parquet_dirpath=parquet_output_dir, part_number=0)
+    else:
+        chunks = []
+        for filepath in iter_archive_filepaths(paths):
+            chunks.extend(get_archive_chunks(filepath, chunk_size))
+        log.info('Exporting %s chunks', len(chunks))
+        part_dirpath = tempfile.mkdtemp(prefix='.export-', dir=csv_output_dir) if csv_output_dir else None
+        try:
+            node_counter = collections.Counter()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(_export_chunk, chunk, part_number, part_dirpath, parquet_output_dir)
+                           for part_number, chunk in enumerate(chunks)]
+                for future in futures:
+                    node_counter.update(future.result())
+            if csv_output_dir:
+                _concat_csv_parts(part_dirpath, len(chunks), node_counter.keys(), csv_output_dir)
+        finally:
+            if part_dirpath:
+                shutil.rmtree(part_dirpath)
+    for definition_name, count in node_counter.most_common():
+        print('{}: {:,}'.format(definition_name, count), file=sys.stderr)
+
+
+def iter_archive_filepaths(paths):
+    """
+    Returns an iterator of the archives in a list of files and directories.
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+        else:
+            for dirpath, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if is_archive_filepath(filename):
+                        yield os.path.join(dirpath, filename)
+
+
+def _export_chunk(chunk, part_number, part_dirpath, parquet_dirpath):
+    filepath, start, end = chunk
+    csv_dirpath = None
+    if part_dirpath:
+        csv_dirpath = os.path.join(part_dirpath, str(part_number))
+        os.makedirs(csv_dirpath)
+    return _export_lines(ArchiveReader(filepath).iter_chunk_lines(start, end), csv_dirpath=csv_dirpath,
+                         parquet_dirpath=parquet_dirpath, part_number=part_number)
+
+
+def _export_lines(lines, csv_dirpath=None, csv_mode='a', parquet_dirpath=None, part_number=0):
+    """
+    Exports lines of an archive, returning a counter of node types.
+
+    With csv_mode='a', CSV files are written without headers.
+    """
+    fb = Fbarc()
+    node_counter = collections.Counter()
+    graph_outputs = []
+    with contextlib.ExitStack() as output_stack:
+        if csv_dirpath:
+            graph_outputs.append(output_stack.enter_context(CsvGraphOutput(csv_dirpath, fb, mode=csv_mode)))
+        if parquet_dirpath:
+            graph_outputs.append(output_stack.enter_context(ParquetGraphOutput(
+                parquet_dirpath, fb, part_name='part-{}'.format(str(part_number).zfill(SEGMENT_NUMBER_DIGITS)))))
+        for line in lines:
+            graph = json_loads(line)
+            definition_name = graph.get('metadata', {}).get('type')
+            if definition_name not in definition_importers:
+                continue
+            node_counter[definition_name] += 1
+            for graph_output in graph_outputs:
+                graph_output.output_graph(graph)
+    return node_counter
+
+
+def _concat_csv_parts(part_dirpath, part_count, definition_names, csv_output_dir):
+    fb = Fbarc()
+    for definition_name in definition_names:
+        csv_filepath = os.path.join(csv_output_dir, '{}.csv'.format(definition_name))
+        with open(csv_filepath, 'w') as file:
+            csv.writer(file).writerow(compile_csv_fields(get_csv_fields(fb.get_definition(definition_name)))[0])
+        # Binary, so that line endings written by the csv module are copied unchanged
+        with open(csv_filepath, 'ab') as file:
+            for part_number in range(part_count):
+                part_filepath = os.path.join(part_dirpath, str(part_number), '{}.csv'.format(definition_name))
+                if os.path.exists(part_filepath):
+                    with open(part_filepath, 'rb') as part_file:
+                        shutil.copyfileobj(part_file, file)
+
+
+def print_graphs(graph_iter, graph_outputs, write_queue_size=0, media_store=None):
+    """
+    Output graphs to each of the graph outputs.
+
+    If write_queue_size, the graphs are output by a background thread, with up to that number
+    of graphs waiting to be output.
+
+    If a media store is provided, the media of graphs are downloaded before they are output.
+    """
+    if media_store is not None:
+        graph_iter = media_store.iter_graphs(graph_iter)
+    if write_queue_size:
+        with BackgroundGraphOutput(graph_outputs, queue_size=write_queue_size) as background_output:
+            print_graphs(graph_iter, (background_output,))
+        return
     for graph in graph_iter:
         for graph_output in graph_outputs:
             graph_output.output_graph(graph)
@@ -277,8 +708,24 @@ def definition_map_template(field_names):
     return definition_map
 
 
-def print_graph(graph, pretty=False, file=sys.stdout):
-    print(json.dumps(graph, indent=4 if pretty else None), file=file)
+def print_graph(graph, pretty=False, file=sys.stdout, encoder='json'):
+    print(json_dumps(graph, pretty=pretty, encoder=encoder), file=file)
+
+
+def parse_limits(values, key_type=str):
+    """
+    Returns a map of keys to limits from a list of limits provided as KEY=N or N.
+
+    A limit without a key is stored with the None key. Raises ValueError for an invalid limit.
+    """
+    limits = {}
+    for value in values or ():
+        key, _, limit = value.rpartition('=')
+        try:
+            limits[key_type(key) if key else None] = int(limit)
+        except ValueError:
+            raise ValueError('invalid limit: {}'.format(value))
+    return limits
 
 
 def print_definition_map(definition_map, node_batch_size, edge_size):
@@ -323,12 +770,65 @@ def get_argparser():
                         help="Name of a profile in your configuration file")
     parser.add_argument('--delay', type=float, help='delay between requests. (default=.5)', default=.5)
 
+    # Budget arguments shared by the retrieval commands
+    budget_parser = argparse.ArgumentParser(add_help=False)
+    budget_parser.add_argument('--max-edge-pages', nargs='+', metavar='[EDGE=]N',
+                               help='maximum number of additional pages to retrieve for an edge, '
+                                    'e.g., 10 or comments=10')
+    budget_parser.add_argument('--max-edge-items', nargs='+', metavar='[EDGE=]N',
+                               help='maximum number of items to retrieve for an edge, e.g., 1000 or comments=500')
+    budget_parser.add_argument('--max-nodes', nargs='+', metavar='[DEFINITION=]N',
+                               help='maximum number of nodes to retrieve for a node type definition, '
+                                    'e.g., comment=10000')
+    budget_parser.add_argument('--max-level-nodes', nargs='+', metavar='[LEVEL=]N',
+                               help='maximum number of nodes to retrieve for a level, e.g., 3=10000')
+    budget_parser.add_argument('--max-requests', type=int, help='stop after this number of requests')
+    budget_parser.add_argument('--max-secs', type=float, help='stop after this number of seconds')
+    budget_parser.add_argument('--stopped-edges', help='record edges that were not completely retrieved because of '
+                                                       'limits to this file')
+    budget_parser.add_argument('--prune-leaves', action='store_true',
+                               help='retrieve nodes at the last level with fields only, unless their definition has '
+                                    'a leaf profile')
+    budget_parser.add_argument('--tune-sizes', nargs='?', const=True, metavar='FILE',
+                               help='adjust node batch and edge sizes based on responses, optionally keeping the '
+                                    'tuned sizes in this file for later runs')
+
+    # Output arguments shared by the retrieval commands
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument('--write-queue', type=int, default=0, metavar='N',
+                               help='write output in a background thread with up to this number of nodes waiting '
+                                    'to be written (default=0, write in the retrieval thread)')
+    output_parser.add_argument('--fetch-workers', type=int, default=1, metavar='N',
+                               help='number of threads fetching batches of nodes while nodes that have been fetched '
+                                    'are expanded and written (default=1, fetch and expand in turn)')
+    output_parser.add_argument('--fetch-queue', type=int, metavar='N',
+                               help='maximum number of batches of nodes being fetched or waiting to be expanded '
+                                    '(default=2 * fetch workers)')
+    output_parser.add_argument('--json-encoder', choices=JSON_ENCODERS, default='json',
+                               help='JSON encoder for output. orjson is faster, but does not escape non-ASCII '
+                                    'characters. (default=json)')
+    output_parser.add_argument('--flush-secs', type=float, help='flush output files every this number of seconds')
+    output_parser.add_argument('--fsync-secs', type=float, help='sync output files to disk every this number of '
+                                                                'seconds')
+    output_parser.add_argument('--stream-edges', action='store_true',
+                               help='write additional pages of edges as edge chunks as they are retrieved rather '
+                                    'than holding all pages of a node in memory')
+    output_parser.add_argument('--media-dir',
+                               help='download media (picture, full_picture and source) to this directory, storing '
+                                    'each file once by content hash, and record local paths in the metadata')
+    output_parser.add_argument('--media-workers', type=int, default=MEDIA_WORKERS, metavar='N',
+                               help='number of concurrent media downloads (default={})'.format(MEDIA_WORKERS))
+    output_parser.add_argument('--media-host-workers', type=int, default=MEDIA_HOST_WORKERS, metavar='N',
+                               help='number of concurrent media downloads from a host '
+                                    '(default={})'.format(MEDIA_HOST_WORKERS))
+
     # Subparsers
     subparsers = parser.add_subparsers(dest='command', help='command help')
 
     subparsers.add_parser('configure', help='input API credentials and store in configuration file')
 
-    graph_parser = subparsers.add_parser('graph', help='retrieve nodes from the Graph API')
+    graph_parser = subparsers.add_parser('graph', help='retrieve nodes from the Graph API',
+                                         parents=[budget_parser, output_parser])
     definition_choices = ['discover']
     definition_choices.extend(definition_importers.keys())
 
@@ -342,9 +842,37 @@ def get_argparser():
                               help='node type definitions to exclude from recursive retrieval', default=[])
     graph_parser.add_argument('--pretty', action='store_true', help='pretty print output')
     graph_parser.add_argument('--output-dir', help='write output to JSON file in this directory')
+    graph_parser.add_argument('--compress', choices=list(COMPRESSION_EXTENSIONS.keys()),
+                              help='compress JSON output files in independently decompressible frames')
+    graph_parser.add_argument('--segment-mb', type=float, metavar='N',
+                              help='split JSON output files into segments of about this number of MB (before '
+                                   'compression), listed in a manifest')
+    graph_parser.add_argument('--segment-nodes', type=int, metavar='N',
+                              help='split JSON output files into segments of this number of nodes, listed in a '
+                                   'manifest')
     graph_parser.add_argument('--csv-output-dir', help='write output as CSV files in this directory')
-
-    graphs_parser = subparsers.add_parser('graphs', help='retrieve multiple nodes from the Graph API')
+    graph_parser.add_argument('--parquet-output-dir',
+                              help='write output as Parquet files in this directory (requires pyarrow)')
+    graph_parser.add_argument('--normalize', action='store_true',
+                              help='replace nodes embedded in edges with references and write the edges to a '
+                                   'separate edges file')
+    graph_parser.add_argument('--sqlite-output', metavar='FILE',
+                              help='write output to tables for each node type and an edges table in this SQLite '
+                                   'database')
+    graph_parser.add_argument('--type-cache', help='file caching node types discovered from the API')
+    graph_parser.add_argument('--schedule', choices=SCHEDULERS, default='bfs',
+                              help='order in which connected nodes are retrieved: breadth first (bfs), '
+                                   'depth first (dfs), by definition (priority) or newest first (recency). '
+                                   '(default=bfs)')
+    graph_parser.add_argument('--priority', nargs='+', choices=list(definition_importers.keys()), default=[],
+                              help='node type definitions in order of priority for the priority schedule')
+    graph_parser.add_argument('--seen-index', help='file recording nodes already retrieved. Nodes in the index are '
+                                                   'not retrieved again.')
+    graph_parser.add_argument('--omit-cache', help='file recording nodes and node types that need fields omitted '
+                                                   '(see omit_on_error)')
+
+    graphs_parser = subparsers.add_parser('graphs', help='retrieve multiple nodes from the Graph API',
+                                          parents=[budget_parser, output_parser])
     graphs_parser.add_argument('definition', choices=definition_choices,
                                help='definition to use to retrieve the node. discover will discover node type '
                                     'from API.')
@@ -356,15 +884,63 @@ def get_argparser():
                                help='node type definitions to exclude from recursive retrieval', default=[])
     graphs_parser.add_argument('--pretty', action='store_true', help='pretty print output')
     graphs_parser.add_argument('--output-dir', help='write output to JSON files in this directory')
+    graphs_parser.add_argument('--compress', choices=list(COMPRESSION_EXTENSIONS.keys()),
+                               help='compress JSON output files in independently decompressible frames')
+    graphs_parser.add_argument('--segment-mb', type=float, metavar='N',
+                               help='split JSON output files into segments of about this number of MB (before '
+                                    'compression), listed in a manifest')
+    graphs_parser.add_argument('--segment-nodes', type=int, metavar='N',
+                               help='split JSON output files into segments of this number of nodes, listed in a '
+                                    'manifest')
     graphs_parser.add_argument('--csv-output-dir', help='write output as CSV files in this directory')
+    graphs_parser.add_argument('--parquet-output-dir',
+                               help='write output as Parquet files in this directory (requires pyarrow)')
+    graphs_parser.add_argument('--normalize', action='store_true',
+                               help='replace nodes embedded in edges with references and write the edges to a '
+                                    'separate edges file')
+    graphs_parser.add_argument('--sqlite-output', metavar='FILE',
+                               help='write output to tables for each node type and an edges table in this SQLite '
+                                    'database')
     graphs_parser.add_argument('--skip', action='store_true', help='skip node if output file exists')
-
-    resume_parser = subparsers.add_parser('resume', help='resume retrieving nodes from the Graph API')
+    graphs_parser.add_argument('--type-cache', help='file caching node types discovered from the API')
+    graphs_parser.add_argument('--schedule', choices=SCHEDULERS, default='bfs',
+                               help='order in which connected nodes are retrieved: breadth first (bfs), '
+                                    'depth first (dfs), by definition (priority) or newest first (recency). '
+                                    '(default=bfs)')
+    graphs_parser.add_argument('--priority', nargs='+', choices=list(definition_importers.keys()), default=[],
+                               help='node type definitions in order of priority for the priority schedule')
+    graphs_parser.add_argument('--seen-index', help='file recording nodes already retrieved. Nodes in the index are '
+                                                    'not retrieved again.')
+    graphs_parser.add_argument('--omit-cache', help='file recording nodes and node types that need fields omitted '
+                                                    '(see omit_on_error)')
+
+    resume_parser = subparsers.add_parser('resume', help='resume retrieving nodes from the Graph API',
+                                          parents=[budget_parser, output_parser])
     resume_parser.add_argument('file', help='file to resume')
     resume_parser.add_argument('--levels', type=int, default='1',
                                help='number of levels of nodes to retrieve (default=1, infinite=0)')
     resume_parser.add_argument('--exclude', nargs='+', choices=list(definition_importers.keys()),
                                help='node type definitions to exclude from recursive retrieval', default=[])
+    resume_parser.add_argument('--schedule', choices=SCHEDULERS, default='bfs',
+                               help='order in which connected nodes are retrieved: breadth first (bfs), '
+                                    'depth first (dfs), by definition (priority) or newest first (recency). '
+                                    '(default=bfs)')
+    resume_parser.add_argument('--priority', nargs='+', choices=list(definition_importers.keys()), default=[],
+                               help='node type definitions in order of priority for the priority schedule')
+    resume_parser.add_argument('--seen-index', help='file recording nodes already retrieved. Nodes in the index are '
+                                                    'not retrieved again.')
+    resume_parser.add_argument('--omit-cache', help='file recording nodes and node types that need fields omitted '
+                                                    '(see omit_on_error)')
+
+    export_parser = subparsers.add_parser('export', help='export JSON files as CSV or Parquet files for each node type')
+    export_parser.add_argument('files', metavar='FILE', nargs='*',
+                               help='JSON files or directories of JSON files to export, if empty, stdin is used')
+    export_parser.add_argument('--csv-output-dir', help='write CSV files to this directory')
+    export_parser.add_argument('--parquet-output-dir', help='write Parquet datasets to this directory (requires '
+                                                            'pyarrow)')
+    export_parser.add_argument('--processes', type=int, help='number of processes (default=number of CPUs)')
+    export_parser.add_argument('--chunk-mb', type=float, default=EXPORT_CHUNK_SIZE / 1024 / 1024,
+                               help='size of the chunks of files exported by each process (default=64)')
 
     metadata_parser = subparsers.add_parser('metadata', help='retrieve metadata for a node from the Graph API')
     metadata_parser.add_argument('node', help='identify node to retrieve by providing node id, username, or Facebook '
@@ -374,14 +950,27 @@ def get_argparser():
     metadata_parser.add_argument('--update', action='store_true',
                                  help='update existing template with additional fields')
 
+    plan_parser = subparsers.add_parser('plan', help='estimate the requests, nodes, bytes and time to retrieve nodes '
+                                                     'from the Graph API by sampling',
+                                        parents=[budget_parser])
+    plan_parser.add_argument('definition', choices=list(definition_importers.keys()),
+                             help='definition to use to retrieve the node.')
+    plan_parser.add_argument('node', help='identify node to retrieve by providing node id or username')
+    plan_parser.add_argument('--levels', type=int, default='1',
+                             help='number of levels of nodes to retrieve (default=1)')
+    plan_parser.add_argument('--exclude', nargs='+', choices=list(definition_importers.keys()),
+                             help='node type definitions to exclude from recursive retrieval', default=[])
+    plan_parser.add_argument('--sample-size', type=int, default=PLAN_SAMPLE_SIZE,
+                             help='number of nodes of each node type to sample at each level '
+                                  '(default={})'.format(PLAN_SAMPLE_SIZE))
+    plan_parser.add_argument('--pretty', action='store_true', help='pretty print output')
+
     url_parser = subparsers.add_parser('url', help='generate the url to retrieve the node from the Graph API')
     url_parser.add_argument('definition', choices=list(definition_importers.keys()),
                             help='definition to use to retrieve the node.')
     url_parser.add_argument('node', help='identify node to retrieve by providing node id or username')
     url_parser.add_argument('--escape', action='store_true', help='escape the characters in the url')
 
-    subparsers.add_parser('configure', help='input API credentials and store in configuration file')
-
     return parser
 
 
@@ -423,6 +1012,426 @@ def get_token_expires_at(app_token, token):
     return datetime.fromtimestamp(response.json()['data']['expires_at'], timezone.utc)
 
 
+def parse_page_link(page_link):
+    """
+    Returns (node id, edge name) for a paging link.
+
+    For example, https://graph.facebook.com/v2.8/488852220724/photos?after=MTAx returns (488852220724, photos).
+    """
+    path = urlparse(page_link).path.strip('/').split('/')
+    if len(path) < 3:
+        return None, None
+    return path[-2], path[-1]
+
+
+def strip_access_token(link):
+    """
+    Returns a link with the access token removed.
+    """
+    parts = urlparse(link)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key != 'access_token']
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+def get_window_link(page_link, since, until):
+    """
+    Returns a paging link for a time window of an edge, replacing the cursors of the link with since and until.
+    """
+    parts = urlparse(page_link)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if key not in ('after', 'before', 'since', 'until', '__paging_token', '__previous')]
+    query.extend((('since', str(since)), ('until', str(until))))
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+def get_time_windows(since, until, count):
+    """
+    Returns a list of (since, until) timestamps that split a time range into windows, newest first.
+    """
+    step = max(1, (until - since) // count)
+    windows = []
+    window_until = until
+    while window_until > since and len(windows) < count:
+        window_since = since if len(windows) == count - 1 else max(since, window_until - step)
+        windows.append((window_since, window_until))
+        window_until = window_since
+    return windows
+
+
+def iter_lists(obj):
+    """
+    Returns an iterator of the lists in a JSON object (including the object, if a list).
+    """
+    if isinstance(obj, list):
+        yield obj
+        for value in obj:
+            for nested_list in iter_lists(value):
+                yield nested_list
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            for nested_list in iter_lists(value):
+                yield nested_list
+
+
+def is_edge_chunk(graph):
+    """
+    Returns True if a graph is an edge chunk, i.e., a page of an edge retrieved with edge streaming.
+    """
+    return 'chunk' in graph.get('metadata', {})
+
+
+def get_compression(filepath):
+    """
+    Returns the compression of an archive based on its extension or None if not compressed.
+    """
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if filepath.endswith(extension):
+            return compression
+    return None
+
+
+def is_archive_filepath(filepath):
+    """
+    Returns True if the filepath is for a (possibly compressed) JSON archive.
+
+    Segments are not archives by themselves; they are read through their manifest.
+    """
+    if is_segment_filepath(filepath):
+        return False
+    for extension in itertools.chain(('',), COMPRESSION_EXTENSIONS.values()):
+        if filepath.lower().endswith('.json' + extension) or filepath.lower().endswith('.jsonl' + extension):
+            return True
+    return False
+
+
+def get_frame_index_filepath(filepath):
+    return '{}.idx'.format(filepath)
+
+
+def is_manifest_filepath(filepath):
+    return filepath.endswith(MANIFEST_EXTENSION)
+
+
+def get_segment_filename(manifest_filepath, number, compression=None):
+    """
+    Returns the filename of a segment of a segmented archive.
+    """
+    return '{}.{}.jsonl{}'.format(os.path.basename(manifest_filepath)[:-len(MANIFEST_EXTENSION)],
+                                  str(number).zfill(SEGMENT_NUMBER_DIGITS),
+                                  COMPRESSION_EXTENSIONS[compression] if compression else '')
+
+
+def is_segment_filepath(filepath):
+    filename = os.path.basename(filepath)
+    if get_compression(filename):
+        filename = os.path.splitext(filename)[0]
+    root, extension = os.path.splitext(filename)
+    number = os.path.splitext(root)[1][1:]
+    return extension == '.jsonl' and len(number) == SEGMENT_NUMBER_DIGITS and number.isdigit()
+
+
+def read_manifest(manifest_filepath):
+    with open(manifest_filepath) as file:
+        return json.load(file)
+
+
+def get_segment_filepaths(manifest_filepath):
+    """
+    Returns the filepaths of the segments listed in a manifest.
+    """
+    dirpath = os.path.dirname(manifest_filepath)
+    return [os.path.join(dirpath, segment['filename']) for segment in read_manifest(manifest_filepath)['segments']]
+
+
+class FramedWriter(object):
+    """
+    A file-like object for writing text to a file as independently decompressible frames
+    (gzip members or zstd frames).
+
+    Frames end on line boundaries once they exceed the frame size. The offset, compressed length
+    and uncompressed length of each frame is recorded in a frame index file.
+    """
+
+    def __init__(self, filepath, mode='w', compression='gzip', frame_size=FRAME_SIZE):
+        assert frame_size < 2 ** FRAME_OFFSET_BITS
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstandard is not installed')
+        self.compression = compression
+        self.frame_size = frame_size
+        index_filepath = get_frame_index_filepath(filepath)
+        self.file = open(filepath, mode + 'b')
+        self.offset = 0
+        if mode == 'a':
+            self.offset = self.file.seek(0, os.SEEK_END)
+            # Remove any partially written frame following the last indexed frame.
+            if os.path.exists(index_filepath):
+                end_offset = 0
+                for frame_offset, compressed_length, _ in read_frame_index(index_filepath):
+                    end_offset = frame_offset + compressed_length
+                if end_offset < self.offset:
+                    log.warning('Truncating %s from %s to %s', filepath, self.offset, end_offset)
+                    self.file.truncate(end_offset)
+                    self.offset = end_offset
+        self.index_file = open(index_filepath, mode)
+        self._buffer = []
+        self._buffer_size = 0
+        if compression == 'zstd':
+            self._compressor = zstandard.ZstdCompressor()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self.frame_size and data.endswith(b'\n'):
+            self._write_frame()
+
+    def tell(self):
+        """
+        Returns the offset of the next line to be written.
+        """
+        return (self.offset << FRAME_OFFSET_BITS) | self._buffer_size
+
+    def _write_frame(self):
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        if self.compression == 'zstd':
+            frame = self._compressor.compress(data)
+        else:
+            frame = gzip.compress(data)
+        self.file.write(frame)
+        self.index_file.write('{}\t{}\t{}\n'.format(self.offset, len(frame), len(data)))
+        self.offset += len(frame)
+        self._buffer = []
+        self._buffer_size = 0
+
+    def flush(self):
+        self._write_frame()
+        self.file.flush()
+        self.index_file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self._write_frame()
+        self.file.close()
+        self.index_file.close()
+
+
+def read_frame_index(index_filepath):
+    """
+    Returns a list of (frame offset, compressed length, uncompressed length) from a frame index file.
+    """
+    frames = []
+    with open(index_filepath) as file:
+        for line in file:
+            values = line.rstrip('\n').split('\t')
+            if len(values) == 3:
+                frames.append(tuple(int(value) for value in values))
+    return frames
+
+
+class ArchiveReader(object):
+    """
+    Reads the lines of a JSON archive that may be uncompressed or compressed in frames.
+
+    The offset of a line in an uncompressed archive is its byte offset. The offset of a line in
+    a compressed archive is the offset of its frame shifted by FRAME_OFFSET_BITS plus the offset of
+    the line within the uncompressed frame. Either way, a line can be read by its offset without
+    reading the rest of the archive.
+
+    If the filepath is a manifest, the segments are read as a single archive. Offsets in a segment
+    are relative to the combined size of the preceding segments.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        if is_manifest_filepath(filepath):
+            self.filepaths = get_segment_filepaths(filepath)
+        else:
+            self.filepaths = [filepath]
+        self.compression = get_compression(self.filepaths[0]) if self.filepaths else None
+        self._offset_bits = FRAME_OFFSET_BITS if self.compression else 0
+        self._segment_offsets = None
+
+    def __iter__(self):
+        """
+        Returns an iterator of (offset, line).
+        """
+        segment_offset = 0
+        for filepath in self.filepaths:
+            if not os.path.exists(filepath):
+                log.warning('Skipping missing segment %s', filepath)
+                continue
+            for offset, line in self._iter_file(filepath):
+                yield (segment_offset << self._offset_bits) + offset, line
+            segment_offset += os.path.getsize(filepath)
+
+    def _iter_file(self, filepath):
+        if not self.compression:
+            with open(filepath, 'rb') as file:
+                offset = 0
+                for line in file:
+                    yield offset, line.decode('utf-8')
+                    offset += len(line)
+        else:
+            for frame_offset, data in self.iter_frames(filepath):
+                pos = 0
+                for line in data.splitlines(True):
+                    yield (frame_offset << FRAME_OFFSET_BITS) | pos, line.decode('utf-8')
+                    pos += len(line)
+
+    def iter_lines(self):
+        for _, line in self:
+            yield line
+
+    def iter_chunk_lines(self, start, end):
+        """
+        Returns an iterator of the lines of a chunk of a file from get_archive_chunks().
+
+        For an uncompressed file, start and end are byte offsets of line boundaries. For a compressed
+        file, they are offsets of frame boundaries.
+        """
+        with open(self.filepath, 'rb') as file:
+            offset = start
+            if not self.compression:
+                file.seek(start)
+                while offset < end:
+                    line = file.readline()
+                    if not line:
+                        break
+                    yield line.decode('utf-8')
+                    offset += len(line)
+            else:
+                while offset < end:
+                    frame = self._read_frame(file, offset)
+                    if frame is None:
+                        break
+                    for line in frame[0].splitlines(True):
+                        yield line.decode('utf-8')
+                    offset += frame[1]
+
+    def _decompressobj(self):
+        if self.compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstandard is not installed')
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _read_frame(self, file, frame_offset):
+        """
+        Returns (uncompressed data, compressed length) of the frame at the offset or None if
+        there are no more frames.
+        """
+        file.seek(frame_offset)
+        decompressor = self._decompressobj()
+        data = []
+        compressed_length = 0
+        while True:
+            chunk = file.read(self.CHUNK_SIZE)
+            if not chunk:
+                if compressed_length:
+                    log.warning('Ignoring incomplete frame at %s in %s', frame_offset, file.name)
+                return None
+            data.append(decompressor.decompress(chunk))
+            compressed_length += len(chunk)
+            if decompressor.eof:
+                return b''.join(data), compressed_length - len(decompressor.unused_data)
+
+    def iter_frames(self, filepath=None):
+        """
+        Returns an iterator of (frame offset, uncompressed data) for a compressed file, by default
+        the archive.
+
+        The frame index is used if available. Otherwise, frames are found by decompressing in order.
+        """
+        filepath = filepath or self.filepath
+        index_filepath = get_frame_index_filepath(filepath)
+        with open(filepath, 'rb') as file:
+            if os.path.exists(index_filepath):
+                for frame_offset, _, _ in read_frame_index(index_filepath):
+                    frame = self._read_frame(file, frame_offset)
+                    if frame is None:
+                        break
+                    yield frame_offset, frame[0]
+            else:
+                frame_offset = 0
+                while True:
+                    frame = self._read_frame(file, frame_offset)
+                    if frame is None:
+                        break
+                    yield frame_offset, frame[0]
+                    frame_offset += frame[1]
+
+    def _find_file(self, offset):
+        """
+        Returns (filepath, offset within the file) for an offset in the archive.
+        """
+        if len(self.filepaths) == 1:
+            return self.filepaths[0], offset
+        if self._segment_offsets is None:
+            self._segment_offsets = []
+            segment_offset = 0
+            for filepath in self.filepaths:
+                self._segment_offsets.append(segment_offset)
+                if os.path.exists(filepath):
+                    segment_offset += os.path.getsize(filepath)
+        index = bisect.bisect_right(self._segment_offsets, offset >> self._offset_bits) - 1
+        return self.filepaths[index], offset - (self._segment_offsets[index] << self._offset_bits)
+
+    def read_line(self, offset):
+        """
+        Returns the line at an offset.
+        """
+        filepath, offset = self._find_file(offset)
+        with open(filepath, 'rb') as file:
+            if not self.compression:
+                file.seek(offset)
+                return file.readline().decode('utf-8')
+            data, _ = self._read_frame(file, offset >> FRAME_OFFSET_BITS)
+            pos = offset & (2 ** FRAME_OFFSET_BITS - 1)
+            end = data.find(b'\n', pos)
+            return data[pos:end + 1 if end != -1 else len(data)].decode('utf-8')
+
+
+def get_archive_chunks(filepath, chunk_size):
+    """
+    Returns a list of (filepath, start, end) dividing an archive into chunks of about chunk_size bytes
+    that can be read independently with ArchiveReader.iter_chunk_lines().
+
+    Chunks of uncompressed files end on line boundaries. Chunks of compressed files end on frame
+    boundaries, so a compressed file without a frame index is a single chunk. The segments of a manifest
+    are divided separately.
+    """
+    if is_manifest_filepath(filepath):
+        return list(itertools.chain.from_iterable(
+            get_archive_chunks(segment_filepath, chunk_size) for segment_filepath in get_segment_filepaths(filepath)
+            if os.path.exists(segment_filepath)))
+    size = os.path.getsize(filepath)
+    chunks = []
+    start = 0
+    if get_compression(filepath):
+        index_filepath = get_frame_index_filepath(filepath)
+        if os.path.exists(index_filepath):
+            for frame_offset, compressed_length, _ in read_frame_index(index_filepath):
+                end = frame_offset + compressed_length
+                if end - start >= chunk_size:
+                    chunks.append((filepath, start, end))
+                    start = end
+    else:
+        with open(filepath, 'rb') as file:
+            while size - start > chunk_size:
+                file.seek(start + chunk_size)
+                file.readline()
+                chunks.append((filepath, start, file.tell()))
+                start = file.tell()
+    if start < size:
+        chunks.append((filepath, start, size))
+    return chunks
+
+
 def raise_for_fb_exception(response, data=None, params=None):
     if response.status_code != requests.codes.ok:
         try:
@@ -436,9 +1445,46 @@ def raise_for_fb_exception(response, data=None, params=None):
 
 
 class Fbarc(object):
-    def __init__(self, token=None, delay_secs=.5):
+    def __init__(self, token=None, delay_secs=.5, seen_index=None, budget=None, type_cache=None, stream_edges=False,
+                 prune_leaves=False, retry_policy=None, defer_retries=True, omit_cache=None, size_tuner=None,
+                 fetch_workers=1, fetch_queue_size=None, defer_seen=False):
         log.debug('Token is %s', token)
         self.token = token
+        # Determines whether and when failed requests are retried.
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        # If True, nodes that fail with retryable errors are queued to be retried later rather than waiting.
+        self.defer_retries = defer_retries
+        # Number of threads fetching batches of nodes and maximum number of batches being fetched or waiting to be
+        # expanded. See _get_nodes_staged().
+        self.fetch_workers = fetch_workers
+        self.fetch_queue_size = fetch_queue_size or 2 * fetch_workers
+        # Number of batches of nodes in each stage
+        self._stage_depths = {'fetch': 0, 'expand': 0}
+        # State of the current thread (e.g., of a fetch worker)
+        self._local = threading.local()
+        self._throttle_lock = threading.Lock()
+        # If True, nodes at the last level of definitions without a leaf profile are retrieved with fields only.
+        self.prune_leaves = prune_leaves
+        # If True, pages of edges are returned as edge chunks as they are retrieved rather than merged into graphs.
+        self.stream_edges = stream_edges
+        # Limits on retrieval. The default is unlimited.
+        self.budget = budget if budget is not None else CrawlBudget()
+        # Map of node ids to discovered node types, optionally persisted across runs.
+        self.type_cache = type_cache if type_cache is not None else PersistentIndex()
+        # Learns which nodes need fields omitted, optionally persisted across runs. By default, fields are not omitted
+        # for all nodes of a definition, since that would drop them for nodes that would have returned them.
+        self.omit_cache = omit_cache if omit_cache is not None else OmitCache(omit_definitions=False)
+        # Optionally adjusts node batch and edge sizes based on responses. Otherwise, the sizes of definitions are used.
+        self.size_tuner = size_tuner
+
+        # Optional index of node ids to [root node id, number of levels expanded] for nodes that have already been
+        # retrieved. Shared across roots and optionally persisted across runs.
+        self.seen_index = seen_index
+        # If True, nodes are recorded in the seen index by record_seen() (e.g., with SeenGraphOutput once they have
+        # been written) rather than once the next node is requested.
+        self.defer_seen = defer_seen
+        # Map of node ids to seen index values for nodes that have been returned, but not recorded yet
+        self._pending_seen = {}
 
         # Map of node types definition names to node type definitions
         self._definitions = {}
@@ -446,9 +1492,36 @@ class Fbarc(object):
         self.last_get = None
         log.debug('Delay is %s', delay_secs)
         self.delay_secs = delay_secs
-        self.get_too_much_data_errors_limit = 4
-        self.get_errors_limit = 10
-        self.get_error_delay_secs = 30
+
+    @property
+    def last_response_secs(self):
+        """
+        Latency of the last (not streamed) response in this thread
+        """
+        return getattr(self._local, 'last_response_secs', None)
+
+    @last_response_secs.setter
+    def last_response_secs(self, value):
+        self._local.last_response_secs = value
+
+    @property
+    def last_response_bytes(self):
+        """
+        Size of the last (not streamed) response in this thread
+        """
+        return getattr(self._local, 'last_response_bytes', None)
+
+    @last_response_bytes.setter
+    def last_response_bytes(self, value):
+        self._local.last_response_bytes = value
+
+    def get_stage_depths(self):
+        """
+        Returns a map of stages to the number of batches of nodes being fetched (fetch) or waiting to be expanded
+        (expand), for tuning fetch_workers and fetch_queue_size. See BackgroundGraphOutput.queue_depth() for the
+        write stage.
+        """
+        return dict(self._stage_depths)
 
     def generate_url(self, node_id, definition_name, escape=False):
         """
@@ -462,180 +1535,801 @@ class Fbarc(object):
             return requests.Request('GET', url, params=params).prepare().url
 
     def get_nodes(self, root_node_id, root_definition_name, levels=1,
-                  exclude_definition_names=None):
+                  exclude_definition_names=None, scheduler=None):
         """
         Iterator for getting nodes, starting with the root node and proceeding
         for the specified number of levels of connected nodes.
+
+        The order in which connected nodes are retrieved is determined by the scheduler.
+        The default is breadth first.
         """
         node_counter = collections.Counter()
-        node_queue = collections.deque()
-        node_queue.appendleft((root_node_id, root_definition_name, 1))
+        node_queue = scheduler if scheduler is not None else BfsScheduler()
+        node_queue.push(root_node_id, root_definition_name, 1)
+        # Root node is always queued, but counts towards limits.
+        self.budget.allow_node(root_definition_name, 1)
         node_counter[root_definition_name] += 1
-        queued_nodes = set()
-        queued_nodes.add(root_node_id)
-        for node_graph in self._get_nodes(node_counter, node_queue, queued_nodes, levels, exclude_definition_names):
+        # Map of node ids to the shallowest level at which they were queued
+        queued_nodes = {root_node_id: 1}
+        for node_graph in self._get_nodes(node_counter, node_queue, queued_nodes, levels, exclude_definition_names,
+                                          root_node_id=root_node_id):
             yield node_graph
 
-    def _get_nodes(self, node_counter, node_queue, queued_nodes, levels, exclude_definition_names):
-        for node_ids, definition_name, level in self.node_queue_iter(node_queue):
-            node_counter[definition_name] -= len(node_ids)
-            log.info('Getting nodes {} ({}). {:,} nodes left: {}'.format(node_ids, definition_name, len(node_queue),
-                                                                         node_counter.most_common()))
+    def _get_nodes(self, node_counter, node_queue, queued_nodes, levels, exclude_definition_names,
+                   root_node_id=None):
+        """
+        Retrieves the queued nodes, yielding them and queuing their connected nodes.
+
+        Each batch of nodes is fetched (see _fetch_node_batch()) and then expanded (see _expand_node_batch()).
+        If fetch_workers is more than 1, the stages run concurrently (see _get_nodes_staged()).
+        """
+        if self.fetch_workers > 1:
+            for graph in self._get_nodes_staged(node_counter, node_queue, queued_nodes, levels,
+                                                exclude_definition_names, root_node_id=root_node_id):
+                yield graph
+            return
+        while node_queue or node_queue.has_pages() or node_queue.has_retries():
+            if self.budget.is_exhausted():
+                log.warning('Stopping with %s nodes, %s edge pages and %s retries left in node queue because budget is '
+                            'exhausted.', len(node_queue), node_queue.page_count(), node_queue.retry_count())
+                return
+            retry = node_queue.pop_retry()
+            if retry is None and not node_queue and not node_queue.has_pages():
+                # Only retries that are not due yet are left.
+                wait_secs = node_queue.get_retry_wait_secs()
+                log.info('Waiting %s seconds to retry nodes', wait_secs)
+                time.sleep(wait_secs)
+                continue
+            if retry is None and node_queue.is_page_batch_next():
+                for edge_chunk in self._get_edge_chunk_batch(node_counter, node_queue, queued_nodes, levels,
+                                                             exclude_definition_names, root_node_id):
+                    yield edge_chunk
+                continue
+            node_ids, definition_name, level, try_count = self._pop_node_batch(node_queue, node_counter,
+                                                                               queued_nodes, retry)
+            if not node_ids:
+                continue
             try:
-                # If a single node, use get_node. Otherwise, use get_node_batch. Get_node supports omitting fields.
-                node_graph_dict = dict()
-                if len(node_ids) == 1:
-                    node_graph_dict[node_ids[0]] = self.get_node(node_ids[0], definition_name)
-                else:
-                    node_graph_dict = self.get_node_batch(node_ids, definition_name)
-                for node_id, node_graph in node_graph_dict.items():
-                    if levels == 0 or level < levels:
-                        connected_nodes = self.find_connected_nodes(definition_name, node_graph,
-                                                                    default_only=False)
-                        added_count = 0
-                        # Checking queued nodes makes sure that never has been queued before.
-                        for connected_node_id, connected_definition_name in connected_nodes:
-                            if connected_node_id not in queued_nodes and (
-                                    connected_definition_name is None or
-                                    connected_definition_name not in exclude_definition_names):
-                                log.debug('%s found in %s', connected_node_id, node_id)
-                                node_queue.append((connected_node_id, connected_definition_name, level + 1))
-                                node_counter[connected_definition_name] += 1
-                                queued_nodes.add(connected_node_id)
-                                added_count += 1
-                        log.debug("%s connected nodes found in %s and %s added to node queue.", len(connected_nodes),
-                                  node_id, added_count)
-                    yield node_graph
-            except FbException as e:
-                # Sometimes get unexpected GraphMethodException: Unsupported get request.
-                if e.code == 100 and e.subcode == 33:
-                    log.warning('Skipping %s due to unexpected GraphMethodException: %s', node_id, e)
-                else:
-                    raise e
+                node_graph_dict = self._fetch_node_batch(node_ids, definition_name, level, levels)
+            except (RetryLater, FbException) as e:
+                self._handle_fetch_error(e, node_ids, definition_name, level, try_count, node_queue, node_counter)
+                continue
+            for graph in self._expand_node_batch(node_graph_dict, definition_name, level, levels, node_counter,
+                                                 node_queue, queued_nodes, exclude_definition_names, root_node_id):
+                yield graph
 
-    def node_queue_iter(self, node_queue):
+    def _get_nodes_staged(self, node_counter, node_queue, queued_nodes, levels, exclude_definition_names,
+                          root_node_id=None):
         """
-        Returns the next list of nodes, node definition, level where the node definition
-        and level is the same for all nodes.
+        Retrieves the queued nodes as stages connected by bounded queues.
 
-        The maximum number of nodes that will be returned is 50.
+        Batches of nodes are fetched by fetch_workers threads (fetch) while this thread expands the batches that
+        have been fetched (expand) and the caller writes the nodes (write, optionally in a background thread with
+        BackgroundGraphOutput). At most fetch_queue_size batches are being fetched or waiting to be expanded, so a
+        slow expand or write stage holds up fetching. Expanding stays in this thread since it updates the node
+        queue.
+
+        Batches are expanded in the order they are fetched, so nodes may be returned in a different order than
+        _get_nodes().
         """
-        node_ids = []
-        while node_queue:
-            pop_node_id, pop_definition_name, pop_level = node_queue.popleft()
-            node_ids.append(pop_node_id)
-            pop_definition = self.get_definition(pop_definition_name)
-            peak_definition_name = None
-            peak_level = None
-            if node_queue:
-                peak_node_id, peak_definition_name, peak_level = node_queue[0]
-            if peak_definition_name != pop_definition_name or peak_level != pop_level or len(
-                    node_ids) == pop_definition.node_batch_size:
-                yield node_ids, pop_definition_name, pop_level
-                node_ids = []
-
-    def get_node(self, node_id, definition_name, omit_fields_for_error=False):
+        # Map of futures to (node ids, definition name, level, try count) of batches being fetched
+        fetching = {}
+        # Batches that have been fetched and are waiting to be expanded
+        fetched = collections.deque()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix='fetch')
+        try:
+            while node_queue or node_queue.has_pages() or node_queue.has_retries() or fetching or fetched:
+                is_exhausted = self.budget.is_exhausted()
+                if is_exhausted and not fetching and not fetched:
+                    log.warning('Stopping with %s nodes, %s edge pages and %s retries left in node queue because '
+                                'budget is exhausted.', len(node_queue), node_queue.page_count(),
+                                node_queue.retry_count())
+                    return
+                # Fetch stage
+                while not is_exhausted and len(fetching) + len(fetched) < self.fetch_queue_size:
+                    retry = node_queue.pop_retry()
+                    if retry is None and not node_queue:
+                        break
+                    batch = self._pop_node_batch(node_queue, node_counter, queued_nodes, retry)
+                    fetching[executor.submit(self._fetch_node_batch, batch[0], batch[1], batch[2], levels)] = batch
+                self._stage_depths = {'fetch': len(fetching), 'expand': len(fetched)}
+                log.debug('Stage depths: %s', self._stage_depths)
+                if not fetching and not fetched:
+                    if node_queue.has_pages():
+                        for edge_chunk in self._get_edge_chunk_batch(node_counter, node_queue, queued_nodes, levels,
+                                                                     exclude_definition_names, root_node_id):
+                            yield edge_chunk
+                    elif node_queue.has_retries():
+                        wait_secs = node_queue.get_retry_wait_secs()
+                        log.info('Waiting %s seconds to retry nodes', wait_secs)
+                        time.sleep(wait_secs)
+                    continue
+                if not fetched:
+                    done, _ = concurrent.futures.wait(fetching, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        fetched.append((future, fetching.pop(future)))
+                # Expand stage
+                future, (node_ids, definition_name, level, try_count) = fetched.popleft()
+                try:
+                    node_graph_dict = future.result()
+                except (RetryLater, FbException) as e:
+                    self._handle_fetch_error(e, node_ids, definition_name, level, try_count, node_queue, node_counter)
+                    continue
+                for graph in self._expand_node_batch(node_graph_dict, definition_name, level, levels, node_counter,
+                                                     node_queue, queued_nodes, exclude_definition_names,
+                                                     root_node_id):
+                    yield graph
+                # Edge pages alternate with batches of nodes.
+                if node_queue.is_page_batch_next():
+                    for edge_chunk in self._get_edge_chunk_batch(node_counter, node_queue, queued_nodes, levels,
+                                                                 exclude_definition_names, root_node_id):
+                        yield edge_chunk
+        finally:
+            for future in fetching:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self._stage_depths = {'fetch': 0, 'expand': 0}
+
+    def _pop_node_batch(self, node_queue, node_counter, queued_nodes, retry=None):
         """
-        Gets a node graph as specified by the node type definition.
+        Returns the next (node ids, definition name, level, try count) to retrieve: the retry, if provided, or the
+        next batch from the node queue.
+
+        Nodes that have been queued again at a shallower level are left out (so the batch may be empty).
         """
-        try:
-            url, params = self._prepare_node_request(node_id, definition_name,
-                                                     omit_fields_for_error=omit_fields_for_error)
-            # Using post because querystring might be huge.
-            params['method'] = 'GET'
-            node_graph = self._perform_http_post(url, data=params)
+        if retry is not None:
+            node_ids, definition_name, level, try_count = retry
+        else:
+            # The maximum number of nodes in a batch is the node batch size of the definition.
+            node_ids, definition_name, level = node_queue.pop_batch(self._get_node_batch_size)
+            try_count = 0
+        node_counter[definition_name] -= len(node_ids)
+        node_ids = self._drop_requeued_nodes(node_ids, level, queued_nodes)
+        log.info('Getting nodes {} ({}). {:,} nodes left: {}'.format(node_ids, definition_name, len(node_queue),
+                                                                     node_counter.most_common()))
+        return node_ids, definition_name, level, try_count
+
+    def _get_edge_chunk_batch(self, node_counter, node_queue, queued_nodes, levels, exclude_definition_names,
+                              root_node_id):
+        """
+        Retrieves a batch of queued edge pages (pages of edges of nodes already retrieved, batched across nodes),
+        yielding the edge chunks and queuing the nodes found in them.
+        """
+        new_edge_pages = []
+        for edge_chunk in self.get_edge_chunks(node_queue.pop_page_batch(PAGE_BATCH_SIZE), new_edge_pages):
+            chunk = edge_chunk['metadata']['chunk']
+            embedded_nodes = []
+            if levels == 0 or chunk['level'] < levels:
+                embedded_nodes = self._queue_connected_nodes(
+                    chunk['node_id'], edge_chunk['metadata']['type'], edge_chunk, chunk['level'], levels,
+                    node_counter, node_queue, queued_nodes, exclude_definition_names)
+            yield edge_chunk
+            for embedded_node in self._iter_embedded_nodes(embedded_nodes, chunk['level'] + 1, levels,
+                                                           node_counter, node_queue, queued_nodes,
+                                                           exclude_definition_names, root_node_id):
+                yield embedded_node
+        for edge_page in new_edge_pages:
+            node_queue.push_page(edge_page)
+
+    def _fetch_node_batch(self, node_ids, definition_name, level, levels):
+        """
+        Retrieves a batch of nodes, returning a map of node ids to node graphs.
 
-            # Queue of pages to retrieve.
-            paging_queue = collections.deque(self.find_paging_links(node_graph))
+        Retryable errors raise RetryLater rather than waiting. This may be called from a fetch worker, so it does not
+        update the node queue. When streaming edges, the edge pages to queue are recorded in the metadata of the
+        nodes.
+        """
+        # If a single node, use get_node. Otherwise, use get_node_batch. Get_node supports omitting fields.
+        node_graph_dict = dict()
+        # When streaming edges, additional pages are queued to be retrieved after the nodes are returned.
+        node_kwargs = {'get_pages': False} if self.stream_edges else {}
+        # Nodes at the last level are not expanded, so may be retrieved with a leaf profile.
+        leaf_profile = self.get_leaf_profile(definition_name) if levels != 0 and level >= levels else None
+        if leaf_profile is not None:
+            node_kwargs['leaf_profile'] = leaf_profile
+        # Rather than waiting to retry, nodes that fail are queued to be retried later.
+        with self._deferred_retries():
+            if len(node_ids) == 1:
+                node_graph_dict[node_ids[0]] = self.get_node(node_ids[0], definition_name, **node_kwargs)
+            else:
+                node_graph_dict = self.get_node_batch(node_ids, definition_name, **node_kwargs)
+            if self.stream_edges:
+                for node_id, node_graph in node_graph_dict.items():
+                    edge_pages = self.find_edge_pages(definition_name, node_graph, node_id, level)
+                    if leaf_profile is not None and not leaf_profile.get('get_pages', False):
+                        edge_pages = []
+                    if edge_pages:
+                        # Recorded so that resume can continue the edges.
+                        node_graph.setdefault('metadata', {})['edge_pages'] = edge_pages
+                    # Paging of fields that are not edges is still merged.
+                    self._get_pages(collections.deque(self.find_paging_links(node_graph)), PAGE_BATCH_SIZE)
+        return node_graph_dict
+
+    def _expand_node_batch(self, node_graph_dict, definition_name, level, levels, node_counter, node_queue,
+                           queued_nodes, exclude_definition_names, root_node_id):
+        """
+        Queues the edge pages and connected nodes of a batch of retrieved nodes, yielding the nodes and the
+        embedded nodes found in them.
+        """
+        for node_id, node_graph in node_graph_dict.items():
+            if self.stream_edges:
+                for edge_page in node_graph.get('metadata', {}).get('edge_pages', []):
+                    node_queue.push_page(edge_page)
+            embedded_nodes = []
+            if levels == 0 or level < levels:
+                embedded_nodes = self._queue_connected_nodes(node_id, definition_name, node_graph, level, levels,
+                                                             node_counter, node_queue, queued_nodes,
+                                                             exclude_definition_names)
+            for graph in self._yield_seen(node_graph, root_node_id, level, levels):
+                yield graph
+            for embedded_node in self._iter_embedded_nodes(embedded_nodes, level + 1, levels, node_counter,
+                                                           node_queue, queued_nodes, exclude_definition_names,
+                                                           root_node_id):
+                yield embedded_node
+
+    def _handle_fetch_error(self, error, node_ids, definition_name, level, try_count, node_queue, node_counter):
+        """
+        Queues a batch of nodes to be retried later for RetryLater or skips it for an unexpected
+        GraphMethodException. Otherwise, raises the error.
+        """
+        if isinstance(error, RetryLater):
+            try_count += 1
+            if try_count >= self.retry_policy.get_max_tries(error.error):
+                log.error('received too many errors for %s', node_ids)
+                raise error.error
+            log.warning('Retrying %s later after error: %s', node_ids, error.error)
+            node_queue.push_retry(node_ids, definition_name, level,
+                                  time.time() + self.retry_policy.get_delay_secs(error.error, try_count), try_count)
+            node_counter[definition_name] += len(node_ids)
+        # Sometimes get unexpected GraphMethodException: Unsupported get request.
+        elif error.code == 100 and error.subcode == 33:
+            log.warning('Skipping %s due to unexpected GraphMethodException: %s', node_ids, error)
+        else:
+            raise error
 
-            # Retrieve pages. Note that additional pages may be appended to queue.
-            while paging_queue:
-                pages = []
-                for _ in range(min(PAGE_BATCH_SIZE, len(paging_queue))):
-                    page_link, graph_fragment = paging_queue.popleft()
-                    pages.append((page_link, graph_fragment))
-                paging_queue.extend(self.get_page_batch(pages))
+    def _queue_connected_nodes(self, node_id, definition_name, graph_fragment, level, levels, node_counter,
+                               node_queue, queued_nodes, exclude_definition_names, retrieved=True):
+        """
+        Queues the nodes found in a graph fragment of a retrieved node (or an edge chunk) for the next level.
 
-            return node_graph
-        except FbException as e:
-            # Try omitting fields
-            definition = self.get_definition(definition_name)
-            if e.code in definition.omit_on_error_fields_by_error_code and not omit_fields_for_error:
-                log.info('Getting node %s (%s), omitting fields for error %s', node_id, definition_name, e.code)
-                return self.get_node(node_id, definition_name, omit_fields_for_error=e.code)
-            else:
-                raise e
+        Returns a list of the connected nodes whose embedded graph fragments are complete (see is_embedded_enough()),
+        which are used rather than queued. retrieved is False for the graph fragment of such a node.
+        """
+        connected_nodes = self._find_edge_fragments(definition_name, graph_fragment, default_only=False)
+        embedded_nodes = []
+        added_count = 0
+        # Checking queued nodes makes sure that never has been queued before (at this level or a shallower level).
+        for parent_node_id, _, connected_node_id, connected_definition_name, connected_fragment in connected_nodes:
+            if not self._is_queued(queued_nodes, connected_node_id, level + 1, levels) and (
+                    connected_definition_name is None or
+                    connected_definition_name not in exclude_definition_names):
+                if self.is_seen(connected_node_id, level + 1, levels):
+                    log.debug('%s found in %s already retrieved for %s', connected_node_id, node_id,
+                              self.seen_index.get(connected_node_id))
+                    continue
+                if not self.budget.allow_node(connected_definition_name, level + 1):
+                    log.debug('%s found in %s exceeds limits', connected_node_id, node_id)
+                    continue
+                queued_nodes[connected_node_id] = level + 1
+                # Edges of the retrieved node are requested with all fields for definitions that embed all fields.
+                if self.is_embedded_enough(connected_definition_name, retrieved and parent_node_id == node_id):
+                    log.debug('%s found in %s is embedded', connected_node_id, node_id)
+                    embedded_nodes.append(dict(connected_fragment, metadata={'type': connected_definition_name,
+                                                                             'embedded': True}))
+                    continue
+                log.debug('%s found in %s', connected_node_id, node_id)
+                node_queue.push(connected_node_id, connected_definition_name, level + 1,
+                                node_fragment=connected_fragment)
+                node_counter[connected_definition_name] += 1
+                added_count += 1
+        log.debug("%s connected nodes found in %s, %s embedded and %s added to node queue.", len(connected_nodes),
+                  node_id, len(embedded_nodes), added_count)
+        return embedded_nodes
 
-    def get_node_batch(self, node_ids, definition_name):
+    @staticmethod
+    def _is_queued(queued_nodes, node_id, level, levels):
         """
-        Gets a node graphs for a list of nodes as specified by the node type definition.
+        Returns True if a node has been queued at the level or a shallower level (or at all, if levels are
+        unlimited).
+
+        Schedulers other than breadth first can find a node at a deeper level first. It is queued again when found
+        at a shallower level, so that as many levels of its connected nodes are retrieved as breadth first.
         """
-        definition = self.get_definition(definition_name)
-        nodes_graph_dict = dict()
-        try:
-            url, params = self._prepare_nodes_request(node_ids, definition_name)
-            # Using post because querystring might be huge.
-            params['method'] = 'GET'
-            # Returns a map of ids to graphs
-            nodes_graph_dict = self._perform_http_post(url, data=params)
+        queued_level = queued_nodes.get(node_id)
+        return queued_level is not None and (levels == 0 or queued_level <= level)
 
-            paging_queue = collections.deque()
+    @staticmethod
+    def _drop_requeued_nodes(node_ids, level, queued_nodes):
+        """
+        Returns the node ids of a batch at a level, leaving out nodes that have been queued again at a shallower
+        level.
+        """
+        return [node_id for node_id in node_ids if queued_nodes.get(node_id, level) >= level]
 
-            for node_id in node_ids:
-                if node_id in nodes_graph_dict:
-                    # Queue of pages to retrieve.
-                    paging_queue.extend(self.find_paging_links(nodes_graph_dict[node_id]))
-                else:
-                    log.warning('Node %s is missing or not permitted, so skipping.', node_id)
+    def _iter_embedded_nodes(self, embedded_nodes, level, levels, node_counter, node_queue, queued_nodes,
+                             exclude_definition_names, root_node_id):
+        """
+        Returns an iterator of embedded nodes, queuing the nodes found in them.
+        """
+        embedded_queue = collections.deque((embedded_node, level) for embedded_node in embedded_nodes)
+        while embedded_queue:
+            embedded_node, embedded_level = embedded_queue.popleft()
+            if levels == 0 or embedded_level < levels:
+                embedded_queue.extend((node, embedded_level + 1) for node in self._queue_connected_nodes(
+                    embedded_node['id'], embedded_node['metadata']['type'], embedded_node, embedded_level, levels,
+                    node_counter, node_queue, queued_nodes, exclude_definition_names, retrieved=False))
+            for graph in self._yield_seen(embedded_node, root_node_id, embedded_level, levels):
+                yield graph
 
-            # Retrieve pages. Note that additional pages may be appended to queue.
+    @staticmethod
+    def _get_expanded_levels(level, levels):
+        """
+        Returns the number of levels of connected nodes retrieved for a node at a level, or None if unlimited.
+        """
+        return None if levels == 0 else max(0, levels - level)
+
+    def is_seen(self, node_id, level, levels):
+        """
+        Returns True if a node at a level has already been retrieved, with at least as many levels of connected
+        nodes as would be retrieved for it now.
+        """
+        if self.seen_index is None:
+            return False
+        seen = self._pending_seen.get(node_id, self.seen_index.get(node_id))
+        if seen is None:
+            return False
+        # Recorded with only the root node id
+        if not isinstance(seen, list):
+            return True
+        seen_levels, expanded_levels = seen[1], self._get_expanded_levels(level, levels)
+        return seen_levels is None or (expanded_levels is not None and seen_levels >= expanded_levels)
+
+    def _yield_seen(self, graph, root_node_id, level, levels):
+        """
+        Yields a node, recording it in the seen index once the next node is requested (unless defer_seen).
+        """
+        if self.seen_index is not None:
+            self._pending_seen[graph['id']] = [root_node_id, self._get_expanded_levels(level, levels)]
+        yield graph
+        if not self.defer_seen:
+            self.record_seen(graph)
+
+    def record_seen(self, graph):
+        """
+        Records a returned node in the seen index.
+        """
+        if self.seen_index is None or is_edge_chunk(graph):
+            return
+        seen = self._pending_seen.pop(graph['id'], None)
+        if seen is not None:
+            self.seen_index.set(graph['id'], seen)
+
+    def is_embedded_enough(self, definition_name, is_edge_of_retrieved_node=False):
+        """
+        Returns True if a node found embedded in an edge is complete, so that it does not need to be retrieved.
+
+        This is the case when the definition has no fields or edges that are not default (so the fields requested
+        for an edge are the same as for the node), is marked as embedded_is_enough or, for edges of a retrieved
+        node, embeds all fields.
+        """
+        if definition_name is None:
+            return False
+        definition = self.get_definition(definition_name)
+        return definition.embedded_is_enough or not (definition.fields or definition.edges) or (
+            is_edge_of_retrieved_node and definition.embed_all_fields)
+
+    def _get_node_batch_size(self, definition_name):
+        if self.size_tuner is not None:
+            return self.size_tuner.get_node_batch_size(definition_name, self.get_definition(definition_name))
+        return self.get_definition(definition_name).node_batch_size
+
+    def _get_edge_size(self, definition_name):
+        if self.size_tuner is not None:
+            return self.size_tuner.get_edge_size(definition_name, self.get_definition(definition_name))
+        return self.get_definition(definition_name).edge_size
+
+    def _tune_sizes(self, definition_name, node_count, too_much_data=False):
+        """
+        Reports the last response for nodes of a definition (or a please reduce the amount of data error) to the size
+        tuner, if any.
+        """
+        if self.size_tuner is None or (self.last_response_secs is None and not too_much_data):
+            return
+        definition = self.get_definition(definition_name)
+        edge_definitions = dict()
+        for edge in itertools.chain(definition.default_edges, definition.edges):
+            edge_type = definition.get_edge_type(edge)
+            edge_definitions[edge_type] = self.get_definition(edge_type)
+        if too_much_data:
+            self.size_tuner.reduce(definition_name, definition, edge_definitions, node_count)
+        else:
+            self.size_tuner.record_response(definition_name, definition, edge_definitions, node_count,
+                                            self.last_response_secs, self.last_response_bytes)
+
+    def get_node(self, node_id, definition_name, omit_fields_for_error=False, get_pages=True, leaf_profile=None):
+        """
+        Gets a node graph as specified by the node type definition.
+
+        If get_pages is False, additional pages of edges are not retrieved and paging is left in the graph.
+
+        If a leaf profile is provided, only the edges of the leaf profile are retrieved.
+
+        Nodes that the omit cache has learned need fields omitted are requested without them on the first attempt.
+        """
+        url, params, omit_fields_for_error = self._prepare_node_post(node_id, definition_name, omit_fields_for_error,
+                                                                     leaf_profile)
+        try:
+            self.last_response_secs = None
+            node_graph = self._perform_http_post(url, data=params)
+            self._tune_sizes(definition_name, 1)
+
+            if get_pages:
+                paging_queue, windows = self._queue_node_pages(definition_name, [node_graph], leaf_profile)
+                self._get_pages(paging_queue, PAGE_BATCH_SIZE)
+                self._merge_windows(windows)
+
+            return node_graph
+        except FbException as e:
+            error_code = self._handle_node_error(e, node_id, definition_name, omit_fields_for_error)
+            return self.get_node(node_id, definition_name, omit_fields_for_error=error_code, get_pages=get_pages,
+                                 leaf_profile=leaf_profile)
+
+    def get_node_batch(self, node_ids, definition_name, get_pages=True, leaf_profile=None):
+        """
+        Gets a node graphs for a list of nodes as specified by the node type definition.
+
+        If get_pages is False, additional pages of edges are not retrieved and paging is left in the graphs.
+
+        If a leaf profile is provided, only the edges of the leaf profile are retrieved.
+        """
+        definition = self.get_definition(definition_name)
+        nodes_graph_dict = dict()
+        omitted_node_ids, node_ids, omit_fields_for_error = self._split_omitted_nodes(node_ids, definition_name)
+        for node_id in omitted_node_ids:
+            nodes_graph_dict[node_id] = self.get_node(node_id, definition_name, get_pages=get_pages,
+                                                      leaf_profile=leaf_profile)
+        if not node_ids:
+            return nodes_graph_dict
+        try:
+            url, params = self._prepare_nodes_request(node_ids, definition_name, leaf_profile=leaf_profile,
+                                                      omit_fields_for_error=omit_fields_for_error)
+            # Using post because querystring might be huge.
+            params['method'] = 'GET'
+            # Returns a map of ids to graphs
+            self.last_response_secs = None
+            batch_graph_dict = self._perform_http_post(url, data=params)
+            self._handle_node_batch(batch_graph_dict, node_ids, definition_name, omit_fields_for_error)
+            nodes_graph_dict.update(batch_graph_dict)
+
+            if get_pages:
+                paging_queue, windows = self._queue_node_pages(definition_name, batch_graph_dict.values(),
+                                                               leaf_profile)
+                self._get_pages(paging_queue, definition.node_batch_size)
+                self._merge_windows(windows)
+        except FbException as e:
+            self._handle_node_batch_error(e, node_ids, definition_name)
+            for node_id in node_ids:
+                log.info('Getting node %s (%s)', node_id, definition_name)
+                nodes_graph_dict[node_id] = self.get_node(node_id, definition_name, get_pages=get_pages,
+                                                          leaf_profile=leaf_profile)
+        return nodes_graph_dict
+
+    # Steps of getting nodes that are shared with AsyncFbarc, which only differs in how requests are performed.
+
+    def _prepare_node_post(self, node_id, definition_name, omit_fields_for_error=False, leaf_profile=None):
+        """
+        Returns (url, params, error code of the omitted fields or False) for a post getting a node.
+
+        On the first attempt, fields are omitted if the omit cache has learned that the node needs them omitted.
+        Otherwise, the request is counted by the omit cache.
+        """
+        definition = self.get_definition(definition_name)
+        if not omit_fields_for_error:
+            error_code = self.omit_cache.get_error_code(node_id, definition_name)
+            if error_code in definition.omit_on_error_fields_by_error_code:
+                log.debug('Getting node %s (%s), omitting fields for learned error %s', node_id, definition_name,
+                          error_code)
+                omit_fields_for_error = error_code
+            else:
+                self.omit_cache.count_request(definition_name)
+        url, params = self._prepare_node_request(node_id, definition_name, omit_fields_for_error=omit_fields_for_error,
+                                                 leaf_profile=leaf_profile)
+        # Using post because querystring might be huge.
+        params['method'] = 'GET'
+        return url, params, omit_fields_for_error
+
+    def _handle_node_error(self, error, node_id, definition_name, omit_fields_for_error=False):
+        """
+        Returns the error code for which to omit fields when trying a node again after an error.
+
+        Raises the error if fields can't be omitted for it or were already omitted.
+        """
+        if error.code == 1:
+            self._tune_sizes(definition_name, 1, too_much_data=True)
+        if error.code in self.get_definition(definition_name).omit_on_error_fields_by_error_code and \
+                not omit_fields_for_error:
+            self.omit_cache.count_error(node_id, definition_name, error.code)
+            log.info('Getting node %s (%s), omitting fields for error %s', node_id, definition_name, error.code)
+            return error.code
+        raise error
+
+    def _split_omitted_nodes(self, node_ids, definition_name):
+        """
+        Returns (node ids to get by themselves, node ids to get in a batch, error code of the fields to omit for the
+        batch or False).
+
+        Nodes that have needed fields omitted are retrieved by themselves (omitting the fields) and the others
+        without the fields omitted for the definition, if any. Sampled batches (see OmitCache) are retrieved with the
+        fields and counted by the omit cache if they succeed.
+        """
+        omit_fields_for_error = self.omit_cache.get_definition_error_code(definition_name, sample=True)
+        if omit_fields_for_error not in self.get_definition(definition_name).omit_on_error_fields_by_error_code:
+            omit_fields_for_error = False
+        omitted_node_ids = [node_id for node_id in node_ids if node_id in self.omit_cache]
+        return omitted_node_ids, [node_id for node_id in node_ids if node_id not in omitted_node_ids], \
+            omit_fields_for_error
+
+    def _handle_node_batch(self, nodes_graph_dict, node_ids, definition_name, omit_fields_for_error=False):
+        """
+        Records the response for a batch of nodes with the size tuner and omit cache.
+        """
+        self._tune_sizes(definition_name, len(node_ids))
+        if not omit_fields_for_error:
+            self.omit_cache.count_request(definition_name, len(node_ids))
+        for node_id in node_ids:
+            if node_id not in nodes_graph_dict:
+                log.warning('Node %s is missing or not permitted, so skipping.', node_id)
+
+    def _handle_node_batch_error(self, error, node_ids, definition_name):
+        """
+        Raises the error for a batch of nodes unless the nodes should be tried one node at a time, i.e., for a too
+        much data exception (1) or other error with an omittable error code.
+        """
+        if error.code == 1:
+            self._tune_sizes(definition_name, len(node_ids), too_much_data=True)
+        elif error.code not in self.get_definition(definition_name).omit_on_error_fields_by_error_code:
+            raise error
+        log.warning('Please reduce the amount of data error or other error, so trying one node at a time.')
+
+    def _queue_node_pages(self, definition_name, node_graphs, leaf_profile=None):
+        """
+        Returns (queue of pages to retrieve, time windows to merge once retrieved) for the edges of node graphs.
+
+        No pages are queued for a leaf profile that doesn't get pages.
+        """
+        paging_queue = collections.deque()
+        windows = []
+        if leaf_profile is None or leaf_profile.get('get_pages', False):
+            for node_graph in node_graphs:
+                paging_queue.extend(self.find_paging_links(node_graph))
+                windows.extend(self._slice_pages(definition_name, node_graph, paging_queue))
+        return paging_queue, windows
+
+    def _get_pages(self, paging_queue, batch_size):
+        """
+        Retrieve pages in batches. Note that additional pages may be appended to queue.
+
+        Pages that exceed the budget are not retrieved.
+
+        Failed pages are retried in place rather than deferred, so that the node and the pages already merged into it
+        are not retrieved again.
+        """
+        # Map of graph fragments to number of pages retrieved for them
+        page_counter = collections.Counter()
+        with self._deferred_retries(False):
             while paging_queue:
                 pages = []
-                for _ in range(min(definition.node_batch_size, len(paging_queue))):
+                while paging_queue and len(pages) < batch_size:
                     page_link, graph_fragment = paging_queue.popleft()
-                    pages.append((page_link, graph_fragment))
-                paging_queue.extend(self.get_page_batch(pages))
-        except FbException as e:
-            # Try one node at a time if too much data exception (1)
-            # or other error with an omittable error code.
-            if e.code == 1 or e.code in definition.omit_on_error_fields_by_error_code:
-                log.warning('Please reduce the amount of data error or other error, so trying one node at a time.')
-                for node_id in node_ids:
-                    log.info('Getting node %s (%s)', node_id, definition_name)
-                    nodes_graph_dict[node_id] = self.get_node(node_id, definition_name)
-            else:
-                raise e
-        return nodes_graph_dict
+                    if self.budget.allow_page(page_link, len(graph_fragment), page_counter[id(graph_fragment)]):
+                        page_counter[id(graph_fragment)] += 1
+                        pages.append((page_link, graph_fragment))
+                if pages:
+                    page_starts = [len(graph_fragment) for _, graph_fragment in pages]
+                    paging_queue.extend(self._trim_pages(pages, page_starts, self.get_page_batch(pages)))
+
+    def _trim_pages(self, pages, page_starts, new_pages):
+        """
+        Trims the edges of retrieved pages to the maximum number of items.
 
-    def get_page_batch(self, pages):
-        log.debug('Getting batch with %s pages', len(pages))
-        batch_list = []
-        for page_link, _ in pages:
-            batch_list.append({'method': 'GET', 'relative_url': page_link[len(GRAPH_URL) + 1:]})
-        data = {'batch': json.dumps(batch_list), 'include_headers': 'false'}
+        page_starts are the number of items in the graph fragments of the pages before the pages were merged.
+
+        Returns the new pages without the next pages of trimmed edges or the pages of edges of removed items.
+        """
+        dropped_fragment_ids = set()
+        for (page_link, graph_fragment), page_start in zip(pages, page_starts):
+            trimmed_items = self.budget.trim_edge(page_link, graph_fragment, page_start=page_start)
+            if trimmed_items:
+                dropped_fragment_ids.add(id(graph_fragment))
+                dropped_fragment_ids.update(id(fragment) for fragment in iter_lists(trimmed_items))
+        return [(page_link, graph_fragment) for page_link, graph_fragment in new_pages
+                if id(graph_fragment) not in dropped_fragment_ids]
+
+    def _slice_pages(self, definition_name, node_graph, paging_queue):
+        """
+        Replaces the next page of the time-sliced edges of a node graph in a paging queue with pages for since/until
+        windows, so that the windows are retrieved in parallel (in the same batches) rather than one page at a time.
+
+        An edge is time-sliced when its time_slices is set in the definition. The windows are between the created
+        time of the last item on the first page and the created time of the node (or FACEBOOK_EPOCH).
+
+        Returns a list of (graph fragment, list of window graph fragments) to be merged once retrieved.
+        """
+        definition = self.get_definition(definition_name)
+        windows = []
+        for edge in itertools.chain(definition.default_edges, definition.edges):
+            time_slices = definition.definition_map[edge].get('time_slices')
+            if not time_slices or edge not in node_graph or 'data' not in node_graph[edge] or \
+                    self.budget.is_edge_limited(edge):
+                continue
+            graph_fragment = node_graph[edge]['data']
+            for index, (page_link, page_graph_fragment) in enumerate(paging_queue):
+                if page_graph_fragment is graph_fragment:
+                    break
+            else:
+                continue
+            try:
+                until = min(int(iso8601.parse_date(node['created_time']).timestamp()) for node in graph_fragment)
+                since = int(iso8601.parse_date(node_graph['created_time']).timestamp()) \
+                    if 'created_time' in node_graph else FACEBOOK_EPOCH
+            except (KeyError, ValueError, iso8601.ParseError):
+                log.debug('Not slicing %s edge of %s without created times', edge, node_graph.get('id'))
+                continue
+            if until <= since:
+                continue
+            del paging_queue[index]
+            window_fragments = []
+            # Including the last item on the first page, so no items with the same created time are missed.
+            for window_since, window_until in get_time_windows(since, until + 1, time_slices):
+                window_fragment = []
+                window_fragments.append(window_fragment)
+                paging_queue.append((get_window_link(page_link, window_since, window_until), window_fragment))
+            log.debug('Slicing %s edge of %s into %s windows', edge, node_graph.get('id'), len(window_fragments))
+            windows.append((graph_fragment, window_fragments))
+        return windows
 
-        batch_json = self._perform_http_post(GRAPH_URL, data=data)
+    @staticmethod
+    def _merge_windows(windows):
+        """
+        Merges the retrieved windows into their graph fragments in order, skipping items in more than one window.
+        """
+        for graph_fragment, window_fragments in windows:
+            node_ids = set(node['id'] for node in graph_fragment)
+            for window_fragment in window_fragments:
+                for node in window_fragment:
+                    if node['id'] not in node_ids:
+                        node_ids.add(node['id'])
+                        graph_fragment.append(node)
 
+    def get_page_batch(self, pages):
         new_pages = []
-        for count, (page_link, graph_fragment) in enumerate(pages):
-            batch_item = batch_json[count]
-            body = json.loads(batch_item['body'])
-            if batch_item['code'] != 200:
-                log.error('Error for page %s in batch: %s', page_link, json.dumps(body, indent=4))
+        page_fragments = self.iter_page_fragments([page_link for page_link, _ in pages])
+        for (page_link, graph_fragment), page_fragment in zip(pages, page_fragments):
+            if page_fragment is None:
                 # Try getting this by itself
                 new_pages.extend(self.get_page(page_link, graph_fragment))
             else:
-                new_pages.extend(self.merge_page(body, graph_fragment))
+                new_pages.extend(self.merge_page(page_fragment, graph_fragment))
         return new_pages
 
+    def iter_page_fragments(self, page_links):
+        """
+        Retrieves pages in a batch request, returning an iterator of page fragments in the order of the page links.
+
+        The page fragment is None for a page that is missing from the batch or has an error.
+        """
+        log.debug('Getting batch with %s pages', len(page_links))
+        batch_item_iter = self._perform_http_post(GRAPH_URL, data=self._prepare_page_batch_request(page_links),
+                                                  stream_items=True)
+        batch_items = batch_item_iter
+        try:
+            for page_link in page_links:
+                batch_item = None
+                try:
+                    batch_item = next(batch_items)
+                except (StopIteration,) + STREAM_ERRORS as e:
+                    # A truncated response falls back to retrieving the remaining pages by themselves.
+                    log.error('Error reading batch: %s', repr(e))
+                    batch_items = iter(())
+                # Decoding each body as its item is reached, so that only one body is buffered at a time.
+                yield self._get_batch_body(page_link, batch_item)
+        finally:
+            # Closes the response, including when not all of the pages are read.
+            batch_item_iter.close()
+
+    @staticmethod
+    def _prepare_page_batch_request(page_links):
+        """
+        Prepare the params of a batch request for pages. The access token is not included in the params.
+        """
+        batch_list = []
+        for page_link in page_links:
+            batch_list.append({'method': 'GET', 'relative_url': page_link[len(GRAPH_URL) + 1:]})
+        return {'batch': json.dumps(batch_list), 'include_headers': 'false'}
+
+    @staticmethod
+    def _get_batch_body(page_link, batch_item):
+        """
+        Returns the decoded body of the item of a batch response for a page or None if it is missing or has an error.
+        """
+        body = None
+        # An item is null if the request in the batch did not complete.
+        if batch_item is not None:
+            try:
+                body = json_loads(batch_item.pop('body'))
+            except (KeyError, ValueError) as e:
+                log.error('Error reading batch: %s', repr(e))
+        if body is None:
+            log.warning('Page %s missing from batch', page_link)
+            return None
+        if batch_item['code'] != 200:
+            log.error('Error for page %s in batch: %s', page_link, json.dumps(body, indent=4))
+            return None
+        return body
+
     def get_page(self, page_link, graph_fragment):
-        pages = []
+        page_fragment = self.get_page_fragment(page_link)
+        if page_fragment is None:
+            return []
+        return self.merge_page(page_fragment, graph_fragment)
+
+    def get_page_fragment(self, page_link, use_token=False):
+        """
+        Returns the page fragment for a page or None if there is an error.
+
+        Paging links include the access token, unless it was stripped.
+        """
         try:
-            page_json = self._perform_http_get(page_link, use_token=False)
-            pages = self.merge_page(page_json, graph_fragment)
+            return self._perform_http_get(page_link, use_token=use_token)
         except FbException:
             log.warning('Ignoring error on page.')
-        return pages
+        return None
+
+    def get_edge_chunks(self, edge_pages, new_edge_pages):
+        """
+        Retrieves edge pages in a batch, returning an iterator of edge chunks as each page is retrieved.
+
+        An edge chunk is a graph fragment of the node that has the edge containing only a page of the edge, e.g.,
+        {"id": "123_456", "metadata": {"type": "post", "chunk": {"node_id": "123", "level": 1, "edge": "comments",
+         "page": 1, "link": "https://graph.facebook.com/v2.11/123_456/comments?after=MTAx"}},
+         "comments": {"data": [...]}}
+        node_id and level are the retrieved node in which the edge was found.
+
+        Edge pages for the next pages of the edges and for the edges of the items in the pages are appended to
+        new_edge_pages and recorded in the metadata of the edge chunks. Pages that exceed the budget are not retrieved.
+        """
+        edge_pages = [edge_page for edge_page in edge_pages
+                      if self.budget.allow_page(edge_page['link'], edge_page['items'], edge_page['pages'])]
+        if not edge_pages:
+            return
+        page_fragments = self.iter_page_fragments([edge_page['link'] for edge_page in edge_pages])
+        for edge_page, page_fragment in zip(edge_pages, page_fragments):
+            if page_fragment is None:
+                # Try getting this by itself. The access token was stripped from the link.
+                page_fragment = self.get_page_fragment(edge_page['link'], use_token=True)
+                if page_fragment is None:
+                    continue
+            items = page_fragment['data']
+            # A trimmed edge is recorded as stopped at this page.
+            is_trimmed = bool(self.budget.trim_edge(edge_page['link'], items, item_count=edge_page['items']))
+            chunk_edge_pages = []
+            if 'next' in page_fragment.get('paging', {}) and not is_trimmed:
+                chunk_edge_pages.append(dict(edge_page, link=strip_access_token(page_fragment['paging']['next']),
+                                             items=edge_page['items'] + len(items), pages=edge_page['pages'] + 1))
+            edge_type = self.get_definition(edge_page['type']).get_edge_type(edge_page['edge'])
+            for node in items:
+                chunk_edge_pages.extend(self.find_edge_pages(edge_type, node, edge_page['node_id'],
+                                                             edge_page['level']))
+            self._get_pages(collections.deque(self.find_paging_links(items)), PAGE_BATCH_SIZE)
+            metadata = {
+                'type': edge_page['type'],
+                'chunk': {'node_id': edge_page['node_id'], 'level': edge_page['level'], 'edge': edge_page['edge'],
+                          'page': edge_page['pages'] + 1, 'link': edge_page['link']}
+            }
+            if chunk_edge_pages:
+                metadata['edge_pages'] = chunk_edge_pages
+                new_edge_pages.extend(chunk_edge_pages)
+            yield {'id': edge_page['owner_id'], 'metadata': metadata, edge_page['edge']: {'data': items}}
 
     def merge_page(self, page_fragment, graph_fragment):
         """
@@ -676,6 +2370,190 @@ class Fbarc(object):
 
         return pages
 
+    def plan(self, root_node_id, root_definition_name, levels=1, exclude_definition_names=None,
+             sample_size=PLAN_SAMPLE_SIZE):
+        """
+        Estimates the cost of retrieving the nodes for a root node for the specified number of levels, without
+        retrieving them.
+
+        At each level, up to sample_size nodes of each definition (found in the first pages of the edges of the
+        sampled nodes of the previous level) are retrieved with the summaries of their edges. The number of items of
+        an edge is the total count of the summary or, if not available, is extrapolated from the created times of the
+        items of the first page back to the created time of the node. Edges for which neither is available are
+        counted by their first page only and are listed as lower bounds. Additional pages of the edges nested in the
+        items of edges are projected the same way from the sampled items. Nodes at the last level are projected with
+        their leaf profile, if any (see get_leaf_profile()).
+
+        Returns a map with the estimated nodes per definition and level, requests, bytes and seconds (at the
+        current delay or the latency of the sample requests, if longer).
+        """
+        exclude_definition_names = exclude_definition_names or []
+        definition_node_counter = collections.Counter()
+        level_node_counters = []
+        node_request_count = 0
+        page_count = 0
+        byte_count = 0
+        lower_bound_edges = set()
+        sample_request_count = 0
+        sample_secs = []
+        level_nodes = {root_definition_name: 1}
+        level_samples = {root_definition_name: [root_node_id]}
+        for level in range(1, levels + 1):
+            next_level_nodes = collections.Counter()
+            next_level_samples = collections.defaultdict(list)
+            for definition_name, node_count in level_nodes.items():
+                definition = self.get_definition(definition_name)
+                max_nodes = self.budget.max_definition_nodes.get(definition_name)
+                if max_nodes is not None:
+                    node_count = min(node_count, max(0, max_nodes - definition_node_counter[definition_name]))
+                if not node_count:
+                    continue
+                definition_node_counter[definition_name] += node_count
+                if not self.is_embedded_enough(definition_name) or level == 1:
+                    node_request_count += math.ceil(node_count / self._get_node_batch_size(definition_name))
+                # Nodes at the last level are retrieved with the leaf profile, if any.
+                leaf_profile = self.get_leaf_profile(definition_name) if level == levels else None
+                sample_graphs = []
+                sample_node_ids = level_samples[definition_name][:sample_size]
+                if sample_node_ids:
+                    sample_request_count += 1
+                    try:
+                        url, params = self._prepare_nodes_request(sample_node_ids, definition_name,
+                                                                  leaf_profile=leaf_profile, summary=True)
+                        params['method'] = 'GET'
+                        self.last_response_secs = None
+                        sample_graphs = list(self._perform_http_post(url, data=params).values())
+                        if self.last_response_secs is not None:
+                            sample_secs.append(self.last_response_secs)
+                    except FbException as e:
+                        log.warning('Unable to sample %s (%s): %s', sample_node_ids, definition_name, e)
+                if not sample_graphs:
+                    continue
+                byte_count += node_count * sum(len(json_dumps(graph)) for graph in sample_graphs) / len(sample_graphs)
+                get_pages = leaf_profile is None or leaf_profile.get('get_pages', False)
+                edges = itertools.chain(definition.default_edges, definition.edges)
+                if leaf_profile is not None:
+                    edges = [edge for edge in edges if edge in leaf_profile.get('edges', ())]
+                for edge in edges:
+                    edge_type = definition.get_edge_type(edge)
+                    edge_definition = self.get_definition(edge_type)
+                    # The edges nested in the items of the edge (see _prepare_field_param())
+                    nested_edges = list(edge_definition.default_edges)
+                    if edge_definition.embed_all_fields:
+                        nested_edges.extend(edge_definition.edges)
+                    edge_item_count = 0
+                    edge_page_count = 0
+                    for graph in sample_graphs:
+                        item_count, graph_page_count = self._estimate_edge_pages(definition_name, graph, edge,
+                                                                                 lower_bound_edges)
+                        items = self._get_edge_items(graph, edge)
+                        edge_item_count += item_count
+                        if get_pages:
+                            edge_page_count += graph_page_count + self._estimate_nested_pages(
+                                edge_type, items, item_count, nested_edges, lower_bound_edges)
+                        next_level_samples[edge_type].extend(node['id'] for node in items)
+                    page_count += node_count * edge_page_count / len(sample_graphs)
+                    if level < levels and definition.should_follow_edge(edge) and \
+                            edge_type not in exclude_definition_names:
+                        next_level_nodes[edge_type] += node_count * edge_item_count / len(sample_graphs)
+            level_node_counters.append(dict((definition_name, int(round(node_count)))
+                                            for definition_name, node_count in level_nodes.items() if node_count))
+            max_level_nodes = self.budget.max_level_nodes.get(level + 1)
+            total_next_level_nodes = sum(next_level_nodes.values())
+            if max_level_nodes is not None and total_next_level_nodes > max_level_nodes:
+                for definition_name in next_level_nodes:
+                    next_level_nodes[definition_name] *= max_level_nodes / total_next_level_nodes
+            level_nodes = next_level_nodes
+            level_samples = next_level_samples
+        # Pages are retrieved in batches.
+        request_count = node_request_count + math.ceil(page_count / PAGE_BATCH_SIZE)
+        secs_per_request = max([self.delay_secs] + sample_secs)
+        return {
+            'levels': level_node_counters,
+            'nodes': dict((definition_name, int(round(node_count)))
+                          for definition_name, node_count in definition_node_counter.items()),
+            'requests': request_count,
+            'pages': int(round(page_count)),
+            'bytes': int(round(byte_count)),
+            'secs': int(round(request_count * secs_per_request)),
+            'sample_requests': sample_request_count,
+            'lower_bound_edges': sorted(lower_bound_edges)
+        }
+
+    def _estimate_edge_pages(self, definition_name, graph, edge, lower_bound_edges):
+        """
+        Returns (estimated number of items, estimated number of additional pages) of an edge of a sampled graph of a
+        definition, within the budget. Edges for which the estimate is a lower bound are added to lower_bound_edges.
+        """
+        definition = self.get_definition(definition_name)
+        edge_size = self.budget.get_edge_size(edge, self._get_edge_size(definition.get_edge_type(edge)))
+        item_count, is_lower_bound = self._estimate_edge_items(graph, edge)
+        if is_lower_bound:
+            lower_bound_edges.add('{}.{}'.format(definition_name, edge))
+        max_pages, max_items = self.budget.get_edge_limits(edge)
+        if max_items is not None:
+            item_count = min(item_count, max_items)
+        page_count = max(0, math.ceil(item_count / edge_size) - 1)
+        if max_pages is not None:
+            page_count = min(page_count, max_pages)
+            item_count = min(item_count, edge_size * (page_count + 1))
+        return item_count, page_count
+
+    def _estimate_nested_pages(self, definition_name, items, item_count, edges, lower_bound_edges):
+        """
+        Returns the estimated number of additional pages of the edges nested in item_count items of a definition,
+        extrapolated from the sampled items. Deeper edges are nested with their default edges.
+        """
+        if not items:
+            return 0
+        definition = self.get_definition(definition_name)
+        page_count = 0
+        for edge in edges:
+            edge_type = definition.get_edge_type(edge)
+            for item in items:
+                nested_item_count, nested_page_count = self._estimate_edge_pages(definition_name, item, edge,
+                                                                                 lower_bound_edges)
+                page_count += nested_page_count + self._estimate_nested_pages(
+                    edge_type, self._get_edge_items(item, edge), nested_item_count,
+                    self.get_definition(edge_type).default_edges, lower_bound_edges)
+        return page_count * item_count / len(items)
+
+    @staticmethod
+    def _get_edge_items(graph, edge):
+        """
+        Returns the items of the first page of an edge of a graph (or the connected node of a single node edge).
+        """
+        edge_fragment = graph.get(edge)
+        if not isinstance(edge_fragment, dict):
+            return []
+        return edge_fragment.get('data', [edge_fragment])
+
+    @staticmethod
+    def _estimate_edge_items(graph, edge):
+        """
+        Returns (estimated number of items of an edge of a node graph, whether the estimate is a lower bound).
+        """
+        edge_fragment = graph.get(edge)
+        if not isinstance(edge_fragment, dict):
+            return 0, False
+        if 'data' not in edge_fragment:
+            return 1, False
+        items = edge_fragment['data']
+        total_count = edge_fragment.get('summary', {}).get('total_count')
+        if total_count is not None:
+            return max(total_count, len(items)), False
+        if 'next' not in edge_fragment.get('paging', {}):
+            return len(items), False
+        # Extrapolating the rate of items in the first page back to the created time of the node.
+        created_times = [iso8601.parse_date(item['created_time']).timestamp() for item in items
+                         if 'created_time' in item]
+        if len(created_times) > 1 and max(created_times) > min(created_times):
+            since = iso8601.parse_date(graph['created_time']).timestamp() if 'created_time' in graph \
+                else FACEBOOK_EPOCH
+            return max(len(items), int(len(items) * (max(created_times) - since) /
+                                       (max(created_times) - min(created_times)))), False
+        return len(items), True
+
     def get_metadata(self, node_id):
         """
         Retrieve the metadata for a node.
@@ -696,9 +2574,55 @@ class Fbarc(object):
         """
         Look up the type of a node.
         """
-        return self.get_metadata(node_id)['metadata']['type']
+        node_type = self.type_cache.get(node_id)
+        if node_type is None:
+            node_type = self.get_metadata(node_id)['metadata']['type']
+            self.type_cache.set(node_id, node_type)
+        return node_type
+
+    def discover_types(self, node_ids):
+        """
+        Look up the types of nodes, returning a map of node ids to types.
+
+        Types are looked up in batches and cached. Nodes that are missing or not
+        permitted are omitted.
+        """
+        node_types = {}
+        lookup_node_ids = []
+        for node_id in node_ids:
+            if node_id in self.type_cache:
+                node_types[node_id] = self.type_cache.get(node_id)
+            elif node_id not in node_types:
+                # Placeholder to avoid looking up the same node twice.
+                node_types[node_id] = None
+                lookup_node_ids.append(node_id)
+        for start in range(0, len(lookup_node_ids), DISCOVER_BATCH_SIZE):
+            batch_node_ids = lookup_node_ids[start:start + DISCOVER_BATCH_SIZE]
+            log.info('Discovering types of %s nodes', len(batch_node_ids))
+            try:
+                nodes_dict = self._perform_http_get(GRAPH_URL, params={
+                    'ids': ','.join(batch_node_ids),
+                    'metadata': 1,
+                    'fields': 'metadata{type}'
+                })
+            except FbException as e:
+                # A single missing node fails the entire batch, so try one node at a time.
+                log.warning('Error discovering types for batch, so trying one node at a time: %s', e)
+                nodes_dict = {}
+                for node_id in batch_node_ids:
+                    try:
+                        nodes_dict[node_id] = self.get_metadata(node_id)
+                    except FbException as e:
+                        log.warning('Error discovering type for %s: %s', node_id, e)
+            for node_id in batch_node_ids:
+                if node_id in nodes_dict:
+                    node_types[node_id] = nodes_dict[node_id]['metadata']['type']
+                    self.type_cache.set(node_id, node_types[node_id])
+                else:
+                    log.warning('Node %s is missing or not permitted, so skipping.', node_id)
+        return {node_id: node_type for node_id, node_type in node_types.items() if node_type is not None}
 
-    def _prepare_node_request(self, node_id, definition_name, omit_fields_for_error=False):
+    def _prepare_node_request(self, node_id, definition_name, omit_fields_for_error=False, leaf_profile=None):
         """
         Prepare the request url and params for a single node.
 
@@ -707,11 +2631,12 @@ class Fbarc(object):
         params = {
             'metadata': 1,
             'fields': self._prepare_field_param(definition_name, default_only=False,
-                                                omit_fields_for_error=omit_fields_for_error)
+                                                omit_fields_for_error=omit_fields_for_error, leaf_profile=leaf_profile)
         }
         return self._prepare_url(node_id), params
 
-    def _prepare_nodes_request(self, node_ids, definition_name):
+    def _prepare_nodes_request(self, node_ids, definition_name, leaf_profile=None, omit_fields_for_error=False,
+                               summary=False):
         """
         Prepare the request url and params for multiple nodes.
 
@@ -720,7 +2645,9 @@ class Fbarc(object):
         params = {
             'ids': ','.join(node_ids),
             'metadata': 1,
-            'fields': self._prepare_field_param(definition_name, default_only=False)
+            'fields': self._prepare_field_param(definition_name, default_only=False,
+                                                omit_fields_for_error=omit_fields_for_error, leaf_profile=leaf_profile,
+                                                summary=summary)
         }
         return GRAPH_URL, params
 
@@ -731,15 +2658,22 @@ class Fbarc(object):
         """
         return "{}/{}".format(GRAPH_URL, node_id)
 
-    def _prepare_field_param(self, definition_name, default_only=True, omit_fields_for_error=False):
+    def _prepare_field_param(self, definition_name, default_only=True, omit_fields_for_error=False,
+                             leaf_profile=None, nested=False, summary=False):
         """
         Construct the fields parameter.
+
+        If a leaf profile is provided, only its edges are included.
+
+        nested is True for the fields of an edge.
+
+        If summary, the summary (with the total count, for edges that support it) of edges is requested.
         """
         definition = self.get_definition(definition_name)
         # Get omitted fields, if any
         omit_fields = definition.omit_on_error_fields_by_error_code.get(omit_fields_for_error, [])
         fields = []
-        if not default_only:
+        if not default_only and not nested:
             fields.append('metadata{type}')
         fields.extend(definition.default_fields)
         if not default_only:
@@ -752,13 +2686,19 @@ class Fbarc(object):
         edges = list(definition.default_edges)
         if not default_only:
             edges.extend(definition.edges)
+        if leaf_profile is not None:
+            edges = [edge for edge in edges if edge in leaf_profile.get('edges', ())]
         for edge in edges:
             if edge not in omit_fields:
                 edge_type = definition.get_edge_type(edge)
                 edge_definition = self.get_definition(edge_type)
+                # Definitions that embed all fields have all fields for the edges of the node, but not deeper.
+                embed_all_fields = edge_definition.embed_all_fields and not default_only and not nested
+                edge_size = self.budget.get_edge_size(edge, self._get_edge_size(edge_type))
                 fields.append(
-                    '{}.limit({}){{{}}}'.format(edge, edge_definition.edge_size,
-                                                self._prepare_field_param(edge_type)))
+                    '{}.limit({}){}{{{}}}'.format(edge, edge_size, '.summary(true)' if summary else '',
+                                                  self._prepare_field_param(edge_type, default_only=not embed_all_fields,
+                                                                            nested=True, summary=summary)))
         if 'id' not in fields:
             fields.insert(0, 'id')
         return ','.join(fields)
@@ -767,8 +2707,31 @@ class Fbarc(object):
         """
         Returns a list of (node ids, definition names) found in a graph fragment.
         """
+        return [(node_id, node_definition_name) for node_id, node_definition_name, _ in
+                self.find_connected_node_fragments(definition_name, graph_fragment, default_only=default_only)]
+
+    def find_connected_node_fragments(self, definition_name, graph_fragment, default_only=True):
+        """
+        Returns a list of (node ids, definition names, node graph fragments) found in a graph fragment.
+        """
+        return [(node_id, node_definition_name, node) for _, _, node_id, node_definition_name, node in
+                self._find_edge_fragments(definition_name, graph_fragment, default_only=default_only)]
+
+    def find_edges(self, definition_name, graph_fragment, default_only=True):
+        """
+        Returns a list of (parent node id, edge, node id) for the connected nodes found in a graph fragment.
+        """
+        return [(parent_node_id, edge, node_id) for parent_node_id, edge, node_id, _, _ in
+                self._find_edge_fragments(definition_name, graph_fragment, default_only=default_only)]
+
+    def _find_edge_fragments(self, definition_name, graph_fragment, default_only=True):
+        """
+        Returns a list of (parent node id, edge, node id, definition name, node graph fragment) found in
+        a graph fragment.
+        """
         connected_nodes = []
         definition = self.get_definition(definition_name)
+        parent_node_id = graph_fragment.get('id')
         # Get the connections from the definition.
         edges = list(definition.default_edges)
         if not default_only:
@@ -779,14 +2742,23 @@ class Fbarc(object):
                 if edge in graph_fragment:
                     if 'data' in graph_fragment[edge]:
                         for node in graph_fragment[edge]['data']:
-                            connected_nodes.append((node['id'], edge_type))
-                            connected_nodes.extend(self.find_connected_nodes(edge_type, node))
+                            connected_nodes.append((parent_node_id, edge, node['id'], edge_type, node))
+                            connected_nodes.extend(self._find_edge_fragments(edge_type, node))
                     else:
                         node = graph_fragment[edge]
-                        connected_nodes.append((node['id'], edge_type))
-                        connected_nodes.extend(self.find_connected_nodes(edge_type, node))
+                        connected_nodes.append((parent_node_id, edge, node['id'], edge_type, node))
+                        connected_nodes.extend(self._find_edge_fragments(edge_type, node))
         return connected_nodes
 
+    def get_leaf_profile(self, definition_name):
+        """
+        Returns the leaf profile for nodes of a definition at the last level or None to retrieve them in full.
+        """
+        leaf_profile = self.get_definition(definition_name).leaf_profile
+        if leaf_profile is None and self.prune_leaves:
+            return DEFAULT_LEAF_PROFILE
+        return leaf_profile
+
     def get_definition(self, definition_name):
         if definition_name not in self._definitions:
             # This will raise a KeyError if not found
@@ -795,126 +2767,111 @@ class Fbarc(object):
                 definition_name).load_module(definition_name).definition)
         return self._definitions[definition_name]
 
-    def _perform_http_get(self, *args, use_token=True, try_count=1, **kwargs):
-        # Optional delay
-        if self.last_get:
-            wait_secs = self.delay_secs - (datetime.now() - self.last_get).total_seconds()
-            if wait_secs > 0:
-                log.debug('Sleeping %s', wait_secs)
-                time.sleep(wait_secs)
-        self.last_get = datetime.now()
+    def _perform_http_get(self, url, use_token=True, **kwargs):
+        """
+        Perform an HTTP get, returning the decoded JSON.
+        """
+        return self._perform_http_request('GET', url, use_token=use_token, **kwargs)
+
+    def _perform_http_post(self, url, use_token=True, stream_items=False, **kwargs):
+        """
+        Perform an HTTP post, returning the decoded JSON.
+
+        If stream_items, the response is a JSON array and an iterator of its items is returned.
+        """
+        return self._perform_http_request('POST', url, use_token=use_token, stream_items=stream_items, **kwargs)
+
+    def _perform_http_request(self, method, url, use_token=True, stream_items=False, **kwargs):
+        """
+        Perform an HTTP get or post, retrying failed requests according to the retry policy.
 
-        url = args[0]
-        params = kwargs.pop('params', {})
+        When retries are deferred (see _deferred_retries()), a retryable error that the retry policy allows
+        deferring raises RetryLater instead of waiting to retry.
+        """
+        params_key = 'params' if method == 'GET' else 'data'
+        params = kwargs.pop(params_key, {})
         if use_token:
             params['access_token'] = self.token
 
-        try:
-            response = requests.get(params=params, *args, **kwargs)
-            raise_for_fb_exception(response, params=params)
-        except requests.exceptions.ConnectionError as e:
-            # Handle (possibly) transient connection errors
-            logging.error('caught connection error %s on %s try', e, try_count)
-            if self.get_errors_limit == try_count:
-                logging.error('received too many errors for %s (%s)', url, params)
-                raise e
-            else:
-                time.sleep(self.get_error_delay_secs * try_count)
-                return self._perform_http_get(*args, use_token=use_token, try_count=try_count + 1, params=params,
-                                              **kwargs)
-        except requests.exceptions.HTTPError as e:
-            # Handle (possibly) transient http errors
-            logging.error('caught http error %s on %s try', e, try_count)
-            if e.response.status_code in (408, 503, 504):
-                if self.get_errors_limit == try_count:
-                    logging.error('received too many errors for %s (%s)', url, params)
-                    raise e
+        try_count = 1
+        while True:
+            self._wait_for_request()
+            self.budget.count_request()
+            start_time = time.time()
+            try:
+                if method == 'GET':
+                    response = requests.get(url, params=params, **kwargs)
                 else:
-                    time.sleep(self.get_error_delay_secs * try_count)
-                    return self._perform_http_get(*args, use_token=use_token, try_count=try_count + 1, params=params,
-                                                  **kwargs)
-            else:
-                raise e
+                    response = requests.post(url, data=params, stream=stream_items, **kwargs)
+                raise_for_fb_exception(response, **{params_key: params})
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError, FbException) as e:
+                time.sleep(self._get_retry_delay_secs(e, self.retry_policy.is_retryable(e), url, params, try_count))
+                try_count += 1
+        self.retry_policy.record_success()
+        if stream_items:
+            return iter_json_array(response)
+        self.last_response_secs = time.time() - start_time
+        self.last_response_bytes = len(response.content)
+        return json_loads(response.content)
+
+    def _get_retry_delay_secs(self, error, is_retryable, url, params, try_count):
+        """
+        Records a failed request with the retry policy and returns the number of seconds to wait before retrying it.
 
-        except FbException as e:
-            # Handle transient facebook errors and unexpected GraphMethodException: Unsupported get request.
-            # Seem that this GraphMethodException may be transient.
-            # Also too much data requested is sometimes transient (1).
-            if e.is_transient or (e.code == 100 and e.subcode == 33) or e.code == 1:
-                logging.error('caught facebook error %s on %s try', e, try_count)
-                if e.code == 1 and self.get_too_much_data_errors_limit == try_count:
-                    logging.error('received too many too much data errors')
-                    raise e
-                elif self.get_errors_limit == try_count:
-                    logging.error('received too many errors')
-                    raise e
-                else:
-                    time.sleep(self.get_error_delay_secs * try_count)
-                    return self._perform_http_get(*args, use_token=use_token, try_count=try_count + 1, params=params,
-                                                  **kwargs)
-            else:
-                raise e
-        return response.json()
+        Raises the error if it is not retryable or the request has been tried too many times. When retries are
+        deferred (see _deferred_retries()), raises RetryLater if the retry policy allows deferring it.
+        """
+        if not is_retryable:
+            raise error
+        logging.error('caught error %s on %s try', error, try_count)
+        self.retry_policy.record_failure()
+        if try_count >= self.retry_policy.get_max_tries(error):
+            logging.error('received too many errors for %s (%s)', url, params)
+            raise error
+        if getattr(self._local, 'deferring_retries', False) and self.retry_policy.can_defer(error):
+            raise RetryLater(error)
+        delay_secs = self.retry_policy.get_delay_secs(error, try_count)
+        log.debug('Retrying in %s', delay_secs)
+        return delay_secs
+
+    def _wait_for_request(self):
+        # Shared by fetch workers
+        with self._throttle_lock:
+            for wait_secs in self._iter_request_waits():
+                time.sleep(wait_secs)
 
-    def _perform_http_post(self, *args, use_token=True, try_count=1, **kwargs):
+    def _iter_request_waits(self):
+        """
+        Yields the number of seconds to wait before making a request, recording the time of the request once waited.
+        """
+        # Waiting while the circuit breaker is open
+        breaker_secs = self.retry_policy.get_breaker_secs()
+        if breaker_secs > 0:
+            log.warning('Pausing requests for %s seconds after repeated errors', breaker_secs)
+            yield breaker_secs
         # Optional delay
         if self.last_get:
             wait_secs = self.delay_secs - (datetime.now() - self.last_get).total_seconds()
             if wait_secs > 0:
                 log.debug('Sleeping %s', wait_secs)
-                time.sleep(wait_secs)
+                yield wait_secs
         self.last_get = datetime.now()
 
-        url = args[0]
-        data = kwargs.pop('data', {})
-        if use_token:
-            data['access_token'] = self.token
+    @contextlib.contextmanager
+    def _deferred_retries(self, defer=True):
+        """
+        Context in which retryable errors raise RetryLater, so that the caller can retry later rather than wait.
 
+        If defer is False, retries are waited for in the context (e.g., for pages of nodes that have already been
+        retrieved).
+        """
+        was_deferring_retries = getattr(self._local, 'deferring_retries', False)
+        self._local.deferring_retries = defer and self.defer_retries
         try:
-            response = requests.post(data=data, *args, **kwargs)
-            raise_for_fb_exception(response, data=data)
-        except requests.exceptions.ConnectionError as e:
-            # Handle (possibly) transient connection errors
-            logging.error('caught connection error %s on %s try', e, try_count)
-            if self.get_errors_limit == try_count:
-                logging.error('received too many errors for %s (%s)', url, data)
-                raise e
-            else:
-                time.sleep(self.get_error_delay_secs * try_count)
-                return self._perform_http_post(*args, use_token=use_token, try_count=try_count + 1, data=data, **kwargs)
-        except requests.exceptions.HTTPError as e:
-            # Handle (possibly) transient http errors
-            logging.error('caught http error %s on %s try', e, try_count)
-            if e.response.status_code in (408, 503, 504):
-                if self.get_errors_limit == try_count:
-                    logging.error('received too many errors for %s (%s)', url, data)
-                    raise e
-                else:
-                    time.sleep(self.get_error_delay_secs * try_count)
-                    return self._perform_http_post(*args, use_token=use_token, try_count=try_count + 1, data=data,
-                                                   **kwargs)
-            else:
-                raise e
-
-        except FbException as e:
-            # Handle transient facebook errors and unexpected GraphMethodException: Unsupported get request.
-            # Seem that this GraphMethodException may be transient.
-            # Also too much data requested is also transient.
-            if e.is_transient or (e.code == 100 and e.subcode == 33) or e.code == 1:
-                logging.error('caught facebook error %s on %s try', e, try_count)
-                if e.code == 1 and self.get_too_much_data_errors_limit == try_count:
-                    logging.error('received too many too much data errors')
-                    raise e
-                elif self.get_errors_limit == try_count:
-                    logging.error('received too many errors for %s (%s)', url, data)
-                    raise e
-                else:
-                    time.sleep(self.get_error_delay_secs * try_count)
-                    return self._perform_http_post(*args, use_token=use_token, try_count=try_count + 1, data=data,
-                                                   **kwargs)
-            else:
-                raise e
-        return response.json()
+            yield
+        finally:
+            self._local.deferring_retries = was_deferring_retries
 
     def find_paging_links(self, graph_fragment):
         """
@@ -949,67 +2906,1198 @@ class Fbarc(object):
 
         return page_queue
 
-    def resume(self, filepath, levels=1, exclude_definition_names=None):
+    def find_edge_pages(self, definition_name, graph_fragment, node_id, level):
+        """
+        Returns a list of edge pages for the edges found in a graph fragment of a retrieved node.
+
+        An edge page is a dict of link (without the access token), node_id and level (the retrieved node), owner_id
+        (the node that has the edge), type (the definition name of the owner), edge, items (the number of items
+        already retrieved) and pages (the number of pages already retrieved).
+
+        Paging of edges is removed from the graph fragment.
+        """
+        edge_pages = []
+        definition = self.get_definition(definition_name)
+        for edge in itertools.chain(definition.default_edges, definition.edges):
+            if edge not in graph_fragment or not isinstance(graph_fragment[edge], dict):
+                continue
+            edge_type = definition.get_edge_type(edge)
+            edge_fragment = graph_fragment[edge]
+            if 'data' in edge_fragment:
+                paging = edge_fragment.pop('paging', {})
+                if 'next' in paging:
+                    edge_pages.append({'link': strip_access_token(paging['next']), 'node_id': node_id, 'level': level,
+                                       'owner_id': graph_fragment['id'], 'type': definition_name, 'edge': edge,
+                                       'items': len(edge_fragment['data']), 'pages': 0})
+                for node in edge_fragment['data']:
+                    edge_pages.extend(self.find_edge_pages(edge_type, node, node_id, level))
+            else:
+                edge_pages.extend(self.find_edge_pages(edge_type, edge_fragment, node_id, level))
+        return edge_pages
+
+    def resume(self, filepath, levels=1, exclude_definition_names=None, scheduler=None, write_queue_size=0,
+               json_output_options=None, media_store=None):
+        """
+        Continues retrieving the nodes of an archive, appending them to the archive.
+
+        A normalized archive (i.e., with an edges file) is continued normalized.
+        """
+        edges_filepath = get_edges_filepath(filepath)
+        is_normalized = os.path.exists(edges_filepath)
+        # Ids of the nodes and fragments in a normalized archive
+        archived_node_ids = set()
+        fragment_ids = set()
         node_counter = collections.Counter()
         node_queue_dict = collections.OrderedDict()
-        queued_nodes = set()
-        with open(filepath) as file:
-            for count, line in enumerate(file):
-                node_graph = json.loads(line)
-                node_id = node_graph['id']
-                if count == 0:
-                    definition_name = node_graph['metadata']['type']
-                    node_queue_dict[node_id] = (node_id, definition_name, 1)
-                    node_counter[definition_name] += 1
-                    queued_nodes.add(node_id)
-                if node_id in node_queue_dict:
-                    _, definition_name, level = node_queue_dict.pop(node_id)
-                    node_counter[definition_name] -= 1
-                    if levels == 0 or level < levels:
-                        connected_nodes = self.find_connected_nodes(definition_name, node_graph,
-                                                                    default_only=False)
-                        added_count = 0
-                        for connected_node_id, connected_definition_name in connected_nodes:
-                            if connected_node_id not in queued_nodes and (
-                                    connected_definition_name is None or
-                                    connected_definition_name not in exclude_definition_names) and \
-                                    connected_node_id not in node_queue_dict:
-                                log.debug('%s found in %s', connected_node_id, node_id)
-                                node_queue_dict[connected_node_id] = (
-                                    connected_node_id, connected_definition_name, level + 1)
+        # Map of node ids to the shallowest level at which they were queued
+        queued_nodes = {}
+        # Map of links to edge pages that have not been retrieved
+        edge_page_dict = collections.OrderedDict()
+        root_node_id = None
+        for count, line in enumerate(ArchiveReader(filepath).iter_lines()):
+            node_graph = json_loads(line)
+            if node_graph.get('metadata', {}).get('fragment'):
+                # Fragments of normalized archives were not retrieved.
+                fragment_ids.add(node_graph['id'])
+                continue
+            node_id = node_graph['id']
+            if is_normalized and not is_edge_chunk(node_graph):
+                archived_node_ids.add(node_id)
+            if count == 0:
+                root_node_id = node_id
+                definition_name = node_graph['metadata']['type']
+                node_queue_dict[node_id] = (node_id, definition_name, 1, None)
+                node_counter[definition_name] += 1
+                queued_nodes[node_id] = 1
+            level = None
+            if is_edge_chunk(node_graph):
+                # Nodes found in an edge chunk are connected to the retrieved node in which the edge was found.
+                definition_name = node_graph['metadata']['type']
+                level = node_graph['metadata']['chunk']['level']
+                edge_page_dict.pop(node_graph['metadata']['chunk']['link'], None)
+            elif node_id in node_queue_dict:
+                _, definition_name, level, _ = node_queue_dict.pop(node_id)
+                node_counter[definition_name] -= 1
+            for edge_page in node_graph.get('metadata', {}).get('edge_pages', []):
+                edge_page_dict[edge_page['link']] = edge_page
+            if level is not None:
+                if levels == 0 or level < levels:
+                    connected_nodes = self.find_connected_node_fragments(definition_name, node_graph,
+                                                                         default_only=False)
+                    added_count = 0
+                    for connected_node_id, connected_definition_name, connected_fragment in connected_nodes:
+                        if not self._is_queued(queued_nodes, connected_node_id, level + 1, levels) and (
+                                connected_definition_name is None or
+                                connected_definition_name not in exclude_definition_names) and \
+                                not self.is_seen(connected_node_id, level + 1, levels) and \
+                                self.budget.allow_node(connected_definition_name, level + 1):
+                            log.debug('%s found in %s', connected_node_id, node_id)
+                            if connected_node_id not in node_queue_dict:
                                 node_counter[connected_definition_name] += 1
-                                added_count += 1
-                                queued_nodes.add(connected_node_id)
-                        log.debug("%s connected nodes found in %s and %s added to node queue.", len(connected_nodes),
-                                  node_id, added_count)
-        node_queue = collections.deque(node_queue_dict.values())
-        log.info('Resuming with %s nodes in node queue.', len(node_queue))
-        with JsonGraphOutput(filepath=filepath, mode='a') as output_file:
-            print_graphs(self._get_nodes(node_counter, node_queue, queued_nodes, levels, exclude_definition_names),
-                         (output_file,))
+                            # Only keeping the created time for schedulers, rather than the entire graph. A node
+                            # that is still queued is replaced at the shallower level.
+                            node_queue_dict[connected_node_id] = (
+                                connected_node_id, connected_definition_name, level + 1,
+                                {'created_time': connected_fragment.get('created_time')})
+                            added_count += 1
+                            queued_nodes[connected_node_id] = level + 1
+                    log.debug("%s connected nodes found in %s and %s added to node queue.", len(connected_nodes),
+                              node_id, added_count)
+        node_queue = scheduler if scheduler is not None else BfsScheduler()
+        for queue_node_id, definition_name, level, node_fragment in node_queue_dict.values():
+            node_queue.push(queue_node_id, definition_name, level, node_fragment=node_fragment)
+        for edge_page in edge_page_dict.values():
+            node_queue.push_page(edge_page)
+        log.info('Resuming with %s nodes and %s edge pages in node queue.', len(node_queue), node_queue.page_count())
+        with contextlib.ExitStack() as output_stack:
+            if is_manifest_filepath(filepath):
+                output_file = output_stack.enter_context(SegmentedJsonGraphOutput(
+                    filepath, mode='a', **(json_output_options or {})))
+            else:
+                output_file = output_stack.enter_context(JsonGraphOutput(
+                    filepath=filepath, mode='a', **(json_output_options or {})))
+            if is_normalized:
+                output_file = output_stack.enter_context(NormalizedGraphOutput(
+                    output_file, self, edges_filepath, mode='a', node_ids=archived_node_ids,
+                    fragment_ids=fragment_ids))
+            print_graphs(self._get_nodes(node_counter, node_queue, queued_nodes, levels, exclude_definition_names,
+                                         root_node_id=root_node_id),
+                         (output_file, SeenGraphOutput(self)), write_queue_size=write_queue_size,
+                         media_store=media_store)
+
+
+class AsyncFbarc(Fbarc):
+    """
+    Async API for retrieving nodes, for embedding in asyncio applications.
 
+    get_nodes is an async iterator and get_node, get_node_batch and get_page_batch are awaitable. Requests are made
+    with aiohttp, with up to concurrency requests (e.g., batches of nodes and batches of pages) at a time. Definitions,
+    requests, limits, the retry policy, the omit cache and the size tuner are shared with Fbarc. Streaming edges and
+    fetch workers are not supported, so raise ValueError.
 
-class Definition:
-    def __init__(self, definition_obj):
-        self.definition_map = definition_obj['fields']
-        self.node_batch_size = definition_obj.get('node_batch_size', DEFAULT_NODE_BATCH_SIZE)
-        self.edge_size = definition_obj.get('edge_size', DEFAULT_EDGE_SIZE)
-        self.csv_fields = definition_obj.get('csv_fields')
-        self.omit_on_error_fields_by_error_code = dict()
-        default_fields_set = set()
-        fields_set = set()
-        default_edges_set = set()
-        edges_set = set()
-        for name, field_definition in self.definition_map.items():
-            if not field_definition.get('omit'):
-                if 'edge_type' in field_definition:
-                    if field_definition.get('default'):
-                        default_edges_set.add(name)
-                    else:
-                        edges_set.add(name)
-                else:
-                    if field_definition.get('default'):
-                        default_fields_set.add(name)
+    Use as an async context manager, which closes the HTTP session (unless one was provided):
+
+        async with AsyncFbarc(token=token) as fb:
+            async for node_graph in fb.get_nodes('123', 'page', levels=2):
+                ...
+    """
+
+    def __init__(self, *args, session=None, concurrency=ASYNC_CONCURRENCY, **kwargs):
+        super(AsyncFbarc, self).__init__(*args, **kwargs)
+        if self.stream_edges:
+            raise ValueError('AsyncFbarc does not support stream_edges')
+        if self.fetch_workers > 1:
+            raise ValueError('AsyncFbarc does not support fetch_workers (use concurrency)')
+        self.concurrency = concurrency
+        self._session = session
+        self._owns_session = session is None
+        self._request_semaphore = asyncio.Semaphore(concurrency)
+        self._request_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None and self._owns_session:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            if aiohttp is None:
+                raise ValueError('aiohttp is not installed')
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def get_nodes(self, root_node_id, root_definition_name, levels=1, exclude_definition_names=None,
+                        scheduler=None):
+        """
+        Async iterator for getting nodes, starting with the root node and proceeding for the specified number of
+        levels of connected nodes (see Fbarc.get_nodes()).
+
+        Up to concurrency batches of nodes are retrieved at a time, so nodes are returned as their batches complete.
+        """
+        exclude_definition_names = exclude_definition_names or []
+        node_counter = collections.Counter()
+        node_queue = scheduler if scheduler is not None else BfsScheduler()
+        node_queue.push(root_node_id, root_definition_name, 1)
+        self.budget.allow_node(root_definition_name, 1)
+        node_counter[root_definition_name] += 1
+        # Map of node ids to the shallowest level at which they were queued
+        queued_nodes = {root_node_id: 1}
+        tasks = set()
+        try:
+            while node_queue or tasks:
+                while node_queue and len(tasks) < self.concurrency and not self.budget.is_exhausted():
+                    node_ids, definition_name, level = node_queue.pop_batch(self._get_node_batch_size)
+                    node_counter[definition_name] -= len(node_ids)
+                    node_ids = self._drop_requeued_nodes(node_ids, level, queued_nodes)
+                    if not node_ids:
+                        continue
+                    log.info('Getting nodes {} ({}). {:,} nodes left: {}'.format(
+                        node_ids, definition_name, len(node_queue), node_counter.most_common()))
+                    tasks.add(asyncio.ensure_future(self._get_level_node_batch(node_ids, definition_name, level,
+                                                                               levels)))
+                if not tasks:
+                    log.warning('Stopping with %s nodes left in node queue because budget is exhausted.',
+                                len(node_queue))
+                    return
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    definition_name, level, node_graph_dict = task.result()
+                    for node_id, node_graph in node_graph_dict.items():
+                        embedded_nodes = []
+                        if levels == 0 or level < levels:
+                            embedded_nodes = self._queue_connected_nodes(node_id, definition_name, node_graph, level,
+                                                                         levels, node_counter, node_queue,
+                                                                         queued_nodes, exclude_definition_names)
+                        for graph in self._yield_seen(node_graph, root_node_id, level, levels):
+                            yield graph
+                        for embedded_node in self._iter_embedded_nodes(embedded_nodes, level + 1, levels,
+                                                                       node_counter, node_queue, queued_nodes,
+                                                                       exclude_definition_names, root_node_id):
+                            yield embedded_node
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _get_level_node_batch(self, node_ids, definition_name, level, levels):
+        """
+        Returns (definition name, level, map of node ids to node graphs) for a batch of nodes at a level.
+        """
+        # Nodes at the last level are not expanded, so may be retrieved with a leaf profile.
+        leaf_profile = self.get_leaf_profile(definition_name) if levels != 0 and level >= levels else None
+        try:
+            if len(node_ids) == 1:
+                node_graph_dict = {node_ids[0]: await self.get_node(node_ids[0], definition_name,
+                                                                    leaf_profile=leaf_profile)}
+            else:
+                node_graph_dict = await self.get_node_batch(node_ids, definition_name, leaf_profile=leaf_profile)
+        except FbException as e:
+            # Sometimes get unexpected GraphMethodException: Unsupported get request.
+            if e.code == 100 and e.subcode == 33:
+                log.warning('Skipping %s due to unexpected GraphMethodException: %s', node_ids, e)
+                node_graph_dict = {}
+            else:
+                raise e
+        return definition_name, level, node_graph_dict
+
+    async def get_node(self, node_id, definition_name, omit_fields_for_error=False, get_pages=True,
+                       leaf_profile=None):
+        """
+        Gets a node graph as specified by the node type definition (see Fbarc.get_node()).
+        """
+        url, params, omit_fields_for_error = self._prepare_node_post(node_id, definition_name, omit_fields_for_error,
+                                                                     leaf_profile)
+        try:
+            self.last_response_secs = None
+            node_graph = await self._perform_http_request_async('POST', url, data=params)
+            self._tune_sizes(definition_name, 1)
+            if get_pages:
+                paging_queue, windows = self._queue_node_pages(definition_name, [node_graph], leaf_profile)
+                await self._get_pages_async(paging_queue, PAGE_BATCH_SIZE)
+                self._merge_windows(windows)
+            return node_graph
+        except FbException as e:
+            error_code = self._handle_node_error(e, node_id, definition_name, omit_fields_for_error)
+            return await self.get_node(node_id, definition_name, omit_fields_for_error=error_code,
+                                       get_pages=get_pages, leaf_profile=leaf_profile)
+
+    async def get_node_batch(self, node_ids, definition_name, get_pages=True, leaf_profile=None):
+        """
+        Gets node graphs for a list of nodes as specified by the node type definition (see Fbarc.get_node_batch()).
+
+        Nodes that are retrieved by themselves (e.g., after an error) are retrieved concurrently.
+        """
+        definition = self.get_definition(definition_name)
+        omitted_node_ids, node_ids, omit_fields_for_error = self._split_omitted_nodes(node_ids, definition_name)
+        nodes_graph_dict = await self._get_nodes_singly(omitted_node_ids, definition_name, get_pages, leaf_profile)
+        if not node_ids:
+            return nodes_graph_dict
+        try:
+            url, params = self._prepare_nodes_request(node_ids, definition_name, leaf_profile=leaf_profile,
+                                                      omit_fields_for_error=omit_fields_for_error)
+            params['method'] = 'GET'
+            self.last_response_secs = None
+            batch_graph_dict = await self._perform_http_request_async('POST', url, data=params)
+            self._handle_node_batch(batch_graph_dict, node_ids, definition_name, omit_fields_for_error)
+            nodes_graph_dict.update(batch_graph_dict)
+            if get_pages:
+                paging_queue, windows = self._queue_node_pages(definition_name, batch_graph_dict.values(),
+                                                               leaf_profile)
+                await self._get_pages_async(paging_queue, definition.node_batch_size)
+                self._merge_windows(windows)
+        except FbException as e:
+            self._handle_node_batch_error(e, node_ids, definition_name)
+            nodes_graph_dict.update(await self._get_nodes_singly(node_ids, definition_name, get_pages,
+                                                                 leaf_profile))
+        return nodes_graph_dict
+
+    async def _get_nodes_singly(self, node_ids, definition_name, get_pages, leaf_profile):
+        node_graphs = await asyncio.gather(*[self.get_node(node_id, definition_name, get_pages=get_pages,
+                                                           leaf_profile=leaf_profile)
+                                             for node_id in node_ids])
+        return dict(zip(node_ids, node_graphs))
+
+    async def _get_pages_async(self, paging_queue, batch_size):
+        """
+        Retrieve pages in batches, with the batches for the pages in the queue retrieved concurrently. Note that
+        additional pages may be appended to queue.
+
+        Pages that exceed the budget are not retrieved.
+        """
+        page_counter = collections.Counter()
+        while paging_queue:
+            pages = []
+            while paging_queue:
+                page_link, graph_fragment = paging_queue.popleft()
+                if self.budget.allow_page(page_link, len(graph_fragment), page_counter[id(graph_fragment)]):
+                    page_counter[id(graph_fragment)] += 1
+                    pages.append((page_link, graph_fragment))
+            page_starts = [len(graph_fragment) for _, graph_fragment in pages]
+            page_batches = [pages[i:i + batch_size] for i in range(0, len(pages), batch_size)]
+            new_pages = []
+            for page_batch_new_pages in await asyncio.gather(*[self.get_page_batch(page_batch)
+                                                               for page_batch in page_batches]):
+                new_pages.extend(page_batch_new_pages)
+            paging_queue.extend(self._trim_pages(pages, page_starts, new_pages))
+
+    async def get_page_batch(self, pages):
+        """
+        Retrieves a batch of (page link, graph fragment), merging the pages into the graph fragments.
+
+        Returns the list of (page link, graph fragment) for the next pages.
+        """
+        log.debug('Getting batch with %s pages', len(pages))
+        batch_items = await self._perform_http_request_async(
+            'POST', GRAPH_URL, data=self._prepare_page_batch_request([page_link for page_link, _ in pages]))
+        new_pages = []
+        for i, (page_link, graph_fragment) in enumerate(pages):
+            page_fragment = self._get_batch_body(page_link, batch_items[i] if i < len(batch_items) else None)
+            if page_fragment is None:
+                # Try getting this by itself
+                try:
+                    page_fragment = await self._perform_http_request_async('GET', page_link, use_token=False)
+                except FbException:
+                    log.warning('Ignoring error on page.')
+                    continue
+            new_pages.extend(self.merge_page(page_fragment, graph_fragment))
+        return new_pages
+
+    async def _perform_http_request_async(self, method, url, use_token=True, **kwargs):
+        """
+        Perform an HTTP get or post, returning the decoded JSON. Failed requests are retried according to the retry
+        policy without blocking other requests.
+        """
+        params_key = 'params' if method == 'GET' else 'data'
+        params = kwargs.pop(params_key, {})
+        if use_token:
+            params['access_token'] = self.token
+
+        try_count = 1
+        while True:
+            async with self._request_semaphore:
+                await self._wait_for_request_async()
+                self.budget.count_request()
+                start_time = time.time()
+                try:
+                    content = await self._send_request_async(method, url, params_key, params, **kwargs)
+                    break
+                except Exception as e:
+                    delay_secs = self._get_retry_delay_secs(e, self._is_retryable_async(e), url, params, try_count)
+            # Waiting outside of the semaphore so that other requests can be made.
+            await asyncio.sleep(delay_secs)
+            try_count += 1
+        self.retry_policy.record_success()
+        # Set after the last await, so that the caller reads them (e.g., for the size tuner) before other requests
+        # complete.
+        self.last_response_secs = time.time() - start_time
+        self.last_response_bytes = len(content)
+        return json_loads(content)
+
+    async def _wait_for_request_async(self):
+        async with self._request_lock:
+            for wait_secs in self._iter_request_waits():
+                await asyncio.sleep(wait_secs)
+
+    def _is_retryable_async(self, error):
+        if aiohttp is not None:
+            if isinstance(error, aiohttp.ClientResponseError):
+                return self.retry_policy.is_retryable_status(error.status)
+            if isinstance(error, aiohttp.ClientConnectionError):
+                return True
+        if isinstance(error, asyncio.TimeoutError):
+            return True
+        return self.retry_policy.is_retryable(error)
+
+    async def _send_request_async(self, method, url, params_key, params, **kwargs):
+        """
+        Sends a request, returning the content of the response or raising FbException or aiohttp errors.
+        """
+        async with self._get_session().request(method, url, **{params_key: params}, **kwargs) as response:
+            content = await response.read()
+            if response.status != 200:
+                try:
+                    error_response = json_loads(content)
+                except ValueError:
+                    error_response = None
+                if isinstance(error_response, dict) and 'error' in error_response:
+                    log.error('Error for %s: %s', url, json.dumps(error_response, indent=4))
+                    raise FbException(error_response)
+                response.raise_for_status()
+            return content
+
+
+class NodeScheduler(abc.ABC):
+    """
+    Base class for policies determining the order in which queued nodes are retrieved.
+
+    Batches only contain nodes with the same definition and level so that they can be
+    retrieved together.
+
+    Edge pages (additional pages of the edges of retrieved nodes, when streaming edges) are also queued.
+    They are retrieved in the order they were queued, in batches across nodes, alternating with batches
+    of nodes so that connected nodes are retrieved while later pages are pending.
+
+    Batches of nodes that failed with retryable errors are queued to be retried no earlier than a given time.
+    Those that are due are retrieved before other batches.
+
+    Subclasses implement push, pop_batch and __len__. The queues of edge pages and retries are set up on first use,
+    so subclasses don't need to call NodeScheduler.__init__().
+    """
+
+    _page_batch_next = False
+
+    @functools.cached_property
+    def _page_queue(self):
+        return collections.deque()
+
+    @functools.cached_property
+    def _retry_queue(self):
+        # Heap of (not before time, sequence, node ids, definition name, level, try count)
+        return []
+
+    @functools.cached_property
+    def _retry_sequence(self):
+        return itertools.count()
+
+    def push_retry(self, node_ids, definition_name, level, not_before, try_count):
+        """
+        Queue a batch of nodes to be retried no earlier than not_before. try_count is the number of tries so far.
+        """
+        heapq.heappush(self._retry_queue, (not_before, next(self._retry_sequence), node_ids, definition_name, level,
+                                           try_count))
+
+    def pop_retry(self, now=None):
+        """
+        Returns the next (list of node ids, definition name, level, try count) that is due, or None.
+        """
+        if self._retry_queue and self._retry_queue[0][0] <= (now if now is not None else time.time()):
+            return heapq.heappop(self._retry_queue)[2:]
+        return None
+
+    def has_retries(self):
+        return bool(self._retry_queue)
+
+    def retry_count(self):
+        return len(self._retry_queue)
+
+    def get_retry_wait_secs(self, now=None):
+        """
+        Returns the number of seconds until the next retry is due.
+        """
+        return max(0, self._retry_queue[0][0] - (now if now is not None else time.time()))
+
+    def push_page(self, edge_page):
+        """
+        Queue an edge page.
+        """
+        self._page_queue.append(edge_page)
+
+    def pop_page_batch(self, batch_size):
+        """
+        Returns a list of up to batch_size edge pages.
+        """
+        edge_pages = []
+        while self._page_queue and len(edge_pages) < batch_size:
+            edge_pages.append(self._page_queue.popleft())
+        return edge_pages
+
+    def has_pages(self):
+        return bool(self._page_queue)
+
+    def page_count(self):
+        return len(self._page_queue)
+
+    def is_page_batch_next(self):
+        """
+        Returns True if the next batch should be a batch of edge pages rather than nodes.
+        """
+        if not self._page_queue:
+            return False
+        if not len(self):
+            return True
+        self._page_batch_next = not self._page_batch_next
+        return self._page_batch_next
+
+    @abc.abstractmethod
+    def push(self, node_id, definition_name, level, node_fragment=None):
+        """
+        Queue a node. The node fragment is the part of the graph in which the node was found, if any.
+        """
+
+    @abc.abstractmethod
+    def pop_batch(self, batch_size_func):
+        """
+        Returns the next (list of node ids, definition name, level).
+
+        batch_size_func returns the maximum batch size for a definition name.
+        """
+
+    @abc.abstractmethod
+    def __len__(self):
+        """
+        Returns the number of queued nodes (not including edge pages and retries).
+        """
+
+
+class BfsScheduler(NodeScheduler):
+    """
+    Retrieves nodes in the order they were found, i.e., breadth first.
+    """
+
+    def __init__(self):
+        self._queue = collections.deque()
+
+    def push(self, node_id, definition_name, level, node_fragment=None):
+        self._queue.append((node_id, definition_name, level))
+
+    def pop_batch(self, batch_size_func):
+        node_ids = []
+        pop_node_id, pop_definition_name, pop_level = self._queue.popleft()
+        node_ids.append(pop_node_id)
+        batch_size = batch_size_func(pop_definition_name)
+        while self._queue and len(node_ids) < batch_size:
+            _, peek_definition_name, peek_level = self._queue[0]
+            if peek_definition_name != pop_definition_name or peek_level != pop_level:
+                break
+            node_ids.append(self._queue.popleft()[0])
+        return node_ids, pop_definition_name, pop_level
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class DfsScheduler(NodeScheduler):
+    """
+    Retrieves the most recently found nodes first, i.e., depth first.
+    """
+
+    def __init__(self):
+        self._stack = []
+
+    def push(self, node_id, definition_name, level, node_fragment=None):
+        self._stack.append((node_id, definition_name, level))
+
+    def pop_batch(self, batch_size_func):
+        node_ids = []
+        pop_node_id, pop_definition_name, pop_level = self._stack.pop()
+        node_ids.append(pop_node_id)
+        batch_size = batch_size_func(pop_definition_name)
+        while self._stack and len(node_ids) < batch_size:
+            _, peek_definition_name, peek_level = self._stack[-1]
+            if peek_definition_name != pop_definition_name or peek_level != pop_level:
+                break
+            node_ids.append(self._stack.pop()[0])
+        return node_ids, pop_definition_name, pop_level
+
+    def __len__(self):
+        return len(self._stack)
+
+
+class BucketScheduler(NodeScheduler):
+    """
+    Base class for schedulers that keep a bucket of nodes for each definition and level.
+
+    A batch is taken from the bucket with the lowest priority value.
+    """
+
+    def __init__(self):
+        # Map of (definition name, level) to heap of (priority value, sequence, node id)
+        self._buckets = {}
+        self._sequence = itertools.count()
+        self._len = 0
+
+    @abc.abstractmethod
+    def node_priority(self, node_id, definition_name, level, node_fragment):
+        """
+        Returns the priority value of a node. Lower values are retrieved first.
+        """
+
+    def push(self, node_id, definition_name, level, node_fragment=None):
+        bucket = self._buckets.setdefault((definition_name, level), [])
+        heapq.heappush(bucket, (self.node_priority(node_id, definition_name, level, node_fragment),
+                                next(self._sequence), node_id))
+        self._len += 1
+
+    def pop_batch(self, batch_size_func):
+        definition_name, level = min(self._buckets, key=lambda bucket_key: self._buckets[bucket_key][0])
+        bucket = self._buckets[(definition_name, level)]
+        node_ids = []
+        batch_size = batch_size_func(definition_name)
+        while bucket and len(node_ids) < batch_size:
+            node_ids.append(heapq.heappop(bucket)[2])
+        if not bucket:
+            del self._buckets[(definition_name, level)]
+        self._len -= len(node_ids)
+        return node_ids, definition_name, level
+
+    def __len__(self):
+        return self._len
+
+
+class PriorityScheduler(BucketScheduler):
+    """
+    Retrieves nodes by definition priority, e.g., all posts before any comments.
+
+    Definitions are provided in order of priority. Definitions that are not provided
+    have the lowest priority. Within the same priority, nodes are retrieved by level
+    and then in the order they were found.
+    """
+
+    def __init__(self, definition_names):
+        BucketScheduler.__init__(self)
+        self.definition_names = list(definition_names)
+
+    def node_priority(self, node_id, definition_name, level, node_fragment):
+        if definition_name in self.definition_names:
+            rank = self.definition_names.index(definition_name)
+        else:
+            rank = len(self.definition_names)
+        return rank, level
+
+
+class RecencyScheduler(BucketScheduler):
+    """
+    Retrieves the newest nodes first, based on the created_time of the node as found in
+    the graph. Nodes without a created time are retrieved last.
+    """
+
+    def node_priority(self, node_id, definition_name, level, node_fragment):
+        created_time = (node_fragment or {}).get('created_time')
+        if created_time:
+            try:
+                return -iso8601.parse_date(created_time).timestamp()
+            except iso8601.ParseError:
+                log.warning('Unable to parse created_time for %s: %s', node_id, created_time)
+        return 0
+
+
+SCHEDULERS = ('bfs', 'dfs', 'priority', 'recency')
+
+
+def create_scheduler(name='bfs', priority_definition_names=None):
+    """
+    Returns a new scheduler for the named policy.
+    """
+    if name == 'bfs':
+        return BfsScheduler()
+    elif name == 'dfs':
+        return DfsScheduler()
+    elif name == 'priority':
+        return PriorityScheduler(priority_definition_names or [])
+    elif name == 'recency':
+        return RecencyScheduler()
+    raise ValueError('Unknown scheduler {}'.format(name))
+
+
+class CrawlBudget(object):
+    """
+    Limits on retrieval. A limit of None is unlimited.
+
+    Edge limits are maps of edge names to limits. The None key provides the limit for all other edges.
+    Node limits are maps of definition names (or levels) to the maximum number of nodes to queue.
+
+    Edges that are not completely retrieved because of limits are recorded to the stopped edges file,
+    along with the link of the page at which retrieval stopped and the number of items of that page
+    that were retrieved (offset).
+    """
+
+    def __init__(self, max_edge_pages=None, max_edge_items=None, max_definition_nodes=None, max_level_nodes=None,
+                 max_requests=None, max_secs=None, stopped_edges_filepath=None):
+        self.max_edge_pages = max_edge_pages or {}
+        self.max_edge_items = max_edge_items or {}
+        self.max_definition_nodes = max_definition_nodes or {}
+        self.max_level_nodes = max_level_nodes or {}
+        self.max_requests = max_requests
+        self.max_secs = max_secs
+        self.start_time = time.time()
+        self.request_count = 0
+        self.definition_node_counter = collections.Counter()
+        self.level_node_counter = collections.Counter()
+        self.stopped_edge_count = 0
+        self._stopped_edges_file = open(stopped_edges_filepath, 'a') if stopped_edges_filepath else None
+        # Fetch workers count requests, nodes and stopped edges concurrently.
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._stopped_edges_file:
+            self._stopped_edges_file.close()
+            self._stopped_edges_file = None
+
+    def count_request(self):
+        with self._lock:
+            self.request_count += 1
+
+    def is_exhausted(self):
+        """
+        Returns True if the request or time limit has been reached.
+        """
+        if self.max_requests is not None and self.request_count >= self.max_requests:
+            return True
+        if self.max_secs is not None and time.time() - self.start_time >= self.max_secs:
+            return True
+        return False
+
+    @staticmethod
+    def _get_limit(limits, key):
+        return limits.get(key, limits.get(None))
+
+    def get_edge_size(self, edge, edge_size):
+        """
+        Returns the edge size, reduced to the maximum number of items for the edge.
+        """
+        max_items = self._get_limit(self.max_edge_items, edge)
+        if max_items is not None:
+            return max(1, min(edge_size, max_items))
+        return edge_size
+
+    def allow_node(self, definition_name, level):
+        """
+        Returns True and counts the node if it is within the node limits.
+        """
+        with self._lock:
+            max_definition_nodes = self.max_definition_nodes.get(definition_name)
+            if max_definition_nodes is not None and \
+                    self.definition_node_counter[definition_name] >= max_definition_nodes:
+                return False
+            max_level_nodes = self.max_level_nodes.get(level)
+            if max_level_nodes is not None and self.level_node_counter[level] >= max_level_nodes:
+                return False
+            self.definition_node_counter[definition_name] += 1
+            self.level_node_counter[level] += 1
+            return True
+
+    def is_edge_limited(self, edge):
+        """
+        Returns True if there is a page or item limit for the edge.
+        """
+        return self.get_edge_limits(edge) != (None, None)
+
+    def get_edge_limits(self, edge):
+        """
+        Returns (maximum number of pages, maximum number of items) for an edge. Either is None if not limited.
+        """
+        return self._get_limit(self.max_edge_pages, edge), self._get_limit(self.max_edge_items, edge)
+
+    def allow_page(self, page_link, item_count, page_count):
+        """
+        Returns True if the page is within the limits. Otherwise, records the edge as stopped.
+
+        item_count and page_count are the number of items and pages already retrieved for the edge.
+        """
+        _, edge = parse_page_link(page_link)
+        reason = None
+        if self.is_exhausted():
+            reason = 'budget'
+        else:
+            max_pages, max_items = self.get_edge_limits(edge)
+            if max_pages is not None and page_count >= max_pages:
+                reason = 'max_edge_pages'
+            elif max_items is not None and item_count >= max_items:
+                reason = 'max_edge_items'
+        if reason:
+            self.stop_edge(page_link, item_count, reason)
+            return False
+        return True
+
+    def trim_edge(self, page_link, graph_fragment, item_count=0, page_start=0):
+        """
+        Removes items from a graph fragment that exceed the maximum number of items for the edge, recording the edge
+        as stopped at the page. Returns the removed items.
+
+        item_count is the number of items of the edge that were already retrieved, but are not in the graph fragment.
+        page_start is the index in the graph fragment of the first item of the page.
+        """
+        _, edge = parse_page_link(page_link)
+        max_items = self._get_limit(self.max_edge_items, edge)
+        if max_items is None or item_count + len(graph_fragment) <= max_items:
+            return []
+        kept_count = max(0, max_items - item_count)
+        trimmed_items = graph_fragment[kept_count:]
+        del graph_fragment[kept_count:]
+        # The removed items are the rest of this page.
+        self.stop_edge(page_link, item_count + kept_count, 'max_edge_items', offset=kept_count - page_start)
+        return trimmed_items
+
+    def stop_edge(self, page_link, item_count, reason, offset=0):
+        node_id, edge = parse_page_link(page_link)
+        log.info('Stopping %s edge of %s after %s items (%s)', edge, node_id, item_count, reason)
+        with self._lock:
+            self.stopped_edge_count += 1
+            if self._stopped_edges_file:
+                self._stopped_edges_file.write(json.dumps({
+                    'node_id': node_id,
+                    'edge': edge,
+                    'items': item_count,
+                    'reason': reason,
+                    'next': strip_access_token(page_link),
+                    'offset': offset
+                }) + '\n')
+                self._stopped_edges_file.flush()
+
+
+class RetryPolicy(object):
+    """
+    Determines whether and when failed requests are retried.
+
+    The delay before a retry grows exponentially with the number of tries, with jitter so that retries are spread out.
+    Rate limit errors are retried after at least rate_limit_delay_secs.
+
+    After breaker_failures consecutive failures, the circuit breaker opens and all requests are paused for
+    breaker_secs.
+    """
+
+    def __init__(self, max_tries=10, max_too_much_data_tries=4, base_delay_secs=5, max_delay_secs=600,
+                 rate_limit_delay_secs=300, breaker_failures=5, breaker_secs=120):
+        self.max_tries = max_tries
+        self.max_too_much_data_tries = max_too_much_data_tries
+        self.base_delay_secs = base_delay_secs
+        self.max_delay_secs = max_delay_secs
+        self.rate_limit_delay_secs = rate_limit_delay_secs
+        self.breaker_failures = breaker_failures
+        self.breaker_secs = breaker_secs
+        self.failure_count = 0
+        self.breaker_until = None
+        # Shared by fetch workers
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_rate_limited(error):
+        return isinstance(error, FbException) and error.code in RATE_LIMIT_ERROR_CODES
+
+    def is_retryable(self, error):
+        """
+        Returns True if the error is (possibly) transient.
+        """
+        if isinstance(error, requests.exceptions.ConnectionError):
+            return True
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is not None and self.is_retryable_status(error.response.status_code)
+        if isinstance(error, FbException):
+            # Unexpected GraphMethodException: Unsupported get request and too much data requested (1) seem to
+            # be transient too.
+            return error.is_transient or (error.code == 100 and error.subcode == 33) or error.code == 1 or \
+                self.is_rate_limited(error)
+        return False
+
+    @staticmethod
+    def is_retryable_status(status_code):
+        return status_code in RETRY_STATUS_CODES
+
+    @staticmethod
+    def can_defer(error):
+        """
+        Returns True if retrying can be deferred. Errors that callers handle after the last try are retried
+        immediately.
+        """
+        return not (isinstance(error, FbException) and error.code in (1, 100))
+
+    def get_max_tries(self, error):
+        if isinstance(error, FbException) and error.code == 1:
+            return self.max_too_much_data_tries
+        return self.max_tries
+
+    def get_delay_secs(self, error, try_count):
+        """
+        Returns the number of seconds to wait before retrying after the try_count try failed.
+        """
+        delay_secs = min(self.max_delay_secs, self.base_delay_secs * 2 ** (try_count - 1))
+        delay_secs = delay_secs / 2 + random.uniform(0, delay_secs / 2)
+        if self.is_rate_limited(error):
+            delay_secs = max(delay_secs, self.rate_limit_delay_secs)
+        return delay_secs
+
+    def record_success(self):
+        with self._lock:
+            self.failure_count = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            if self.failure_count >= self.breaker_failures:
+                self.failure_count = 0
+                self.breaker_until = time.time() + self.breaker_secs
+
+    def get_breaker_secs(self):
+        """
+        Returns the number of seconds until the circuit breaker closes, or 0 if it is closed.
+        """
+        if self.breaker_until is None:
+            return 0
+        return max(0, self.breaker_until - time.time())
+
+
+class PersistentIndex(object):
+    """
+    A map of keys to values that is optionally persisted to a file.
+
+    Each line of the file is a JSON list of key and value. The file is only appended to, so
+    later lines take precedence over earlier lines.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self._index = {}
+        self._file = None
+        self._lock = threading.Lock()
+        if filepath:
+            if os.path.exists(filepath):
+                with open(filepath) as file:
+                    for line in file:
+                        try:
+                            key, value = json.loads(line)
+                        except ValueError:
+                            # Possibly a partially written last line
+                            log.warning('Ignoring bad line in %s: %s', filepath, line)
+                            continue
+                        self._index[key] = value
+                log.info('Loaded %s entries from %s', len(self._index), filepath)
+            self._file = open(filepath, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key, default=None):
+        return self._index.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._index and self._index[key] == value:
+                return
+            self._index[key] = value
+            if self._file:
+                self._file.write(json.dumps([key, value]) + '\n')
+                self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class OmitCache(object):
+    """
+    Learns which nodes need fields omitted (see omit_on_error) so that they are requested without the fields on the
+    first attempt rather than after an error, optionally persisted across runs.
+
+    The error code is recorded for each node that needed fields omitted. Requests and errors are also counted for
+    each definition. Once the rate of an error reaches max_error_rate (after at least min_requests requests), all
+    nodes of the definition are requested without the fields omitted for that error, except for every
+    sample_interval-th request. Sampled requests are counted, so the fields stop being omitted if the rate drops.
+    If omit_definitions is False, fields are only omitted for the nodes that needed them omitted.
+    """
+
+    def __init__(self, filepath=None, min_requests=OMIT_MIN_REQUESTS, max_error_rate=OMIT_ERROR_RATE,
+                 sample_interval=OMIT_SAMPLE_INTERVAL, omit_definitions=True):
+        self.omit_definitions = omit_definitions
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.sample_interval = sample_interval
+        # Map of node ids to error codes. Definition counts are stored with definition keys.
+        self._index = PersistentIndex(filepath)
+        # Map of definition names to {'requests': count, 'errors': map of error codes to counts}
+        self._definition_counts = {}
+        # Map of definition names to number of requests for which the definition error code was returned
+        self._sample_counts = collections.Counter()
+        # Counts are updated by fetch workers.
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, node_id):
+        return node_id in self._index
+
+    @staticmethod
+    def _definition_key(definition_name):
+        return 'definition:{}'.format(definition_name)
+
+    def _get_definition_counts(self, definition_name):
+        with self._lock:
+            if definition_name not in self._definition_counts:
+                self._definition_counts[definition_name] = self._index.get(self._definition_key(definition_name),
+                                                                           {'requests': 0, 'errors': {}})
+            return self._definition_counts[definition_name]
+
+    def get_error_code(self, node_id, definition_name):
+        """
+        Returns the error code for which to omit fields for a request for a node, or None.
+        """
+        error_code = self._index.get(node_id)
+        if error_code is not None:
+            return error_code
+        return self.get_definition_error_code(definition_name, sample=True)
+
+    def get_definition_error_code(self, definition_name, sample=False):
+        """
+        Returns the error code for which to omit fields for all nodes of a definition, or None.
+
+        If sample, this is for a request and None is returned for every sample_interval-th request.
+        """
+        if not self.omit_definitions:
+            return None
+        with self._lock:
+            counts = self._get_definition_counts(definition_name)
+            if counts['requests'] < self.min_requests or not counts['errors']:
+                return None
+            error_code, error_count = max(counts['errors'].items(), key=operator.itemgetter(1))
+            if error_count / counts['requests'] < self.max_error_rate:
+                return None
+            if sample:
+                self._sample_counts[definition_name] += 1
+                if self._sample_counts[definition_name] % self.sample_interval == 0:
+                    log.debug('Sampling request for %s with fields for error %s', definition_name, error_code)
+                    return None
+            return int(error_code)
+
+    def count_request(self, definition_name, count=1):
+        """
+        Counts requests for nodes of a definition with no fields omitted.
+        """
+        with self._lock:
+            self._get_definition_counts(definition_name)['requests'] += count
+
+    def count_error(self, node_id, definition_name, error_code):
+        """
+        Records that a node needed fields omitted for an error.
+        """
+        with self._lock:
+            errors = self._get_definition_counts(definition_name)['errors']
+            # JSON keys are strings
+            errors[str(error_code)] = errors.get(str(error_code), 0) + 1
+        self._index.set(node_id, error_code)
+
+    def close(self):
+        for definition_name, counts in self._definition_counts.items():
+            self._index.set(self._definition_key(definition_name), counts)
+        self._index.close()
+
+
+class SizeTuner(object):
+    """
+    Adjusts the node batch size and edge size of definitions during a run, optionally persisted across runs.
+
+    Sizes start from the definition (or the tuned sizes of an earlier run) and are increased additively after
+    responses within the limits and halved after slow or large responses or please reduce the amount of data errors (1).
+    For a batch, the node batch size is reduced. For a single node, the edge sizes of the definitions of its edges are
+    reduced.
+    """
+
+    def __init__(self, filepath=None, max_latency_secs=TUNE_MAX_LATENCY_SECS,
+                 max_response_bytes=TUNE_MAX_RESPONSE_BYTES, max_factor=TUNE_MAX_FACTOR):
+        self.max_latency_secs = max_latency_secs
+        self.max_response_bytes = max_response_bytes
+        self.max_factor = max_factor
+        # Map of (size name, definition name) keys to tuned sizes
+        self._index = PersistentIndex(filepath)
+        self._sizes = {}
+        # Sizes are tuned from the responses of fetch workers.
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _key(size_name, definition_name):
+        return '{}:{}'.format(size_name, definition_name)
+
+    def _get_size(self, size_name, definition_name, size):
+        key = self._key(size_name, definition_name)
+        with self._lock:
+            if key not in self._sizes:
+                self._sizes[key] = self._index.get(key, size)
+            return self._sizes[key]
+
+    def _set_size(self, size_name, definition_name, size, new_size, max_size):
+        new_size = max(1, min(new_size, max_size, size * self.max_factor))
+        with self._lock:
+            if new_size != self._get_size(size_name, definition_name, size):
+                log.debug('Tuning %s of %s to %s', size_name, definition_name, new_size)
+                self._sizes[self._key(size_name, definition_name)] = new_size
+
+    def get_node_batch_size(self, definition_name, definition):
+        return self._get_size('node_batch_size', definition_name, definition.node_batch_size)
+
+    def get_edge_size(self, definition_name, definition):
+        return self._get_size('edge_size', definition_name, definition.edge_size)
+
+    def record_response(self, definition_name, definition, edge_definitions, node_count, latency_secs,
+                        response_bytes):
+        """
+        Adjusts sizes for a response for nodes of a definition.
+
+        edge_definitions is a map of definition names to definitions of the edges of the definition.
+        """
+        with self._lock:
+            if latency_secs > self.max_latency_secs or response_bytes > self.max_response_bytes:
+                self.reduce(definition_name, definition, edge_definitions, node_count)
+                return
+            node_batch_size = self.get_node_batch_size(definition_name, definition)
+            # Only increasing the node batch size when the batch was full.
+            if node_count >= node_batch_size:
+                self._set_size('node_batch_size', definition_name, definition.node_batch_size,
+                               node_batch_size + max(1, definition.node_batch_size // 4), MAX_NODE_BATCH_SIZE)
+            for edge_definition_name, edge_definition in edge_definitions.items():
+                self._set_size('edge_size', edge_definition_name, edge_definition.edge_size,
+                               self.get_edge_size(edge_definition_name, edge_definition) +
+                               max(1, edge_definition.edge_size // 4), edge_definition.edge_size * self.max_factor)
+
+    def reduce(self, definition_name, definition, edge_definitions, node_count):
+        """
+        Reduces sizes after a slow or large response or please reduce the amount of data error for nodes of a
+        definition.
+        """
+        with self._lock:
+            if node_count > 1:
+                self._set_size('node_batch_size', definition_name, definition.node_batch_size, node_count // 2,
+                               MAX_NODE_BATCH_SIZE)
+                return
+            for edge_definition_name, edge_definition in edge_definitions.items():
+                self._set_size('edge_size', edge_definition_name, edge_definition.edge_size,
+                               self.get_edge_size(edge_definition_name, edge_definition) // 2,
+                               edge_definition.edge_size * self.max_factor)
+
+    def close(self):
+        for key, size in self._sizes.items():
+            self._index.set(key, size)
+        self._index.close()
+
+
+class Definition:
+    def __init__(self, definition_obj):
+        self.definition_map = definition_obj['fields']
+        self.node_batch_size = definition_obj.get('node_batch_size', DEFAULT_NODE_BATCH_SIZE)
+        self.edge_size = definition_obj.get('edge_size', DEFAULT_EDGE_SIZE)
+        self.csv_fields = definition_obj.get('csv_fields')
+        # Map of CSV field names to types (see CSV_TYPES) for columnar output
+        self.csv_types = definition_obj.get('csv_types', {})
+        # Edges to retrieve (and whether to retrieve their additional pages) for nodes at the last level
+        self.leaf_profile = definition_obj.get('leaf')
+        # If True, nodes found in edges are not retrieved by themselves.
+        self.embedded_is_enough = definition_obj.get('embedded_is_enough', False)
+        # If True, all fields and edges are requested for nodes in the edges of a retrieved node, so that they are
+        # not retrieved by themselves.
+        self.embed_all_fields = definition_obj.get('embed_all_fields', False)
+        self.omit_on_error_fields_by_error_code = dict()
+        default_fields_set = set()
+        fields_set = set()
+        default_edges_set = set()
+        edges_set = set()
+        for name, field_definition in self.definition_map.items():
+            if not field_definition.get('omit'):
+                if 'edge_type' in field_definition:
+                    if field_definition.get('default'):
+                        default_edges_set.add(name)
+                    else:
+                        edges_set.add(name)
+                else:
+                    if field_definition.get('default'):
+                        default_fields_set.add(name)
                     else:
                         fields_set.add(name)
                 omit_on_error_code = field_definition.get('omit_on_error')
@@ -1039,31 +4127,683 @@ class FbException(Exception):
         self.is_transient = error_json['error'].get('is_transient', False)
 
 
+class RetryLater(Exception):
+    """
+    Raised when retrying a failed request is deferred. error is the error of the failed request.
+    """
+
+    def __init__(self, error):
+        super(RetryLater, self).__init__(str(error))
+        self.error = error
+
+
 class JsonGraphOutput:
-    def __init__(self, pretty=False, filepath=None, mode='w'):
+    """
+    Writes graphs as JSON to a file or stdout.
+
+    If the filepath ends with a compression extension (e.g., .jsonl.gz), the file is written
+    as independently decompressible frames so that nodes can be read by offset.
+
+    Writes are buffered. The file is flushed every flush_secs and synced to disk every fsync_secs,
+    if provided.
+    """
+
+    def __init__(self, pretty=False, filepath=None, mode='w', encoder='json', flush_secs=None, fsync_secs=None,
+                 frame_size=FRAME_SIZE):
         self.pretty = pretty
         self.filepath = filepath
-        self.file = open(filepath, mode=mode) if filepath else sys.stdout
+        self.encoder = encoder
+        self.flush_secs = flush_secs
+        self.fsync_secs = fsync_secs
+        if not filepath:
+            self.file = sys.stdout
+        elif get_compression(filepath):
+            self.file = FramedWriter(filepath, mode=mode, compression=get_compression(filepath),
+                                     frame_size=frame_size)
+        else:
+            self.file = open(filepath, mode=mode, buffering=WRITE_BUFFER_SIZE, encoding='utf-8')
+        self.last_flush = self.last_fsync = time.time()
+        # Characters of JSON written
+        self.written_size = 0
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
+        self.close()
+
+    def close(self):
         if self.filepath:
             self.file.close()
 
     def output_graph(self, graph):
-        print_graph(graph, pretty=self.pretty, file=self.file)
+        line = json_dumps(graph, pretty=self.pretty, encoder=self.encoder)
+        print(line, file=self.file)
+        self.written_size += len(line) + 1
+        if self.flush_secs is not None or self.fsync_secs is not None:
+            now = time.time()
+            if self.flush_secs is not None and now - self.last_flush >= self.flush_secs:
+                self.file.flush()
+                self.last_flush = now
+            if self.filepath and self.fsync_secs is not None and now - self.last_fsync >= self.fsync_secs:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.last_flush = self.last_fsync = now
+
+
+class SegmentedJsonGraphOutput:
+    """
+    Writes graphs as JSON to a series of segment files, starting a new segment once the current
+    segment reaches a maximum size (in characters of JSON before compression) or number of nodes.
+
+    A manifest lists the segments with the number of nodes, the number of nodes of each type and
+    the first and last node ids in each. The manifest is rewritten when a segment is started and
+    when the output is closed. ArchiveReader reads the segments of a manifest as a single archive.
+
+    When appending, graphs are appended to the last segment. Its counts are recalculated, since it
+    may have been written to after the manifest.
+    """
+
+    def __init__(self, manifest_filepath, mode='w', max_segment_size=None, max_segment_nodes=None,
+                 compression=None, **json_output_options):
+        self.manifest_filepath = manifest_filepath
+        self.max_segment_size = max_segment_size
+        self.max_segment_nodes = max_segment_nodes
+        self.compression = compression
+        self.json_output_options = json_output_options
+        self.segments = []
+        self._output = None
+        if mode == 'a' and os.path.exists(manifest_filepath):
+            manifest = read_manifest(manifest_filepath)
+            self.segments = manifest['segments']
+            self.compression = manifest.get('compression')
+            if self.max_segment_size is None:
+                self.max_segment_size = manifest.get('max_segment_size')
+            if self.max_segment_nodes is None:
+                self.max_segment_nodes = manifest.get('max_segment_nodes')
+        if self.segments:
+            self._reopen_segment()
+        else:
+            self._start_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_segment_filepath(self, segment):
+        return os.path.join(os.path.dirname(self.manifest_filepath), segment['filename'])
+
+    @staticmethod
+    def _count_graph(segment, graph):
+        if is_edge_chunk(graph):
+            return
+        segment['nodes'] += 1
+        node_type = graph.get('metadata', {}).get('type')
+        if node_type:
+            segment['types'][node_type] = segment['types'].get(node_type, 0) + 1
+        if segment['first_id'] is None:
+            segment['first_id'] = graph['id']
+        segment['last_id'] = graph['id']
+
+    def _start_segment(self):
+        if self._output is not None:
+            self._output.close()
+        segment = {
+            'filename': get_segment_filename(self.manifest_filepath, len(self.segments) + 1, self.compression),
+            'nodes': 0,
+            'types': {},
+            'first_id': None,
+            'last_id': None
+        }
+        self._output = JsonGraphOutput(filepath=self._get_segment_filepath(segment), **self.json_output_options)
+        self.segments.append(segment)
+        self.write_manifest()
+
+    def _reopen_segment(self):
+        segment = self.segments[-1]
+        segment.update({'nodes': 0, 'types': {}, 'first_id': None, 'last_id': None})
+        segment_filepath = self._get_segment_filepath(segment)
+        written_size = 0
+        if os.path.exists(segment_filepath):
+            for line in ArchiveReader(segment_filepath).iter_lines():
+                self._count_graph(segment, json_loads(line))
+                written_size += len(line)
+        self._output = JsonGraphOutput(filepath=segment_filepath, mode='a', **self.json_output_options)
+        self._output.written_size = written_size
+
+    def _is_segment_full(self):
+        segment = self.segments[-1]
+        if not segment['nodes']:
+            return False
+        if self.max_segment_nodes and segment['nodes'] >= self.max_segment_nodes:
+            return True
+        return bool(self.max_segment_size and self._output.written_size >= self.max_segment_size)
+
+    def output_graph(self, graph):
+        if self._is_segment_full():
+            self._start_segment()
+        self._output.output_graph(graph)
+        self._count_graph(self.segments[-1], graph)
+
+    def write_manifest(self):
+        manifest = {
+            'compression': self.compression,
+            'max_segment_size': self.max_segment_size,
+            'max_segment_nodes': self.max_segment_nodes,
+            'segments': self.segments
+        }
+        # Replacing so that the manifest is never partially written.
+        tmp_filepath = '{}.tmp'.format(self.manifest_filepath)
+        with open(tmp_filepath, 'w') as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(tmp_filepath, self.manifest_filepath)
+
+    def close(self):
+        self._output.close()
+        self.write_manifest()
+
+
+class NormalizedGraphOutput:
+    """
+    Normalizes graphs before outputting them to a JSON graph output, so that each node is stored once.
+
+    The items of followed edges embedded in a graph are replaced by references (e.g., {"id": "123"}).
+    Embedded items are spooled to a temporary file. When the output is closed, those items that were
+    not output as nodes are output as fragments, i.e., with "fragment": true in their metadata. For
+    each node or fragment output, (parent node id, edge, node id) of its edges are written to a
+    tab-separated edges file.
+
+    The fragments are output even if retrieving fails, since the items have already been replaced by
+    references. When appending (e.g., for resume), the ids of the nodes and fragments already in the
+    archive are provided so that they are not output as fragments again.
+
+    NormalizedArchive reconstructs the embedded items.
+    """
+
+    def __init__(self, graph_output, fb, edges_filepath, mode='w', node_ids=None, fragment_ids=None):
+        self.graph_output = graph_output
+        self.fb = fb
+        self.edges_file = open(edges_filepath, mode, buffering=WRITE_BUFFER_SIZE, encoding='utf-8')
+        self.spool_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self.node_ids = set(node_ids or ())
+        self.fragment_ids = set(fragment_ids or ())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def output_graph(self, graph):
+        if not is_edge_chunk(graph):
+            self.node_ids.add(graph['id'])
+        normalized_graph = self.normalize(graph['metadata']['type'], graph)
+        self._write_edges(graph['metadata']['type'], normalized_graph)
+        self.graph_output.output_graph(normalized_graph)
+
+    def _iter_edge_items(self, definition_name, graph_fragment):
+        """
+        Returns an iterator of (edge, definition name, edge items) for the followed edges in a graph fragment.
+        """
+        definition = self.fb.get_definition(definition_name)
+        for edge in itertools.chain(definition.default_edges, definition.edges):
+            if edge in graph_fragment and definition.should_follow_edge(edge):
+                edge_fragment = graph_fragment[edge]
+                yield edge, definition.get_edge_type(edge), edge_fragment['data'] if 'data' in edge_fragment \
+                    else (edge_fragment,)
+
+    def _write_edges(self, definition_name, graph_fragment):
+        for edge, _, nodes in self._iter_edge_items(definition_name, graph_fragment):
+            for node in nodes:
+                self.edges_file.write('{}\t{}\t{}\n'.format(graph_fragment['id'], edge, node['id']))
+
+    def normalize(self, definition_name, graph_fragment):
+        """
+        Returns a copy of a graph fragment with the items of followed edges replaced by references.
+        """
+        normalized_fragment = None
+        for edge, edge_type, _ in self._iter_edge_items(definition_name, graph_fragment):
+            if normalized_fragment is None:
+                normalized_fragment = dict(graph_fragment)
+            edge_fragment = graph_fragment[edge]
+            if 'data' in edge_fragment:
+                normalized_fragment[edge] = dict(edge_fragment, data=[self._normalize_item(edge_type, node)
+                                                                      for node in edge_fragment['data']])
+            else:
+                normalized_fragment[edge] = self._normalize_item(edge_type, edge_fragment)
+        return normalized_fragment if normalized_fragment is not None else graph_fragment
+
+    def _normalize_item(self, definition_name, node):
+        if len(node) > 1 and node['id'] not in self.node_ids and node['id'] not in self.fragment_ids:
+            self.spool_file.write(json_dumps([definition_name, self.normalize(definition_name, node)]))
+            self.spool_file.write('\n')
+        return {'id': node['id']}
+
+    def close(self):
+        try:
+            self.spool_file.seek(0)
+            for line in self.spool_file:
+                definition_name, fragment = json_loads(line)
+                if fragment['id'] in self.node_ids or fragment['id'] in self.fragment_ids:
+                    continue
+                self.fragment_ids.add(fragment['id'])
+                fragment['metadata'] = {'type': definition_name, 'fragment': True}
+                self._write_edges(definition_name, fragment)
+                self.graph_output.output_graph(fragment)
+        finally:
+            self.spool_file.close()
+            self.edges_file.close()
+
+
+def get_edges_filepath(filepath):
+    """
+    Returns the filepath of the edges file for a (possibly compressed or segmented) archive.
+    """
+    if is_manifest_filepath(filepath):
+        return filepath[:-len(MANIFEST_EXTENSION)] + '.edges.tsv'
+    if get_compression(filepath):
+        filepath = os.path.splitext(filepath)[0]
+    return '{}.edges.tsv'.format(os.path.splitext(filepath)[0])
+
+
+class NormalizedArchive(object):
+    """
+    Reads nodes from a normalized archive with the items of edges embedded, as they were retrieved.
+
+    An embedded item is reconstructed from a node with the default fields and edges of its definition
+    or from a fragment.
+    """
+
+    def __init__(self, filepath, fb=None):
+        self.reader = ArchiveReader(filepath)
+        self.fb = fb or Fbarc()
+        # Map of node ids to (offset, is fragment)
+        self.offsets = {}
+        for offset, line in self.reader:
+            graph = json_loads(line)
+            if is_edge_chunk(graph):
+                continue
+            is_fragment = graph.get('metadata', {}).get('fragment', False)
+            if graph['id'] not in self.offsets or self.offsets[graph['id']][1]:
+                self.offsets[graph['id']] = (offset, is_fragment)
+
+    def __contains__(self, node_id):
+        return node_id in self.offsets
+
+    def _read_graph(self, node_id):
+        if node_id not in self.offsets:
+            return None
+        return json_loads(self.reader.read_line(self.offsets[node_id][0]))
+
+    def get_node(self, node_id):
+        """
+        Returns a node, or None if not in the archive.
+        """
+        graph = self._read_graph(node_id)
+        if graph is None:
+            return None
+        return self._embed(graph['metadata']['type'], graph)
+
+    def _embed(self, definition_name, graph_fragment):
+        definition = self.fb.get_definition(definition_name)
+        embedded_fragment = dict(graph_fragment)
+        for edge in itertools.chain(definition.default_edges, definition.edges):
+            if edge not in graph_fragment or not definition.should_follow_edge(edge):
+                continue
+            edge_type = definition.get_edge_type(edge)
+            edge_fragment = graph_fragment[edge]
+            if 'data' in edge_fragment:
+                embedded_fragment[edge] = dict(edge_fragment, data=[self._get_item(edge_type, node)
+                                                                    for node in edge_fragment['data']])
+            else:
+                embedded_fragment[edge] = self._get_item(edge_type, edge_fragment)
+        return embedded_fragment
+
+    def _get_item(self, definition_name, reference):
+        if len(reference) > 1:
+            # Not a reference
+            return reference
+        graph = self._read_graph(reference['id'])
+        if graph is None:
+            return reference
+        if graph['metadata'].get('fragment'):
+            del graph['metadata']
+        else:
+            definition = self.fb.get_definition(definition_name)
+            graph = dict((field, value) for field, value in graph.items() if field == 'id' or
+                         field in definition.default_fields or field in definition.default_edges)
+        return self._embed(definition_name, graph)
+
+
+class SeenGraphOutput:
+    """
+    Records graphs in the seen index of an Fbarc (with defer_seen), so that nodes are recorded once they have been
+    output by the graph outputs before it, including by a background thread.
+    """
+
+    def __init__(self, fb):
+        self.fb = fb
+
+    def output_graph(self, graph):
+        self.fb.record_seen(graph)
+
+
+class BackgroundGraphOutput:
+    """
+    Outputs graphs to graph outputs from a background thread, so that encoding and writing
+    overlap with retrieval.
+
+    Graphs are passed to the thread through a bounded queue. When the queue is full, output_graph
+    blocks until there is room. An error in the background thread is raised by the next call to
+    output_graph or close.
+    """
+    _STOP = object()
+
+    def __init__(self, graph_outputs, queue_size=1000):
+        self.graph_outputs = list(graph_outputs)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, name='graph-output', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.close(raise_error=exc_type is None)
+
+    def _write(self):
+        while True:
+            graph = self._queue.get()
+            if graph is self._STOP:
+                break
+            if self._error is None:
+                try:
+                    for graph_output in self.graph_outputs:
+                        graph_output.output_graph(graph)
+                except Exception as e:
+                    log.exception('Error outputting graph')
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def output_graph(self, graph):
+        self._raise_error()
+        self._queue.put(graph)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self, raise_error=True):
+        """
+        Waits for queued graphs to be output.
+        """
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+        if raise_error:
+            self._raise_error()
+
+
+def find_media_urls(graph_fragment):
+    """
+    Returns a list of the urls of media fields (see MEDIA_FIELDS) found in a graph fragment, including in
+    embedded nodes.
+
+    A media field is a url or, for picture{url}, a fragment with the url in its data.
+    """
+    urls = []
+    if isinstance(graph_fragment, dict):
+        for key, value in graph_fragment.items():
+            if key == 'metadata':
+                continue
+            if key in MEDIA_FIELDS:
+                if isinstance(value, dict):
+                    value = value.get('data', {}).get('url')
+                if isinstance(value, str) and value.startswith(('http://', 'https://')):
+                    urls.append(value)
+                    continue
+            urls.extend(find_media_urls(value))
+    elif isinstance(graph_fragment, list):
+        for value in graph_fragment:
+            urls.extend(find_media_urls(value))
+    return urls
+
+
+class MediaStore:
+    """
+    Downloads the media of graphs to a directory, storing each file once by content hash.
+
+    Files are stored as <first 2 characters of hash>/<SHA-256 hash><extension>, so identical media found in different
+    nodes (or at different urls) are stored once. Downloads are made by a pool of max_workers threads, with at most
+    max_host_workers concurrent downloads from each host. Further downloads from a host are queued until one of its
+    downloads completes, so that workers are available for other hosts. Partial downloads are kept and continued
+    with a range request. The urls that have been downloaded are recorded in an index in the directory, so they are
+    not downloaded again.
+
+    The local paths (relative to the directory) are recorded in the metadata of graphs as a map of urls to paths.
+    """
+
+    def __init__(self, media_dir, max_workers=MEDIA_WORKERS, max_host_workers=MEDIA_HOST_WORKERS,
+                 window_size=MEDIA_WINDOW_SIZE):
+        self.media_dir = media_dir
+        self.max_host_workers = max_host_workers
+        self.window_size = window_size
+        self._partial_dir = os.path.join(media_dir, '.partial')
+        os.makedirs(self._partial_dir, exist_ok=True)
+        # Map of urls to paths
+        self._index = PersistentIndex(os.path.join(media_dir, 'media.idx'))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='media')
+        self._lock = threading.Lock()
+        # Map of urls to futures for downloads, so that a url is only downloaded once
+        self._futures = {}
+        # Map of hosts to number of downloads submitted to the pool
+        self._host_counts = collections.Counter()
+        # Map of hosts to queues of (url, future) waiting for a download from the host to complete
+        self._host_queues = collections.defaultdict(collections.deque)
+        self.download_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def iter_graphs(self, graph_iter):
+        """
+        Iterator of graphs annotated with the local paths of their media, in order.
+
+        Graphs wait for their media to be downloaded, with up to window_size graphs waiting.
+        """
+        pending = collections.deque()
+        for graph in graph_iter:
+            pending.append((graph, [(url, self.submit(url)) for url in find_media_urls(graph)]))
+            while pending and (len(pending) > self.window_size or all(future.done() for _, future in pending[0][1])):
+                yield self._annotate(*pending.popleft())
+        while pending:
+            yield self._annotate(*pending.popleft())
+
+    @staticmethod
+    def _annotate(graph, url_futures):
+        media = collections.OrderedDict()
+        for url, future in url_futures:
+            path = future.result()
+            if path is not None:
+                media[url] = path
+        if media:
+            graph.setdefault('metadata', {})['media'] = media
+        return graph
+
+    def submit(self, url):
+        """
+        Returns a future for the path of the media at a url, downloading it if not already downloaded.
+        """
+        with self._lock:
+            if url not in self._futures:
+                future = concurrent.futures.Future()
+                host = urlparse(url).netloc
+                if url in self._index:
+                    future.set_result(self._index.get(url))
+                elif self._host_counts[host] < self.max_host_workers:
+                    self._submit_download(url, future, host)
+                else:
+                    self._host_queues[host].append((url, future))
+                self._futures[url] = future
+            return self._futures[url]
+
+    def _submit_download(self, url, future, host):
+        # Called with the lock held
+        self._host_counts[host] += 1
+        self._executor.submit(self._run_download, url, future, host)
+
+    def _run_download(self, url, future, host):
+        """
+        Downloads the media at a url for a future, then submits the next download queued for the host, if any.
+        """
+        try:
+            future.set_result(self._download(url))
+        except Exception as e:
+            future.set_exception(e)
+        with self._lock:
+            self._host_counts[host] -= 1
+            if self._host_queues[host]:
+                self._submit_download(*self._host_queues[host].popleft(), host)
+
+    def _download(self, url):
+        """
+        Downloads the media at a url, returning the path or None if it could not be downloaded.
+        """
+        parsed_url = urlparse(url)
+        extension = os.path.splitext(parsed_url.path)[1].lower()
+        if not extension[1:].isalnum() or len(extension) > 6:
+            extension = ''
+        partial_filepath = os.path.join(self._partial_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        try:
+            content_hash = self._download_partial(url, partial_filepath)
+        except (requests.exceptions.RequestException, OSError) as e:
+            log.warning('Unable to download %s: %s', url, e)
+            return None
+        path = os.path.join(content_hash[:2], content_hash + extension)
+        filepath = os.path.join(self.media_dir, path)
+        if os.path.exists(filepath):
+            log.debug('%s is a duplicate of %s', url, path)
+            os.remove(partial_filepath)
+        else:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.replace(partial_filepath, filepath)
+        with self._lock:
+            self._index.set(url, path)
+            self.download_count += 1
+        return path
+
+    @classmethod
+    def _download_partial(cls, url, partial_filepath):
+        """
+        Downloads (or continues downloading) a url to a partial file, returning the SHA-256 hash of the content.
+
+        A partial file that doesn't match the media (e.g., the media was replaced by a shorter one) is started over.
+        """
+        content_hash = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial_filepath):
+            with open(partial_filepath, 'rb') as file:
+                for chunk in iter(lambda: file.read(MEDIA_CHUNK_SIZE), b''):
+                    content_hash.update(chunk)
+                    offset += len(chunk)
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with requests.get(url, headers=headers, stream=True, timeout=MEDIA_TIMEOUT_SECS) as response:
+            if offset and response.status_code in (requests.codes.range_not_satisfiable,
+                                                   requests.codes.partial_content):
+                # bytes <first>-<last>/<length> for a partial response or bytes */<length> if not satisfiable
+                content_range = response.headers.get('Content-Range', '')
+                if response.status_code == requests.codes.partial_content:
+                    is_match = content_range.startswith('bytes {}-'.format(offset))
+                else:
+                    is_match = content_range == 'bytes */{}'.format(offset)
+                if not is_match:
+                    log.warning('Restarting download of %s, since %s bytes were downloaded but the range is %s',
+                                url, offset, content_range or None)
+                    os.remove(partial_filepath)
+                    return cls._download_partial(url, partial_filepath)
+                if response.status_code == requests.codes.range_not_satisfiable:
+                    # Already complete
+                    return content_hash.hexdigest()
+            response.raise_for_status()
+            mode = 'ab'
+            if offset and response.status_code != requests.codes.partial_content:
+                # Range not supported, so starting over.
+                content_hash = hashlib.sha256()
+                mode = 'wb'
+            with open(partial_filepath, mode) as file:
+                for chunk in response.iter_content(MEDIA_CHUNK_SIZE):
+                    content_hash.update(chunk)
+                    file.write(chunk)
+        return content_hash.hexdigest()
+
+    def close(self):
+        # Queued downloads are submitted as others complete, so waiting for them before shutting down the pool.
+        with self._lock:
+            futures = list(self._futures.values())
+        concurrent.futures.wait(futures)
+        self._executor.shutdown(wait=True)
+        self._index.close()
+
+
+def get_csv_fields(definition):
+    """
+    Returns the CSV fields for a definition, starting with the id and type.
+    """
+    fields = ['id', ['metadata', 'type']]
+    fields.extend(definition.csv_fields or ())
+    return fields
+
+
+def compile_csv_fields(fields):
+    """
+    Returns (field names, getters) for a list of CSV fields.
+
+    A field is a field name, a list of field names forming a path (e.g., ['object', 'id']) or a dict
+    of column name to either. Each getter returns the value of a field from a graph. Compiling the
+    fields once avoids interpreting them for every row.
+    """
+    fieldnames = []
+    getters = []
+    for field in fields:
+        fieldname = None
+        if isinstance(field, dict):
+            fieldname, field = list(field.items())[0]
+        if isinstance(field, list):
+            fieldnames.append(fieldname or '_'.join(field))
+            getters.append(_path_getter(tuple(field)))
+        else:
+            fieldnames.append(fieldname or field)
+            getters.append(operator.methodcaller('get', field))
+    return tuple(fieldnames), tuple(getters)
+
+
+def _path_getter(path):
+    def get_path(graph):
+        for subfield in path:
+            if not graph:
+                return graph
+            graph = graph.get(subfield)
+        return graph
+    return get_path
 
 
 class CsvGraphOutput:
     def __init__(self, dirpath, fb, mode='w'):
         self.dirpath = dirpath
         self.mode = mode
+        # Map of definition names to (csv writer, getters)
         self.writer_dict = {}
         self.files = []
         self.fb = fb
-        self.fields_dict = {}
 
     def __enter__(self):
         return self
@@ -1073,60 +4813,283 @@ class CsvGraphOutput:
             file.close()
 
     def output_graph(self, graph):
+        if is_edge_chunk(graph):
+            return
         definition_name = graph['metadata']['type']
         if definition_name not in self.writer_dict:
+            fieldnames, getters = compile_csv_fields(self._get_fields(definition_name))
             file = open(os.path.join(self.dirpath, '{}.csv'.format(definition_name)), mode=self.mode)
             self.files.append(file)
-            self.writer_dict[definition_name] = csv.DictWriter(file, extrasaction='ignore',
-                                                               fieldnames=self._get_fieldnames(definition_name))
+            writer = csv.writer(file)
             if self.mode != 'a':
-                self.writer_dict[definition_name].writeheader()
-        self.writer_dict[definition_name].writerow(self._get_row(graph, definition_name))
-
-    @staticmethod
-    def _flatten_field_name(field):
-        return '_'.join(field)
-
-    def _get_row(self, graph, definition_name):
-        row = {}
-        for field in self._get_fields(definition_name):
-            field_name = None
-            if isinstance(field, dict):
-                field_name, field = list(field.items())[0]
-            if isinstance(field, list):
-                graph_part = graph
-                for subfield in field:
-                    if graph_part:
-                        graph_part = graph_part.get(subfield)
-                row[field_name or self._flatten_field_name(field)] = self._clean_value(graph_part)
-            else:
-                row[field_name or field] = self._clean_value(graph.get(field))
-        return row
+                writer.writerow(fieldnames)
+            self.writer_dict[definition_name] = (writer, getters)
+        writer, getters = self.writer_dict[definition_name]
+        row = [getter(graph) for getter in getters]
+        writer.writerow([value.replace('\n', ' ') if isinstance(value, str) else value for value in row])
 
     def _get_fields(self, definition_name):
-        if definition_name not in self.fields_dict:
-            fields = ['id', ['metadata', 'type']]
-            fields.extend(self.fb.get_definition(definition_name).csv_fields)
-            self.fields_dict[definition_name] = fields
-        return self.fields_dict[definition_name]
-
-    def _get_fieldnames(self, definition_name):
-        fieldnames = []
-        for field in self._get_fields(definition_name):
-            if isinstance(field, dict):
-                fieldnames.append(list(field.keys())[0])
-            elif isinstance(field, list):
-                fieldnames.append(self._flatten_field_name(field))
+        return get_csv_fields(self.fb.get_definition(definition_name))
+
+
+class ParquetGraphOutput:
+    """
+    Writes the CSV fields of graphs to a Parquet file for each node type.
+
+    Rows are buffered by node type and written as a row group once row_group_size rows are buffered.
+    To bound memory, when max_buffered_rows are buffered across all types, the largest buffer is
+    written as a (smaller) row group.
+
+    Column types are declared with csv_types in the definition. Otherwise, they are inferred from the
+    first row group: strings, integers, floats and booleans are kept, and other values (e.g., dicts)
+    are written as JSON. Values that do not match the type of their column are written as null.
+
+    If a part name is provided, files are written to <dirpath>/<node type>/<part name>.parquet,
+    i.e., as part of a dataset for each node type. Otherwise, files are written to
+    <dirpath>/<node type>.parquet.
+    """
+
+    def __init__(self, dirpath, fb, row_group_size=PARQUET_ROW_GROUP_SIZE,
+                 max_buffered_rows=PARQUET_MAX_BUFFERED_ROWS, part_name=None):
+        if pyarrow is None:
+            raise ValueError('pyarrow is not installed')
+        self.dirpath = dirpath
+        self.fb = fb
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self.part_name = part_name
+        # Map of definition names to (getters, buffered columns)
+        self.columns_dict = {}
+        # Map of definition names to (schema, converters, parquet writer)
+        self.writer_dict = {}
+        self.buffered_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def output_graph(self, graph):
+        if is_edge_chunk(graph):
+            return
+        definition_name = graph['metadata']['type']
+        if definition_name not in self.columns_dict:
+            fieldnames, getters = compile_csv_fields(get_csv_fields(self.fb.get_definition(definition_name)))
+            self.columns_dict[definition_name] = (getters, collections.OrderedDict(
+                (fieldname, []) for fieldname in fieldnames))
+        getters, columns = self.columns_dict[definition_name]
+        for getter, values in zip(getters, columns.values()):
+            values.append(getter(graph))
+        self.buffered_rows += 1
+        if len(columns['id']) >= self.row_group_size:
+            self._write_row_group(definition_name)
+        elif self.buffered_rows >= self.max_buffered_rows:
+            self._write_row_group(max(self.columns_dict, key=lambda name: len(self.columns_dict[name][1]['id'])))
+
+    def _get_filepath(self, definition_name):
+        if self.part_name:
+            dataset_dirpath = os.path.join(self.dirpath, definition_name)
+            os.makedirs(dataset_dirpath, exist_ok=True)
+            return os.path.join(dataset_dirpath, '{}.parquet'.format(self.part_name))
+        return os.path.join(self.dirpath, '{}.parquet'.format(definition_name))
+
+    def _create_writer(self, definition_name, columns):
+        csv_types = self.fb.get_definition(definition_name).csv_types
+        fields = []
+        converters = []
+        for fieldname, values in columns.items():
+            if fieldname in ('id', 'metadata_type'):
+                column_type = 'string'
             else:
-                fieldnames.append(field)
-        return fieldnames
+                column_type = csv_types.get(fieldname) or self._infer_type(values)
+            arrow_type, converter = self._get_column_type(column_type)
+            fields.append(pyarrow.field(fieldname, arrow_type))
+            converters.append(converter)
+        schema = pyarrow.schema(fields)
+        return schema, converters, pyarrow.parquet.ParquetWriter(self._get_filepath(definition_name), schema)
+
+    @staticmethod
+    def _infer_type(values):
+        try:
+            arrow_type = pyarrow.array(values).type
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            return 'json'
+        if pyarrow.types.is_integer(arrow_type):
+            return 'int'
+        if pyarrow.types.is_floating(arrow_type):
+            return 'float'
+        if pyarrow.types.is_boolean(arrow_type):
+            return 'bool'
+        if pyarrow.types.is_string(arrow_type) or pyarrow.types.is_null(arrow_type):
+            return 'string'
+        return 'json'
+
+    @staticmethod
+    def _get_column_type(column_type):
+        """
+        Returns (arrow type, converter function or None) for a CSV type.
+        """
+        if column_type == 'int':
+            return pyarrow.int64(), None
+        if column_type == 'float':
+            return pyarrow.float64(), None
+        if column_type == 'bool':
+            return pyarrow.bool_(), None
+        if column_type == 'timestamp':
+            return pyarrow.timestamp('ms', tz='UTC'), lambda value: iso8601.parse_date(value) if isinstance(
+                value, str) else value
+        if column_type == 'json':
+            return pyarrow.string(), lambda value: json_dumps(value) if value is not None and not isinstance(
+                value, str) else value
+        if column_type != 'string':
+            raise ValueError('Unknown CSV type: {}'.format(column_type))
+        return pyarrow.string(), lambda value: str(value) if value is not None and not isinstance(
+            value, str) else value
+
+    @staticmethod
+    def _create_array(values, arrow_type, converter):
+        if converter is not None:
+            values = [converter(value) for value in values]
+        try:
+            return pyarrow.array(values, type=arrow_type)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, ValueError):
+            pass
+        arrow_values = []
+        for value in values:
+            try:
+                pyarrow.scalar(value, type=arrow_type)
+                arrow_values.append(value)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, ValueError):
+                log.warning('Writing %s as null since not %s', value, arrow_type)
+                arrow_values.append(None)
+        return pyarrow.array(arrow_values, type=arrow_type)
+
+    def _write_row_group(self, definition_name):
+        _, columns = self.columns_dict[definition_name]
+        row_count = len(columns['id'])
+        if not row_count:
+            return
+        if definition_name not in self.writer_dict:
+            self.writer_dict[definition_name] = self._create_writer(definition_name, columns)
+        schema, converters, writer = self.writer_dict[definition_name]
+        arrays = [self._create_array(values, field.type, converter)
+                  for values, field, converter in zip(columns.values(), schema, converters)]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema), row_group_size=row_count)
+        for values in columns.values():
+            values.clear()
+        self.buffered_rows -= row_count
+
+    def close(self):
+        for definition_name in self.columns_dict:
+            self._write_row_group(definition_name)
+        for _, _, writer in self.writer_dict.values():
+            writer.close()
+
+
+class SqliteGraphOutput:
+    """
+    Writes graphs to a SQLite database.
+
+    Each node type has a table with the id, the JSON of the graph and a column for each of the CSV
+    fields of the definition. The edges table has the (parent node id, edge, node id) of the connected
+    nodes found in each graph.
+
+    Rows are buffered and inserted with executemany in a transaction every batch_size rows.
+    """
+
+    def __init__(self, filepath, fb, batch_size=SQLITE_BATCH_SIZE, encoder='json'):
+        self.fb = fb
+        self.batch_size = batch_size
+        self.encoder = encoder
+        # The connection is used by the background output thread, if any, but never concurrently.
+        self.connection = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS edges (parent_id TEXT NOT NULL, edge TEXT NOT NULL, '
+                                'child_id TEXT NOT NULL, PRIMARY KEY (parent_id, edge, child_id))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS edges_child_id ON edges (child_id)')
+        # Map of definition names to (insert statement, getters, buffered rows)
+        self.table_dict = {}
+        self.edge_rows = []
+        self.buffered_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     @staticmethod
-    def _clean_value(value):
-        if isinstance(value, str):
-            return value.replace('\n', ' ')
+    def _quote(name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def _create_table(self, definition_name):
+        definition = self.fb.get_definition(definition_name)
+        fieldnames, getters = compile_csv_fields(get_csv_fields(definition))
+        # Skipping id and type
+        fieldnames, getters = fieldnames[2:], getters[2:]
+        table = self._quote(definition_name)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY KEY, json TEXT NOT NULL)'.format(
+            table))
+        # Adding columns for CSV fields that were added to the definition since the table was created.
+        column_names = set(row[1] for row in self.connection.execute('PRAGMA table_info({})'.format(table)))
+        for fieldname in fieldnames:
+            if fieldname not in column_names:
+                self.connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, self._quote(fieldname), SQLITE_COLUMN_TYPES.get(definition.csv_types.get(fieldname), '')))
+        insert = 'INSERT OR REPLACE INTO {} (id, json{}) VALUES (?, ?{})'.format(
+            table, ''.join(', ' + self._quote(fieldname) for fieldname in fieldnames), ', ?' * len(fieldnames))
+        return insert, getters, []
+
+    def _clean_value(self, value):
+        if isinstance(value, (dict, list)):
+            return json_dumps(value, encoder=self.encoder)
         return value
 
+    def output_graph(self, graph):
+        definition_name = graph['metadata']['type']
+        if definition_name not in self.table_dict:
+            self.table_dict[definition_name] = self._create_table(definition_name)
+        _, getters, rows = self.table_dict[definition_name]
+        # Only the edges of edge chunks are inserted.
+        if not is_edge_chunk(graph):
+            row = [graph['id'], json_dumps(graph, encoder=self.encoder)]
+            row.extend(self._clean_value(getter(graph)) for getter in getters)
+            rows.append(row)
+            self.buffered_rows += 1
+        edges = self.fb.find_edges(definition_name, graph, default_only=False)
+        self.edge_rows.extend(edges)
+        self.buffered_rows += len(edges)
+        if self.buffered_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered_rows:
+            return
+        self.connection.execute('BEGIN')
+        try:
+            for insert, _, rows in self.table_dict.values():
+                if rows:
+                    self.connection.executemany(insert, rows)
+            self.connection.executemany('INSERT OR IGNORE INTO edges (parent_id, edge, child_id) VALUES (?, ?, ?)',
+                                        self.edge_rows)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        # Only cleared once committed, so that rows that were rolled back are written by the next flush.
+        for _, _, rows in self.table_dict.values():
+            rows.clear()
+        self.edge_rows.clear()
+        self.buffered_rows = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.connection.close()
+
 
 if __name__ == '__main__':
     main()
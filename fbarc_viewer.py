@@ -12,6 +12,9 @@ from sqlalchemy.orm import sessionmaker
 from itertools import islice
 from contextlib import contextmanager
 
+from fbarc import ArchiveReader, get_compression, is_archive_filepath, is_edge_chunk, is_manifest_filepath, \
+    MANIFEST_EXTENSION
+
 Base = declarative_base()
 
 app = Flask(__name__)
@@ -222,9 +225,7 @@ def get_node(root_node, node_id):
             if node:
                 pos = node.offset
     if pos is not None:
-        with open(filepaths[root_node]) as file:
-            file.seek(pos)
-            return json.loads(file.readline())
+        return json.loads(ArchiveReader(filepaths[root_node]).read_line(pos))
     return None
 
 
@@ -242,29 +243,32 @@ def get_db_filepath(json_filepath):
 
 
 def get_root_node(filepath):
-    return os.path.splitext(os.path.basename(filepath))[0]
+    filename = os.path.basename(filepath)
+    if is_manifest_filepath(filename):
+        return filename[:-len(MANIFEST_EXTENSION)]
+    if get_compression(filename):
+        filename = os.path.splitext(filename)[0]
+    return os.path.splitext(filename)[0]
 
 
 def load_json(filepath):
     stats_counter = Counter()
     nodes = {}
     first_node = None
-    with open(filepath) as file:
-        pos = 0
-        line = file.readline()
-        while line:
-            node = json.loads(line.rstrip('\n'))
-            if 'id' in node:
-                nodes[node['id']] = pos
-                if 'metadata' in node:
-                    stats_counter[node['metadata']['type']] += 1
-                if first_node is None:
-                    first_node = node['id']
-            else:
-                print('Error line: {}'.format(line))
-                sys.exit(1)
-            pos = file.tell()
-            line = file.readline()
+    for pos, line in ArchiveReader(filepath):
+        node = json.loads(line.rstrip('\n'))
+        if is_edge_chunk(node):
+            # Edge chunks are not shown.
+            continue
+        if 'id' in node:
+            nodes[node['id']] = pos
+            if 'metadata' in node:
+                stats_counter[node['metadata']['type']] += 1
+            if first_node is None:
+                first_node = node['id']
+        else:
+            print('Error line: {}'.format(line))
+            sys.exit(1)
     return first_node, nodes, stats_counter
 
 
@@ -327,7 +331,7 @@ def init(files, index=False):
         else:
             for dirpath, _, filenames in os.walk(file_or_dirpath):
                 for filename in filenames:
-                    if filename.lower().endswith('.json') or filename.lower().endswith('.jsonl'):
+                    if is_archive_filepath(filename):
                         load_filepaths.append(os.path.join(dirpath, filename))
 
     for filepath in load_filepaths:
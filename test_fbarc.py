@@ -1,13 +1,35 @@
 import unittest
-from collections import namedtuple
+import os
+import tempfile
+import shutil
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import namedtuple, OrderedDict, Counter, deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+import requests
+import urllib3
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 try:
     from unittest.mock import patch, MagicMock  # Python 3
 except ImportError:
     from mock import patch, MagicMock  # Python 2
 
-from fbarc import Fbarc, Definition
-from collections import OrderedDict
+from fbarc import Fbarc, Definition, PersistentIndex, NodeScheduler, BfsScheduler, DfsScheduler, PriorityScheduler, \
+    RecencyScheduler, CrawlBudget, parse_limits, discover_definition_names, iter_json_array, JsonGraphOutput, \
+    print_graphs, ArchiveReader, get_frame_index_filepath, SegmentedJsonGraphOutput, read_manifest, \
+    compile_csv_fields, CsvGraphOutput, export_command, get_archive_chunks, ParquetGraphOutput, \
+    SqliteGraphOutput, SeenGraphOutput, NormalizedGraphOutput, NormalizedArchive, get_edges_filepath, \
+    get_time_windows, get_window_link, RetryPolicy, RetryLater, FbException, OmitCache, \
+    SizeTuner, MediaStore, find_media_urls, AsyncFbarc, OMIT_MIN_REQUESTS, OMIT_SAMPLE_INTERVAL
 
 Importer = namedtuple('Importer', ['definition'])
 
@@ -192,3 +214,1492 @@ class TestFbarc(unittest.TestCase):
             'likes': {'edge_type': 'page', 'follow_edge': False},
         })
         self.assertFalse(self.fbarc.find_connected_nodes('page', graph, default_only=False))
+
+
+class TestSeenIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index_filepath = os.path.join(self.temp_dir, 'seen.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_persistent_index(self):
+        with PersistentIndex(self.index_filepath) as index:
+            index.set('1', 'root1')
+            index.set('2', 'root1')
+            index.set('2', 'root2')
+        with PersistentIndex(self.index_filepath) as index:
+            self.assertEqual(2, len(index))
+            self.assertEqual('root1', index.get('1'))
+            self.assertEqual('root2', index.get('2'))
+            self.assertFalse('3' in index)
+
+    def test_get_nodes_skips_seen(self):
+        graphs = {
+            'root1': {'id': 'root1', 'posts': {'data': [{'id': 'post1'}, {'id': 'post2'}]}},
+            'root2': {'id': 'root2', 'posts': {'data': [{'id': 'post2'}, {'id': 'post3'}]}},
+        }
+        with PersistentIndex(self.index_filepath) as index:
+            fbarc = Fbarc(seen_index=index)
+            fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+                'posts': {'edge_type': 'post'}}})
+            fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'fields': {}})
+            with patch.object(fbarc, 'get_node', side_effect=lambda node_id, _: graphs.get(node_id, {'id': node_id})):
+                self.assertEqual(['root1', 'post1', 'post2'],
+                                 [graph['id'] for graph in fbarc.get_nodes('root1', 'page', levels=2,
+                                                                           exclude_definition_names=[])])
+                self.assertEqual(['root2', 'post3'],
+                                 [graph['id'] for graph in fbarc.get_nodes('root2', 'page', levels=2,
+                                                                           exclude_definition_names=[])])
+        with PersistentIndex(self.index_filepath) as index:
+            # Root node id and number of levels of connected nodes retrieved
+            self.assertEqual(['root1', 0], index.get('post2'))
+            self.assertEqual(['root2', 0], index.get('post3'))
+
+    def test_get_nodes_expands_leaves(self):
+        graphs = {
+            'root1': {'id': 'root1', 'posts': {'data': [{'id': 'post1'}]}},
+            'root2': {'id': 'root2', 'pages': {'data': [{'id': 'root1'}]}},
+            'post1': {'id': 'post1', 'comments': {'data': [{'id': 'comment1'}]}},
+        }
+        fbarc = Fbarc(seen_index=PersistentIndex())
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'}, 'pages': {'edge_type': 'page'}}})
+        fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'fields': {
+            'comments': {'edge_type': 'comment'}}})
+        fbarc._definitions['comment'] = Definition({'fields': {'message': {}}})
+        with patch.object(fbarc, 'get_node', side_effect=lambda node_id, _, **kwargs: graphs.get(
+                node_id, {'id': node_id})):
+            self.assertEqual(['root1', 'post1'], [graph['id'] for graph in fbarc.get_nodes(
+                'root1', 'page', levels=2, exclude_definition_names=[])])
+            # Post1 was a leaf, so is retrieved again to retrieve its comments.
+            self.assertEqual(['root2', 'root1', 'post1', 'comment1'], [graph['id'] for graph in fbarc.get_nodes(
+                'root2', 'page', levels=4, exclude_definition_names=[])])
+            # Root1 has been retrieved with enough levels.
+            self.assertEqual(['root2'], [graph['id'] for graph in fbarc.get_nodes(
+                'root2', 'page', levels=2, exclude_definition_names=[])])
+
+    def test_seen_graph_output(self):
+        graphs = {'root1': {'id': 'root1', 'posts': {'data': [{'id': 'post1'}]}}}
+        fbarc = Fbarc(seen_index=PersistentIndex(), defer_seen=True)
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'}}})
+        fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'fields': {'message': {}}})
+        mock_output = MagicMock()
+        mock_output.output_graph.side_effect = [None, OSError('Disk full')]
+        with patch.object(fbarc, 'get_node', side_effect=lambda node_id, _, **kwargs: graphs.get(
+                node_id, {'id': node_id})):
+            with self.assertRaises(OSError):
+                print_graphs(fbarc.get_nodes('root1', 'page', levels=2, exclude_definition_names=[]),
+                             (mock_output, SeenGraphOutput(fbarc)), write_queue_size=1)
+        # Post1 was not written, so is not recorded as seen.
+        self.assertIn('root1', fbarc.seen_index)
+        self.assertNotIn('post1', fbarc.seen_index)
+
+
+class TestLeafProfile(unittest.TestCase):
+    def setUp(self):
+        self.fbarc = Fbarc()
+        self.fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'name': {'default': True},
+            'about': {},
+            'posts': {'edge_type': 'post'}}})
+        self.fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'leaf': {'edges': ['comments']}, 'fields': {
+            'message': {},
+            'comments': {'edge_type': 'comment'},
+            'reactions': {'edge_type': 'comment'}}})
+        self.fbarc._definitions['comment'] = Definition({'fields': {}})
+
+    def test_prepare_field_param(self):
+        self.assertEqual('id,metadata{type},name,about', self.fbarc._prepare_field_param(
+            'page', default_only=False, leaf_profile={'edges': []}))
+        self.assertEqual('id,metadata{type},message,comments.limit(100){id}', self.fbarc._prepare_field_param(
+            'post', default_only=False, leaf_profile=self.fbarc.get_leaf_profile('post')))
+
+    def test_get_nodes(self):
+        graphs = {'root': {'id': 'root', 'posts': {'data': [{'id': 'post1'}]}}}
+        with patch.object(self.fbarc, 'get_node', side_effect=lambda node_id, _, **kwargs: graphs.get(
+                node_id, {'id': node_id})) as mock_get_node:
+            list(self.fbarc.get_nodes('root', 'page', levels=2, exclude_definition_names=[]))
+            self.assertEqual({}, mock_get_node.call_args_list[0][1])
+            self.assertEqual({'leaf_profile': {'edges': ['comments']}}, mock_get_node.call_args_list[1][1])
+            self.assertIsNone(self.fbarc.get_leaf_profile('page'))
+            self.fbarc.prune_leaves = True
+            self.assertEqual({'edges': [], 'get_pages': False}, self.fbarc.get_leaf_profile('page'))
+
+
+class TestEmbeddedNodes(unittest.TestCase):
+    def setUp(self):
+        self.fbarc = Fbarc()
+        self.fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'},
+            'likes': {'edge_type': 'page'}}})
+        self.fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'embed_all_fields': True, 'fields': {
+            'message': {},
+            'comments': {'edge_type': 'comment'}}})
+        self.fbarc._definitions['comment'] = Definition({'embedded_is_enough': True, 'fields': {
+            'message': {'default': True},
+            'like_count': {}}})
+
+    def test_prepare_field_param(self):
+        self.assertEqual('id,metadata{type},likes.limit(100){id},'
+                         'posts.limit(100){id,message,comments.limit(100){id,message}}',
+                         self.fbarc._prepare_field_param('page', default_only=False))
+
+    def test_get_nodes(self):
+        graphs = {'root': {'id': 'root', 'likes': {'data': [{'id': 'page2'}]}, 'posts': {'data': [
+            {'id': 'post1', 'message': 'Post', 'comments': {'data': [{'id': 'comment1', 'message': 'Comment'}]}}]}}}
+        with patch.object(self.fbarc, 'get_node', side_effect=lambda node_id, _: graphs.get(
+                node_id, {'id': node_id})) as mock_get_node:
+            records = list(self.fbarc.get_nodes('root', 'page', levels=3, exclude_definition_names=[]))
+            self.assertEqual(['root', 'page2'], [call[0][0] for call in mock_get_node.call_args_list])
+        self.assertEqual(['root', 'post1', 'comment1', 'page2'], [record['id'] for record in records])
+        self.assertEqual({'id': 'post1', 'message': 'Post',
+                          'comments': {'data': [{'id': 'comment1', 'message': 'Comment'}]},
+                          'metadata': {'type': 'post', 'embedded': True}}, records[1])
+        self.assertEqual({'type': 'comment', 'embedded': True}, records[2]['metadata'])
+
+
+class TestTimeSlicedPaging(unittest.TestCase):
+    def test_get_time_windows(self):
+        self.assertEqual([(67, 100), (34, 67), (0, 34)], get_time_windows(0, 100, 3))
+        self.assertEqual([(0, 2)], get_time_windows(0, 2, 1))
+        self.assertEqual('https://graph.facebook.com/v2.11/1/feed?limit=2&since=10&until=20',
+                         get_window_link('https://graph.facebook.com/v2.11/1/feed?limit=2&after=abc', 10, 20))
+
+    def test_get_node(self):
+        fbarc = Fbarc()
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'feed': {'edge_type': 'post', 'time_slices': 2}}})
+        fbarc._definitions['post'] = Definition({'fields': {'created_time': {'default': True}}})
+        node_graph = {'id': '1', 'created_time': '1970-01-01T00:00:00+0000', 'feed': {
+            'data': [{'id': '1_4', 'created_time': '1970-01-01T00:01:40+0000'}],
+            'paging': {'next': 'https://graph.facebook.com/v2.11/1/feed?limit=1&after=abc'}}}
+        windows = {
+            ('51', '101'): {'data': [{'id': '1_4', 'created_time': '1970-01-01T00:01:40+0000'},
+                                     {'id': '1_3', 'created_time': '1970-01-01T00:01:30+0000'}]},
+            ('0', '51'): {'data': [{'id': '1_2', 'created_time': '1970-01-01T00:00:50+0000'}],
+                          'paging': {'next': 'https://graph.facebook.com/v2.11/1/feed?limit=1&after=def'}},
+        }
+        batches = []
+
+        def perform_http_post(url, data=None, stream_items=False):
+            if not stream_items:
+                return node_graph
+            batch = json.loads(data['batch'])
+            batches.append(batch)
+            batch_items = []
+            for request in batch:
+                params = dict(parse_qsl(urlparse(request['relative_url']).query))
+                if 'since' in params:
+                    body = windows[(params['since'], params['until'])]
+                else:
+                    body = {'data': [{'id': '1_1', 'created_time': '1970-01-01T00:00:10+0000'}]}
+                batch_items.append({'code': 200, 'body': json.dumps(body)})
+            return (batch_item for batch_item in batch_items)
+
+        with patch.object(fbarc, '_perform_http_post', side_effect=perform_http_post):
+            graph = fbarc.get_node('1', 'page')
+        # Windows are retrieved in the same batch.
+        self.assertEqual(2, len(batches[0]))
+        self.assertEqual(['1_4', '1_3', '1_2', '1_1'], [node['id'] for node in graph['feed']['data']])
+
+
+class TestScheduler(unittest.TestCase):
+    @staticmethod
+    def batch_size(definition_name):
+        return {'post': 2, 'comment': 3}[definition_name]
+
+    def drain(self, scheduler):
+        batches = []
+        while scheduler:
+            batches.append(scheduler.pop_batch(self.batch_size))
+        return batches
+
+    def push_nodes(self, scheduler):
+        scheduler.push('post1', 'post', 2, node_fragment={'created_time': '2017-01-01T00:00:00+0000'})
+        scheduler.push('comment1', 'comment', 3)
+        scheduler.push('post2', 'post', 2, node_fragment={'created_time': '2017-03-01T00:00:00+0000'})
+        scheduler.push('post3', 'post', 2, node_fragment={'created_time': '2017-02-01T00:00:00+0000'})
+        scheduler.push('comment2', 'comment', 3)
+
+    def test_bfs(self):
+        scheduler = BfsScheduler()
+        self.push_nodes(scheduler)
+        self.assertEqual([(['post1'], 'post', 2), (['comment1'], 'comment', 3), (['post2', 'post3'], 'post', 2),
+                          (['comment2'], 'comment', 3)], self.drain(scheduler))
+
+    def test_dfs(self):
+        scheduler = DfsScheduler()
+        self.push_nodes(scheduler)
+        self.assertEqual([(['comment2'], 'comment', 3), (['post3', 'post2'], 'post', 2),
+                          (['comment1'], 'comment', 3), (['post1'], 'post', 2)], self.drain(scheduler))
+
+    def test_priority(self):
+        scheduler = PriorityScheduler(['comment'])
+        self.push_nodes(scheduler)
+        self.assertEqual([(['comment1', 'comment2'], 'comment', 3), (['post1', 'post2'], 'post', 2),
+                          (['post3'], 'post', 2)], self.drain(scheduler))
+
+    def test_recency(self):
+        scheduler = RecencyScheduler()
+        self.push_nodes(scheduler)
+        self.assertEqual([(['post2', 'post3'], 'post', 2), (['post1'], 'post', 2),
+                          (['comment1', 'comment2'], 'comment', 3)], self.drain(scheduler))
+        self.assertEqual(0, len(scheduler))
+
+    def test_dfs_levels(self):
+        # Diamond: D is found at level 4 through B and C before it is found at level 3 through A.
+        links = {'root': ['A', 'B'], 'A': ['D'], 'B': ['C'], 'C': ['D'], 'D': ['E'], 'E': []}
+
+        def get_node(node_id, definition_name, **kwargs):
+            return {'id': node_id, 'links': {'data': [{'id': link} for link in links[node_id]]}}
+
+        node_ids = {}
+        for scheduler in (BfsScheduler(), DfsScheduler()):
+            fbarc = Fbarc()
+            fbarc._definitions['node'] = Definition({'node_batch_size': 1, 'fields': {
+                'links': {'edge_type': 'node'}}})
+            with patch.object(fbarc, 'get_node', side_effect=get_node):
+                node_ids[type(scheduler)] = set(graph['id'] for graph in fbarc.get_nodes(
+                    'root', 'node', levels=4, exclude_definition_names=[], scheduler=scheduler))
+        self.assertEqual({'root', 'A', 'B', 'C', 'D', 'E'}, node_ids[BfsScheduler])
+        self.assertEqual(node_ids[BfsScheduler], node_ids[DfsScheduler])
+
+    def test_subclass(self):
+        class ListScheduler(NodeScheduler):
+            # Not calling NodeScheduler.__init__()
+            def __init__(self):
+                self.nodes = []
+
+            def push(self, node_id, definition_name, level, node_fragment=None):
+                self.nodes.append(node_id)
+
+            def pop_batch(self, batch_size_func):
+                return [self.nodes.pop()], 'post', 2
+
+            def __len__(self):
+                return len(self.nodes)
+
+        scheduler = ListScheduler()
+        scheduler.push_page('page1')
+        scheduler.push_retry(['post1'], 'post', 2, 0, 1)
+        self.assertTrue(scheduler.is_page_batch_next())
+        self.assertEqual(['page1'], scheduler.pop_page_batch(10))
+        self.assertEqual((['post1'], 'post', 2, 1), scheduler.pop_retry())
+        with self.assertRaises(TypeError):
+            NodeScheduler()
+
+
+class TestCrawlBudget(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.stopped_filepath = os.path.join(self.temp_dir, 'stopped.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_parse_limits(self):
+        self.assertEqual({None: 10, 'comments': 500}, parse_limits(['10', 'comments=500']))
+        self.assertEqual({3: 100}, parse_limits(['3=100'], key_type=int))
+        self.assertEqual({}, parse_limits(None))
+        with self.assertRaises(ValueError):
+            parse_limits(['comments=all'])
+
+    def test_edge_limits(self):
+        link = 'https://graph.facebook.com/v2.11/123_456/comments?access_token=secret&limit=2&after=abc'
+
+        def get_page_batch(pages):
+            new_pages = []
+            for _, graph_fragment in pages:
+                graph_fragment.extend([{'id': str(len(graph_fragment))}, {'id': str(len(graph_fragment) + 1)}])
+                new_pages.append((link, graph_fragment))
+            return new_pages
+
+        with CrawlBudget(max_edge_items={'comments': 5}, stopped_edges_filepath=self.stopped_filepath) as budget:
+            fbarc = Fbarc(budget=budget)
+            self.assertEqual(5, budget.get_edge_size('comments', 2000))
+            self.assertEqual(2000, budget.get_edge_size('photos', 2000))
+            graph_fragment = [{'id': 'a'}, {'id': 'b'}]
+            with patch.object(fbarc, 'get_page_batch', side_effect=get_page_batch):
+                fbarc._get_pages(deque([(link, graph_fragment)]), 50)
+            self.assertEqual(5, len(graph_fragment))
+            self.assertEqual(1, budget.stopped_edge_count)
+        with open(self.stopped_filepath) as file:
+            stopped_edge = json.loads(file.readline())
+        self.assertEqual('123_456', stopped_edge['node_id'])
+        self.assertEqual('comments', stopped_edge['edge'])
+        self.assertEqual('max_edge_items', stopped_edge['reason'])
+        self.assertNotIn('secret', stopped_edge['next'])
+        self.assertIn('after=abc', stopped_edge['next'])
+        # The edge stopped after the first item of the last page.
+        self.assertEqual(1, stopped_edge['offset'])
+
+    def test_trim_edge(self):
+        link = 'https://graph.facebook.com/v2.11/123_456/comments?after=abc'
+        nested_link = 'https://graph.facebook.com/v2.11/{}/comments?after=abc'
+
+        def get_page_batch(pages):
+            new_pages = []
+            for page_link, graph_fragment in pages:
+                if page_link == link:
+                    items = [{'id': 'c', 'comments': {'data': []}}, {'id': 'd', 'comments': {'data': []}}]
+                    graph_fragment.extend(items)
+                    new_pages.append((link, graph_fragment))
+                    new_pages.extend((nested_link.format(item['id']), item['comments']['data']) for item in items)
+            return new_pages
+
+        budget = CrawlBudget(max_edge_items={'comments': 3})
+        fbarc = Fbarc(budget=budget)
+        graph_fragment = [{'id': 'a'}, {'id': 'b'}]
+        with patch.object(fbarc, 'get_page_batch', side_effect=get_page_batch) as mock_get_page_batch:
+            fbarc._get_pages(deque([(link, graph_fragment)]), 50)
+        self.assertEqual(['a', 'b', 'c'], [item['id'] for item in graph_fragment])
+        # Neither the next page of the trimmed edge nor the pages of the removed item are retrieved.
+        self.assertEqual([[link], [nested_link.format('c')]],
+                         [[page_link for page_link, _ in call[0][0]] for call in mock_get_page_batch.call_args_list])
+        self.assertEqual(1, budget.stopped_edge_count)
+
+    def test_node_limits(self):
+        budget = CrawlBudget(max_definition_nodes={'comment': 2}, max_level_nodes={3: 1}, max_requests=1)
+        self.assertTrue(budget.allow_node('comment', 2))
+        self.assertTrue(budget.allow_node('comment', 2))
+        self.assertFalse(budget.allow_node('comment', 2))
+        self.assertTrue(budget.allow_node('post', 3))
+        self.assertFalse(budget.allow_node('post', 3))
+        self.assertFalse(budget.is_exhausted())
+        budget.count_request()
+        self.assertTrue(budget.is_exhausted())
+
+    def test_concurrent_counts(self):
+        link = 'https://graph.facebook.com/v2.11/123_456/comments?after=abc'
+        with CrawlBudget(max_definition_nodes={'comment': 1000},
+                         stopped_edges_filepath=self.stopped_filepath) as budget:
+            def count():
+                for _ in range(500):
+                    budget.count_request()
+                    budget.allow_node('comment', 2)
+                    budget.stop_edge(link, 10, 'max_edge_items')
+
+            threads = [threading.Thread(target=count) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(2000, budget.request_count)
+            self.assertEqual(1000, budget.definition_node_counter['comment'])
+            self.assertEqual(2000, budget.stopped_edge_count)
+        with open(self.stopped_filepath) as file:
+            self.assertEqual(2000, len([json.loads(line) for line in file]))
+
+
+class TestDiscover(unittest.TestCase):
+    def test_discover_types(self):
+        type_cache = PersistentIndex()
+        type_cache.set('cached1', 'page')
+        fbarc = Fbarc(type_cache=type_cache)
+        node_ids = ['cached1'] + ['node{}'.format(count) for count in range(60)] + ['node1']
+
+        def perform_http_get(url, params=None):
+            return {node_id: {'id': node_id, 'metadata': {'type': 'post' if node_id.endswith('1') else 'page'}}
+                    for node_id in params['ids'].split(',') if node_id != 'node5'}
+
+        with patch.object(fbarc, '_perform_http_get', side_effect=perform_http_get) as mock_get:
+            node_types = fbarc.discover_types(node_ids)
+            # 60 nodes to look up in batches of 50
+            self.assertEqual(2, mock_get.call_count)
+        self.assertEqual(60, len(node_types))
+        self.assertEqual('page', node_types['cached1'])
+        self.assertEqual('post', node_types['node1'])
+        self.assertNotIn('node5', node_types)
+        self.assertEqual('page', type_cache.get('node2'))
+
+        with patch.object(fbarc, '_perform_http_get', side_effect=perform_http_get) as mock_get:
+            self.assertEqual([('node2', 'page'), ('node3', 'page'), ('node1', 'post'), ('node11', 'post')],
+                             discover_definition_names(['node2', 'node1', 'node3', 'node11'], fbarc))
+            self.assertEqual(0, mock_get.call_count)
+
+
+class TestStreamingDecode(unittest.TestCase):
+    def test_iter_json_array(self):
+        mock_response = MagicMock()
+        mock_response.content = b'[{"code": 200, "body": "{\\"data\\": []}"}, null]'
+        mock_response.raw.read.side_effect = [mock_response.content, b'']
+        self.assertEqual([{'code': 200, 'body': '{"data": []}'}, None], list(iter_json_array(mock_response)))
+
+    def test_get_page_batch(self):
+        fbarc = Fbarc()
+        pages = [('https://graph.facebook.com/v2.11/1/comments?after=1', []),
+                 ('https://graph.facebook.com/v2.11/2/comments?after=1', []),
+                 ('https://graph.facebook.com/v2.11/3/comments?after=1', []),
+                 ('https://graph.facebook.com/v2.11/4/comments?after=1', [])]
+        batch_items = (batch_item for batch_item in [
+            {'code': 200, 'body': json.dumps({'data': [{'id': '1_1'}], 'paging': {'next': 'next1'}})},
+            None,
+            {'code': 500, 'body': json.dumps({'error': {'message': 'Error'}})},
+        ])
+        with patch.object(fbarc, '_perform_http_post', return_value=batch_items), \
+                patch.object(fbarc, 'get_page', return_value=[]) as mock_get_page:
+            self.assertEqual([('next1', pages[0][1])], fbarc.get_page_batch(pages))
+            # Missing, error and truncated pages are retrieved by themselves.
+            self.assertEqual([page_link for page_link, _ in pages[1:]],
+                             [call[0][0] for call in mock_get_page.call_args_list])
+        self.assertEqual([{'id': '1_1'}], pages[0][1])
+
+    def test_iter_page_fragments_truncated(self):
+        fbarc = Fbarc()
+        page_links = ['https://graph.facebook.com/v2.11/{}/comments?after=1'.format(i) for i in range(3)]
+        closed = []
+
+        def batch_items():
+            try:
+                yield {'code': 200, 'body': json.dumps({'data': []})}
+                raise urllib3.exceptions.ProtocolError('Connection broken: IncompleteRead')
+            finally:
+                closed.append(True)
+
+        with patch.object(fbarc, '_perform_http_post', return_value=batch_items()):
+            # Pages after the truncation are retrieved by themselves.
+            self.assertEqual([{'data': []}, None, None], list(fbarc.iter_page_fragments(page_links)))
+        self.assertEqual([True], closed)
+
+        closed.clear()
+        with patch.object(fbarc, '_perform_http_post', return_value=batch_items()):
+            page_fragments = fbarc.iter_page_fragments(page_links)
+            next(page_fragments)
+            page_fragments.close()
+        # The response is closed when not all pages are read.
+        self.assertEqual([True], closed)
+
+    def test_iter_json_array_closes(self):
+        mock_response = MagicMock()
+        mock_response.content = b'[1, 2]'
+        mock_response.raw.read.side_effect = [mock_response.content, b'']
+        items = iter_json_array(mock_response)
+        self.assertEqual(1, next(items))
+        items.close()
+        mock_response.close.assert_called_once_with()
+
+
+class TestOmitCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_filepath = os.path.join(self.temp_dir, 'omit.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def create_fbarc(self, omit_cache):
+        fbarc = Fbarc(omit_cache=omit_cache)
+        fbarc._definitions['page'] = Definition({'fields': {
+            'name': {}, 'visitor_posts': {'edge_type': 'post', 'omit_on_error': 10}}})
+        fbarc._definitions['post'] = Definition({'fields': {'message': {'default': True}}})
+        return fbarc
+
+    @staticmethod
+    def perform_http_post(url, data=None):
+        if 'visitor_posts' in data['fields']:
+            raise FbException({'error': {'code': 10}})
+        if 'ids' in data:
+            return dict((node_id, {'id': node_id}) for node_id in data['ids'].split(','))
+        return {'id': url.split('/')[-1]}
+
+    def test_get_node(self):
+        with OmitCache(self.cache_filepath) as omit_cache:
+            fbarc = self.create_fbarc(omit_cache)
+            with patch.object(fbarc, '_perform_http_post', side_effect=self.perform_http_post) as mock_post:
+                self.assertEqual({'id': '1'}, fbarc.get_node('1', 'page'))
+            self.assertEqual(2, mock_post.call_count)
+
+        # Learned node is requested without the fields on the first attempt.
+        with OmitCache(self.cache_filepath) as omit_cache:
+            fbarc = self.create_fbarc(omit_cache)
+            with patch.object(fbarc, '_perform_http_post', side_effect=self.perform_http_post) as mock_post:
+                self.assertEqual({'id': '1'}, fbarc.get_node('1', 'page'))
+            self.assertEqual(1, mock_post.call_count)
+
+            # In a batch, the learned node is retrieved by itself.
+            with patch.object(fbarc, '_perform_http_post', side_effect=self.perform_http_post) as mock_post:
+                self.assertEqual({'1': {'id': '1'}, '2': {'id': '2'}}, fbarc.get_node_batch(['1', '2'], 'page'))
+            self.assertEqual(4, mock_post.call_count)
+            self.assertIn('2', omit_cache)
+
+    def test_definition_error_rate(self):
+        with OmitCache(self.cache_filepath, min_requests=4) as omit_cache:
+            omit_cache.count_request('page', 3)
+            omit_cache.count_error('1', 'page', 10)
+            self.assertIsNone(omit_cache.get_definition_error_code('page'))
+            omit_cache.count_request('page')
+            omit_cache.count_error('2', 'page', 10)
+            self.assertEqual(10, omit_cache.get_error_code('3', 'page'))
+        with OmitCache(self.cache_filepath, min_requests=4) as omit_cache:
+            self.assertEqual(10, omit_cache.get_definition_error_code('page'))
+            self.assertIn('1', omit_cache)
+            self.assertNotIn('3', omit_cache)
+
+    def test_default_omits_nodes_only(self):
+        fbarc = self.create_fbarc(None)
+        failing_node_ids = [str(i) for i in range(OMIT_MIN_REQUESTS)]
+
+        def perform_http_post(url, data=None):
+            if 'ids' in data:
+                node_ids = data['ids'].split(',')
+                if 'visitor_posts' in data['fields'] and set(node_ids) & set(failing_node_ids):
+                    raise FbException({'error': {'code': 10}})
+                return dict((node_id, {'id': node_id}) for node_id in node_ids)
+            return self.perform_http_post(url, data=data)
+
+        with patch.object(fbarc, '_perform_http_post', side_effect=perform_http_post) as mock_post:
+            fbarc.get_node_batch(failing_node_ids, 'page')
+            self.assertIsNone(fbarc.omit_cache.get_definition_error_code('page'))
+            # Nodes that haven't failed are always requested with the fields.
+            for _ in range(OMIT_SAMPLE_INTERVAL):
+                fbarc.get_node_batch(['new1', 'new2'], 'page')
+                self.assertIn('visitor_posts', mock_post.call_args[1]['data']['fields'])
+
+    def test_sample(self):
+        with OmitCache(min_requests=4, sample_interval=2) as omit_cache:
+            omit_cache.count_request('page', 4)
+            omit_cache.count_error('1', 'page', 10)
+            omit_cache.count_error('2', 'page', 10)
+            self.assertEqual([10, None, 10, None], [omit_cache.get_definition_error_code('page', sample=True)
+                                                    for _ in range(4)])
+            self.assertEqual(10, omit_cache.get_definition_error_code('page'))
+            # Sampled requests without errors
+            omit_cache.count_request('page', 4)
+            self.assertIsNone(omit_cache.get_definition_error_code('page'))
+            self.assertEqual(10, omit_cache.get_error_code('1', 'page'))
+
+
+class TestSizeTuner(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sizes_filepath = os.path.join(self.temp_dir, 'sizes.idx')
+        self.page_definition = Definition({'node_batch_size': 4, 'fields': {'posts': {'edge_type': 'post'}}})
+        self.post_definition = Definition({'edge_size': 8, 'fields': {'message': {'default': True}}})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_record_response(self):
+        edge_definitions = {'post': self.post_definition}
+        with SizeTuner(self.sizes_filepath, max_latency_secs=10, max_factor=2) as size_tuner:
+            size_tuner.record_response('page', self.page_definition, edge_definitions, 4, 1, 1000)
+            self.assertEqual(5, size_tuner.get_node_batch_size('page', self.page_definition))
+            self.assertEqual(10, size_tuner.get_edge_size('post', self.post_definition))
+            # Not a full batch
+            size_tuner.record_response('page', self.page_definition, edge_definitions, 2, 1, 1000)
+            self.assertEqual(5, size_tuner.get_node_batch_size('page', self.page_definition))
+            # Within bounds
+            for _ in range(10):
+                size_tuner.record_response('page', self.page_definition, edge_definitions, 8, 1, 1000)
+            self.assertEqual(8, size_tuner.get_node_batch_size('page', self.page_definition))
+            self.assertEqual(16, size_tuner.get_edge_size('post', self.post_definition))
+            # Slow
+            size_tuner.record_response('page', self.page_definition, edge_definitions, 8, 20, 1000)
+            self.assertEqual(4, size_tuner.get_node_batch_size('page', self.page_definition))
+            size_tuner.reduce('page', self.page_definition, edge_definitions, 1)
+            self.assertEqual(8, size_tuner.get_edge_size('post', self.post_definition))
+        with SizeTuner(self.sizes_filepath) as size_tuner:
+            self.assertEqual(4, size_tuner.get_node_batch_size('page', self.page_definition))
+            self.assertEqual(8, size_tuner.get_edge_size('post', self.post_definition))
+
+    def test_get_node_batch(self):
+        fbarc = Fbarc(size_tuner=SizeTuner())
+        fbarc._definitions['page'] = self.page_definition
+        fbarc._definitions['post'] = self.post_definition
+
+        def perform_http_post(url, data=None):
+            if 'ids' in data:
+                raise FbException({'error': {'code': 1}})
+            if 'posts.limit(8)' in data['fields']:
+                raise FbException({'error': {'code': 1}})
+            return {'id': url.split('/')[-1]}
+
+        with patch.object(fbarc, '_perform_http_post', side_effect=perform_http_post):
+            with self.assertRaises(FbException):
+                fbarc.get_node_batch(['1', '2', '3', '4'], 'page')
+            self.assertEqual(2, fbarc._get_node_batch_size('page'))
+            # Edge size was reduced after the error for a single node.
+            self.assertEqual({'id': '1'}, fbarc.get_node('1', 'page'))
+        self.assertIn('posts.limit(4)', fbarc._prepare_node_request('1', 'page')[1]['fields'])
+
+
+class TestPlan(unittest.TestCase):
+    def test_plan(self):
+        fbarc = Fbarc(delay_secs=1)
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'created_time': {}, 'posts': {'edge_type': 'post'}}})
+        fbarc._definitions['post'] = Definition({'node_batch_size': 10, 'edge_size': 2, 'fields': {
+            'created_time': {'default': True}, 'comments': {'edge_type': 'comment'}}})
+        fbarc._definitions['comment'] = Definition({'edge_size': 10, 'fields': {'message': {'default': True}}})
+        samples = []
+
+        def perform_http_post(url, data=None):
+            node_ids = data['ids'].split(',')
+            samples.append(node_ids)
+            if node_ids == ['1']:
+                # 2 posts in 10 seconds, back to 100 seconds
+                return {'1': {'id': '1', 'created_time': '1970-01-01T00:00:00+0000', 'posts': {
+                    'data': [{'id': '1_2', 'created_time': '1970-01-01T00:01:40+0000'},
+                             {'id': '1_1', 'created_time': '1970-01-01T00:01:30+0000'}],
+                    'paging': {'next': 'https://graph.facebook.com/v2.11/1/posts?limit=2&after=abc'}}}}
+            self.assertIn('comments.limit(10).summary(true)', data['fields'])
+            return dict((node_id, {'id': node_id, 'comments': {
+                'data': [{'id': node_id + '_c1'}], 'summary': {'total_count': 16},
+                'paging': {'next': 'https://graph.facebook.com/v2.11/1_1/comments?limit=10&after=abc'}}})
+                for node_id in node_ids)
+
+        with patch.object(fbarc, '_perform_http_post', side_effect=perform_http_post):
+            plan = fbarc.plan('1', 'page', levels=2, sample_size=2)
+        self.assertEqual([['1'], ['1_2', '1_1']], samples)
+        self.assertEqual([{'page': 1}, {'post': 20}], plan['levels'])
+        self.assertEqual({'page': 1, 'post': 20}, plan['nodes'])
+        # 9 additional pages of posts and an additional page of comments for each of 20 posts
+        self.assertEqual(29, plan['pages'])
+        # 1 request for page, 2 for posts and 1 for pages
+        self.assertEqual(4, plan['requests'])
+        self.assertEqual(4, plan['secs'])
+        self.assertEqual(2, plan['sample_requests'])
+        self.assertEqual([], plan['lower_bound_edges'])
+
+    def test_plan_nested_edges(self):
+        fields = []
+
+        def perform_http_post(url, data=None):
+            fields.append(data['fields'])
+            graph = {'id': '1'}
+            if 'posts' in data['fields']:
+                graph['posts'] = {
+                    'data': [{'id': '1_{}'.format(i), 'comments': {
+                        'data': [{'id': '1_{}_c1'.format(i)}], 'summary': {'total_count': 25},
+                        'paging': {'next': 'https://graph.facebook.com/v2.11/1_1/comments?limit=10&after=abc'}}}
+                        for i in range(2)],
+                    'summary': {'total_count': 20},
+                    'paging': {'next': 'https://graph.facebook.com/v2.11/1/posts?limit=2&after=abc'}}
+            return {'1': graph}
+
+        for prune_leaves in (False, True):
+            fbarc = Fbarc(delay_secs=1, prune_leaves=prune_leaves)
+            fbarc._definitions['page'] = Definition({'fields': {'posts': {'edge_type': 'post'}}})
+            fbarc._definitions['post'] = Definition({'edge_size': 2, 'fields': {
+                'comments': {'edge_type': 'comment', 'default': True}}})
+            fbarc._definitions['comment'] = Definition({'edge_size': 10, 'fields': {'message': {'default': True}}})
+            with patch.object(fbarc, '_perform_http_post', side_effect=perform_http_post):
+                plan = fbarc.plan('1', 'page', levels=1)
+            if not prune_leaves:
+                self.assertIn('comments.limit(10).summary(true)', fields[-1])
+                # 9 additional pages of posts and 2 additional pages of comments for each of 20 posts
+                self.assertEqual(49, plan['pages'])
+                self.assertEqual(2, plan['requests'])
+            else:
+                # The page is a leaf, so retrieved without edges.
+                self.assertNotIn('posts', fields[-1])
+                self.assertEqual(0, plan['pages'])
+                self.assertEqual(1, plan['requests'])
+
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    contents = {'/a.jpg': b'image' * 1000, '/b.jpg': b'image' * 1000, '/c.jpg': b'other image'}
+    range_headers = []
+
+    def do_GET(self):
+        if self.path not in self.contents:
+            self.send_error(404)
+            return
+        content = self.contents[self.path]
+        range_header = self.headers.get('Range')
+        self.range_headers.append(range_header)
+        if range_header:
+            start = int(range_header[len('bytes='):-1])
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(content)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)))
+            content = content[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMediaStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), MediaRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        MediaRequestHandler.range_headers = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_find_media_urls(self):
+        self.assertEqual(['https://example.com/1.jpg', 'https://example.com/2.jpg'], find_media_urls({
+            'id': '1', 'picture': {'data': {'url': 'https://example.com/1.jpg'}},
+            'attachments': {'data': [{'full_picture': 'https://example.com/2.jpg', 'source': 'Not a url'}]}}))
+
+    def test_iter_graphs(self):
+        graphs = [
+            {'id': '1', 'full_picture': self.url + '/a.jpg'},
+            {'id': '2', 'photos': {'data': [{'id': '3', 'picture': self.url + '/b.jpg'},
+                                            {'id': '4', 'picture': self.url + '/c.jpg'}]}},
+            {'id': '5', 'full_picture': self.url + '/missing.jpg'},
+            {'id': '6', 'picture': self.url + '/a.jpg'},
+        ]
+        with MediaStore(self.temp_dir, window_size=1) as media_store:
+            annotated_graphs = list(media_store.iter_graphs(graphs))
+            self.assertEqual(3, media_store.download_count)
+        self.assertEqual(['1', '2', '5', '6'], [graph['id'] for graph in annotated_graphs])
+        path = annotated_graphs[0]['metadata']['media'][self.url + '/a.jpg']
+        self.assertTrue(path.endswith('.jpg'))
+        # Identical content is stored once.
+        self.assertEqual({self.url + '/b.jpg': path, self.url + '/c.jpg': annotated_graphs[1]['metadata']['media'][
+            self.url + '/c.jpg']}, annotated_graphs[1]['metadata']['media'])
+        self.assertNotIn('metadata', annotated_graphs[2])
+        with open(os.path.join(self.temp_dir, path), 'rb') as file:
+            self.assertEqual(MediaRequestHandler.contents['/a.jpg'], file.read())
+
+        # Downloaded urls are not downloaded again.
+        with MediaStore(self.temp_dir) as media_store:
+            self.assertEqual(path, media_store.submit(self.url + '/a.jpg').result())
+            self.assertEqual(0, media_store.download_count)
+
+    def test_host_queues(self):
+        release = threading.Event()
+        lock = threading.Lock()
+        active = Counter()
+        max_active = Counter()
+
+        def download_partial(url, partial_filepath):
+            host = urlparse(url).netloc
+            with lock:
+                active[host] += 1
+                max_active[host] = max(max_active[host], active[host])
+            if host == 'a.example.com':
+                release.wait(5)
+            with lock:
+                active[host] -= 1
+            with open(partial_filepath, 'wb') as file:
+                file.write(url.encode('utf-8'))
+            return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+        with MediaStore(self.temp_dir, max_workers=2, max_host_workers=1) as media_store:
+            with patch.object(media_store, '_download_partial', side_effect=download_partial):
+                a_futures = [media_store.submit('https://a.example.com/{}.jpg'.format(i)) for i in range(3)]
+                # Downloads queued for a host don't hold up downloads from other hosts.
+                self.assertIsNotNone(media_store.submit('https://b.example.com/1.jpg').result(timeout=5))
+                release.set()
+                self.assertTrue(all(future.result(timeout=5) for future in a_futures))
+        self.assertEqual(1, max_active['a.example.com'])
+        self.assertEqual(4, media_store.download_count)
+
+    def test_resume_partial(self):
+        with MediaStore(self.temp_dir) as media_store:
+            partial_filepath = os.path.join(media_store._partial_dir, 'c')
+            with open(partial_filepath, 'wb') as file:
+                file.write(b'other')
+            content_hash = media_store._download_partial(self.url + '/c.jpg', partial_filepath)
+        self.assertEqual(['bytes=5-'], MediaRequestHandler.range_headers)
+        with open(partial_filepath, 'rb') as file:
+            self.assertEqual(b'other image', file.read())
+        self.assertEqual(hashlib.sha256(b'other image').hexdigest(), content_hash)
+
+    def test_resume_partial_mismatch(self):
+        with MediaStore(self.temp_dir) as media_store:
+            partial_filepath = os.path.join(media_store._partial_dir, 'c')
+            # Complete
+            with open(partial_filepath, 'wb') as file:
+                file.write(b'other image')
+            self.assertEqual(hashlib.sha256(b'other image').hexdigest(),
+                             media_store._download_partial(self.url + '/c.jpg', partial_filepath))
+            self.assertEqual(['bytes=11-'], MediaRequestHandler.range_headers)
+            # Longer than the media, so started over.
+            with open(partial_filepath, 'wb') as file:
+                file.write(b'other image that was replaced')
+            self.assertEqual(hashlib.sha256(b'other image').hexdigest(),
+                             media_store._download_partial(self.url + '/c.jpg', partial_filepath))
+        self.assertEqual(['bytes=11-', 'bytes=29-', None], MediaRequestHandler.range_headers)
+        with open(partial_filepath, 'rb') as file:
+            self.assertEqual(b'other image', file.read())
+
+
+class FakeResponse(object):
+    """
+    Stands in for an aiohttp response.
+    """
+    def __init__(self, status, body):
+        self.status = status
+        self.content = json.dumps(body).encode('utf-8') if body is not None else b'Not found'
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        return self.content
+
+    def raise_for_status(self):
+        raise IOError(self.status)
+
+
+class FakeSession(object):
+    """
+    Stands in for an aiohttp session, responding to requests with respond(method, url, data).
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return FakeResponse(*self.respond(method, url, kwargs['data']))
+
+
+class TestAsyncFbarc(unittest.TestCase):
+    def test_get_nodes(self):
+        fbarc = AsyncFbarc(delay_secs=0, retry_policy=RetryPolicy(base_delay_secs=0))
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'}}})
+        fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'fields': {'message': {}}})
+        requests_made = []
+
+        async def send_request(method, url, params_key, params):
+            requests_made.append(url)
+            if 'batch' in params:
+                return json.dumps([{'code': 200, 'body': json.dumps({'data': [{'id': 'post3'}]})}]).encode('utf-8')
+            node_id = url.split('/')[-1]
+            if node_id == 'root':
+                if requests_made.count(url) == 1:
+                    raise FbException({'error': {'code': 2, 'is_transient': True}})
+                return json.dumps({'id': 'root', 'posts': {'data': [{'id': 'post1'}, {'id': 'post2'}], 'paging': {
+                    'next': 'https://graph.facebook.com/v2.11/root/posts?limit=2&after=abc'}}}).encode('utf-8')
+            return json.dumps({'id': node_id, 'message': node_id}).encode('utf-8')
+
+        async def get_nodes():
+            async with fbarc:
+                return [graph async for graph in fbarc.get_nodes('root', 'page', levels=2)]
+
+        with patch.object(fbarc, '_send_request_async', side_effect=send_request):
+            graphs = asyncio.run(get_nodes())
+        self.assertEqual('root', graphs[0]['id'])
+        self.assertEqual(['post1', 'post2', 'post3'], [node['id'] for node in graphs[0]['posts']['data']])
+        self.assertEqual({'post1', 'post2', 'post3'}, set(graph['id'] for graph in graphs[1:]))
+        # Root retried, page batch and 3 posts
+        self.assertEqual(6, len(requests_made))
+
+    def test_get_node(self):
+        tries = Counter()
+
+        def respond(method, url, data):
+            node_id = url.split('/')[-1]
+            if 'visitor_posts' in data['fields']:
+                return 400, {'error': {'code': 10}}
+            tries[node_id] += 1
+            if node_id == '2':
+                return 404, None
+            if tries[node_id] == 1:
+                return 500, {'error': {'code': 2, 'is_transient': True}}
+            return 200, {'id': node_id}
+
+        session = FakeSession(respond)
+        fbarc = AsyncFbarc(delay_secs=0, retry_policy=RetryPolicy(base_delay_secs=0), omit_cache=OmitCache(),
+                           size_tuner=SizeTuner(), session=session)
+        fbarc._definitions['page'] = Definition({'fields': {
+            'name': {}, 'visitor_posts': {'edge_type': 'post', 'omit_on_error': 10}}})
+        fbarc._definitions['post'] = Definition({'edge_size': 8, 'fields': {'message': {'default': True}}})
+
+        self.assertEqual({'id': '1'}, asyncio.run(fbarc.get_node('1', 'page')))
+        # Omitting fields for the error, then retrying the transient error.
+        self.assertEqual(3, len(session.requests))
+        self.assertIn('1', fbarc.omit_cache)
+        # The response was recorded by the size tuner.
+        self.assertEqual(10, fbarc._get_edge_size('post'))
+
+        # Not retried
+        with self.assertRaises(IOError):
+            asyncio.run(fbarc.get_node('2', 'page'))
+        self.assertEqual(1, tries['2'])
+
+    def test_unsupported_options(self):
+        with self.assertRaises(ValueError):
+            AsyncFbarc(stream_edges=True)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    @patch('fbarc.time.sleep')
+    def test_perform_http_get(self, mock_sleep):
+        fbarc = Fbarc(delay_secs=0, retry_policy=RetryPolicy(base_delay_secs=4))
+        response = MagicMock(status_code=200, content=b'{"id": "1"}')
+        with patch('fbarc.requests.get', side_effect=[requests.exceptions.ConnectionError(), response]) as mock_get:
+            self.assertEqual({'id': '1'}, fbarc._perform_http_get('https://graph.facebook.com/v2.11/1'))
+        self.assertEqual(2, mock_get.call_count)
+        # Jittered delay for the first retry
+        self.assertTrue(2 <= mock_sleep.call_args[0][0] <= 4)
+
+    def test_get_delay_secs(self):
+        retry_policy = RetryPolicy(base_delay_secs=4, max_delay_secs=10, rate_limit_delay_secs=60)
+        transient_error = FbException({'error': {'code': 2, 'is_transient': True}})
+        self.assertTrue(4 <= retry_policy.get_delay_secs(transient_error, 2) <= 8)
+        self.assertTrue(5 <= retry_policy.get_delay_secs(transient_error, 5) <= 10)
+        self.assertEqual(60, retry_policy.get_delay_secs(FbException({'error': {'code': 4}}), 1))
+        self.assertFalse(retry_policy.is_retryable(FbException({'error': {'code': 190}})))
+
+    def test_circuit_breaker(self):
+        retry_policy = RetryPolicy(breaker_failures=2, breaker_secs=60)
+        retry_policy.record_failure()
+        retry_policy.record_success()
+        retry_policy.record_failure()
+        self.assertEqual(0, retry_policy.get_breaker_secs())
+        retry_policy.record_failure()
+        self.assertTrue(retry_policy.get_breaker_secs() > 0)
+
+    def test_get_nodes(self):
+        fbarc = Fbarc(delay_secs=0, retry_policy=RetryPolicy(base_delay_secs=.02))
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'}}})
+        fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'fields': {'message': {}}})
+        tries = Counter()
+
+        def get_node(node_id, definition_name, **kwargs):
+            tries[node_id] += 1
+            if node_id == 'post1' and tries[node_id] < 3:
+                raise RetryLater(FbException({'error': {'code': 2, 'is_transient': True}}))
+            if node_id == 'root':
+                return {'id': 'root', 'posts': {'data': [{'id': 'post1'}, {'id': 'post2'}]}}
+            return {'id': node_id}
+
+        with patch.object(fbarc, 'get_node', side_effect=get_node):
+            # Post1 is retried after post2 rather than holding it up.
+            self.assertEqual(['root', 'post2', 'post1'],
+                             [graph['id'] for graph in fbarc.get_nodes('root', 'page', levels=2,
+                                                                       exclude_definition_names=[])])
+        self.assertEqual(3, tries['post1'])
+
+        fbarc.retry_policy.max_tries = 2
+        tries.clear()
+        with patch.object(fbarc, 'get_node', side_effect=get_node):
+            with self.assertRaises(FbException):
+                list(fbarc.get_nodes('root', 'page', levels=2, exclude_definition_names=[]))
+
+    @patch('fbarc.time.sleep')
+    def test_get_nodes_retries_pages(self, mock_sleep):
+        fbarc = Fbarc(delay_secs=0)
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'}}})
+        fbarc._definitions['post'] = Definition({'fields': {'message': {}}})
+        requests_made = Counter()
+
+        def post(url, data=None, **kwargs):
+            request = 'batch' if 'batch' in data else 'node'
+            requests_made[request] += 1
+            if request == 'batch':
+                if requests_made[request] == 1:
+                    raise requests.exceptions.ConnectionError()
+                return MagicMock(status_code=200, content=json.dumps(
+                    [{'code': 200, 'body': json.dumps({'data': [{'id': 'post2'}]})}]).encode('utf-8'))
+            return MagicMock(status_code=200, content=json.dumps({'id': 'root', 'posts': {
+                'data': [{'id': 'post1'}],
+                'paging': {'next': 'https://graph.facebook.com/v2.11/root/posts?after=1'}}}).encode('utf-8'))
+
+        with patch('fbarc.requests.post', side_effect=post):
+            graphs = list(fbarc.get_nodes('root', 'page', levels=1, exclude_definition_names=[]))
+        # The failed page is retried rather than the node.
+        self.assertEqual({'node': 1, 'batch': 2}, requests_made)
+        self.assertEqual(['post1', 'post2'], [post['id'] for post in graphs[0]['posts']['data']])
+
+
+class TestStagedPipeline(unittest.TestCase):
+    def test_get_nodes(self):
+        fbarc = Fbarc(delay_secs=0, retry_policy=RetryPolicy(base_delay_secs=.02), fetch_workers=2)
+        fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'}}})
+        fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'fields': {'message': {}}})
+        tries = Counter()
+        threads = set()
+
+        def get_node(node_id, definition_name, **kwargs):
+            threads.add(threading.current_thread().name)
+            tries[node_id] += 1
+            if node_id == 'post1' and tries[node_id] < 2:
+                raise RetryLater(FbException({'error': {'code': 2, 'is_transient': True}}))
+            if node_id == 'post2':
+                raise FbException({'error': {'code': 100, 'error_subcode': 33}})
+            if node_id == 'root':
+                return {'id': 'root', 'posts': {'data': [{'id': 'post{}'.format(i)} for i in range(1, 6)]}}
+            return {'id': node_id}
+
+        with patch.object(fbarc, 'get_node', side_effect=get_node):
+            graphs = list(fbarc.get_nodes('root', 'page', levels=2, exclude_definition_names=[]))
+        self.assertEqual('root', graphs[0]['id'])
+        # Post2 is skipped and post1 is retried.
+        self.assertEqual({'post1', 'post3', 'post4', 'post5'}, set(graph['id'] for graph in graphs[1:]))
+        self.assertEqual(2, tries['post1'])
+        self.assertTrue(all(thread.startswith('fetch') for thread in threads))
+        self.assertEqual({'fetch': 0, 'expand': 0}, fbarc.get_stage_depths())
+
+
+class TestEdgeStreaming(unittest.TestCase):
+    posts_link = 'https://graph.facebook.com/v2.11/root/posts?after=1'
+    posts_link2 = 'https://graph.facebook.com/v2.11/root/posts?after=2'
+    comments_link = 'https://graph.facebook.com/v2.11/post1/comments?after=1'
+    page_fragments = {
+        posts_link: {'data': [{'id': 'post2'}], 'paging': {'next': posts_link2 + '&access_token=secret'}},
+        posts_link2: {'data': [{'id': 'post3'}]},
+        comments_link: {'data': [{'id': 'comment2'}, {'id': 'comment3'}]},
+    }
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.fbarc = Fbarc(stream_edges=True, budget=CrawlBudget(max_edge_items={'comments': 2}))
+        self.fbarc._definitions['page'] = Definition({'node_batch_size': 1, 'fields': {
+            'posts': {'edge_type': 'post'}}})
+        self.fbarc._definitions['post'] = Definition({'node_batch_size': 1, 'fields': {
+            'comments': {'edge_type': 'comment', 'follow_edge': False}}})
+        self.fbarc._definitions['comment'] = Definition({'fields': {}})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def patch_requests(self, graphs):
+        return patch.object(self.fbarc, 'get_node', side_effect=lambda node_id, _, get_pages: graphs.get(
+            node_id, {'id': node_id})), \
+            patch.object(self.fbarc, 'iter_page_fragments', side_effect=lambda page_links: iter(
+                [json.loads(json.dumps(self.page_fragments[page_link])) for page_link in page_links]))
+
+    def test_get_nodes(self):
+        graphs = {
+            'root': {'id': 'root', 'posts': {'data': [
+                {'id': 'post1', 'comments': {'data': [{'id': 'comment1'}], 'paging': {'next': self.comments_link}}}],
+                'paging': {'next': self.posts_link}}},
+        }
+        patch_get_node, patch_iter_page_fragments = self.patch_requests(graphs)
+        with patch_get_node as mock_get_node, patch_iter_page_fragments as mock_iter_page_fragments:
+            records = list(self.fbarc.get_nodes('root', 'page', levels=2, exclude_definition_names=[]))
+            self.assertFalse(mock_get_node.call_args[1]['get_pages'])
+            # Pages of different nodes are retrieved in the same batch.
+            self.assertEqual([self.posts_link, self.comments_link], mock_iter_page_fragments.call_args_list[0][0][0])
+        # Nodes found in the first pages are retrieved before the later pages.
+        self.assertEqual(['root', 'root', 'post1', 'post1', 'root', 'post2', 'post3'],
+                         [record['id'] for record in records])
+        self.assertNotIn('paging', records[0]['posts'])
+        self.assertNotIn('paging', records[0]['posts']['data'][0]['comments'])
+        self.assertEqual([self.posts_link, self.comments_link],
+                         [edge_page['link'] for edge_page in records[0]['metadata']['edge_pages']])
+        self.assertEqual({'node_id': 'root', 'level': 1, 'edge': 'posts', 'page': 1, 'link': self.posts_link},
+                         records[1]['metadata']['chunk'])
+        self.assertEqual({'data': [{'id': 'post2'}]}, records[1]['posts'])
+        # Access token is stripped from the cursor.
+        self.assertEqual([self.posts_link2], [edge_page['link'] for edge_page in records[1]['metadata']['edge_pages']])
+        # Trimmed to the maximum number of items for the edge
+        self.assertEqual({'data': [{'id': 'comment2'}]}, records[2]['comments'])
+        self.assertEqual('post', records[2]['metadata']['type'])
+        self.assertEqual({'data': [{'id': 'post3'}]}, records[4]['posts'])
+
+    def test_resume(self):
+        filepath = os.path.join(self.temp_dir, 'root.jsonl')
+        edge_page = {'link': self.posts_link, 'node_id': 'root', 'level': 1, 'owner_id': 'root', 'type': 'page',
+                     'edge': 'posts', 'items': 1, 'pages': 0}
+        with open(filepath, 'w') as file:
+            file.write(json.dumps({'id': 'root', 'metadata': {'type': 'page', 'edge_pages': [edge_page]},
+                                   'posts': {'data': [{'id': 'post1'}]}}) + '\n')
+            file.write(json.dumps({'id': 'root', 'metadata': {
+                'type': 'page', 'chunk': {'node_id': 'root', 'level': 1, 'edge': 'posts', 'page': 1,
+                                          'link': self.posts_link},
+                'edge_pages': [dict(edge_page, link=self.posts_link2, items=2, pages=1)]},
+                'posts': {'data': [{'id': 'post2'}]}}) + '\n')
+        patch_get_node, patch_iter_page_fragments = self.patch_requests({})
+        with patch_get_node as mock_get_node, patch_iter_page_fragments as mock_iter_page_fragments:
+            self.fbarc.resume(filepath, levels=2, exclude_definition_names=[])
+            # Only the pending page is retrieved.
+            self.assertEqual([[self.posts_link2]], [call[0][0] for call in mock_iter_page_fragments.call_args_list])
+            self.assertEqual(['post1', 'post2', 'post3'], [call[0][0] for call in mock_get_node.call_args_list])
+        with open(filepath) as file:
+            self.assertEqual(['root', 'root', 'root', 'post1', 'post2', 'post3'],
+                             [json.loads(line)['id'] for line in file])
+
+
+class TestGraphOutput(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.temp_dir, 'test.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_background_output(self):
+        graphs = [{'id': str(count), 'message': 'caf\u00e9'} for count in range(100)]
+        with JsonGraphOutput(filepath=self.filepath, encoder='orjson', flush_secs=0) as json_output:
+            print_graphs(iter(graphs), (json_output,), write_queue_size=5)
+        with open(self.filepath, encoding='utf-8') as file:
+            self.assertEqual(graphs, [json.loads(line) for line in file])
+
+    def test_background_output_error(self):
+        mock_output = MagicMock()
+        mock_output.output_graph.side_effect = IOError('Disk full')
+        with self.assertRaises(IOError):
+            print_graphs(iter([{'id': str(count)} for count in range(100)]), (mock_output,), write_queue_size=5)
+
+
+class TestCompressedArchive(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.temp_dir, 'test.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_graphs(self, graphs, mode='w'):
+        # Small frames so that there are multiple frames
+        with JsonGraphOutput(filepath=self.filepath, mode=mode, frame_size=100) as output:
+            for graph in graphs:
+                output.output_graph(graph)
+
+    def test_archive(self):
+        graphs = [{'id': str(count), 'message': 'Message {}'.format(count)} for count in range(50)]
+        self.write_graphs(graphs[:25])
+        self.write_graphs(graphs[25:], mode='a')
+
+        offsets = {}
+        for offset, line in ArchiveReader(self.filepath):
+            graph = json.loads(line)
+            offsets[graph['id']] = offset
+        self.assertEqual(50, len(offsets))
+        reader = ArchiveReader(self.filepath)
+        self.assertEqual(graphs[37], json.loads(reader.read_line(offsets['37'])))
+        self.assertEqual(graphs[0], json.loads(reader.read_line(offsets['0'])))
+
+        # Without the frame index, frames are found by decompressing.
+        os.remove(get_frame_index_filepath(self.filepath))
+        self.assertEqual(graphs, [json.loads(line) for line in ArchiveReader(self.filepath).iter_lines()])
+
+    def test_uncompressed_archive(self):
+        filepath = os.path.join(self.temp_dir, 'test.jsonl')
+        graphs = [{'id': str(count), 'message': 'caf\u00e9'} for count in range(10)]
+        with JsonGraphOutput(filepath=filepath) as output:
+            for graph in graphs:
+                output.output_graph(graph)
+        offsets = dict((json.loads(line)['id'], offset) for offset, line in ArchiveReader(filepath))
+        self.assertEqual(graphs[5], json.loads(ArchiveReader(filepath).read_line(offsets['5'])))
+
+
+class TestSegmentedArchive(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.manifest_filepath = os.path.join(self.temp_dir, 'test.manifest.json')
+        self.graphs = [{'id': str(count), 'metadata': {'type': 'post' if count % 2 else 'comment'}}
+                       for count in range(25)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_graphs(self, graphs, mode='w', **kwargs):
+        with SegmentedJsonGraphOutput(self.manifest_filepath, mode=mode, **kwargs) as output:
+            for graph in graphs:
+                output.output_graph(graph)
+
+    def assert_archive(self):
+        offsets = {}
+        for offset, line in ArchiveReader(self.manifest_filepath):
+            offsets[json.loads(line)['id']] = offset
+        self.assertEqual([graph['id'] for graph in self.graphs], list(offsets.keys()))
+        reader = ArchiveReader(self.manifest_filepath)
+        for node_id in ('0', '12', '24'):
+            self.assertEqual(self.graphs[int(node_id)], json.loads(reader.read_line(offsets[node_id])))
+
+    def test_segments(self):
+        self.write_graphs(self.graphs[:13], max_segment_nodes=10)
+        # Appending continues the last segment using the limits from the manifest.
+        self.write_graphs(self.graphs[13:], mode='a')
+
+        manifest = read_manifest(self.manifest_filepath)
+        self.assertEqual(['test.00001.jsonl', 'test.00002.jsonl', 'test.00003.jsonl'],
+                         [segment['filename'] for segment in manifest['segments']])
+        self.assertEqual([10, 10, 5], [segment['nodes'] for segment in manifest['segments']])
+        self.assertEqual({'post': 5, 'comment': 5}, manifest['segments'][0]['types'])
+        self.assertEqual(('10', '19'), (manifest['segments'][1]['first_id'], manifest['segments'][1]['last_id']))
+        self.assert_archive()
+
+    def test_compressed_segments(self):
+        self.write_graphs(self.graphs, max_segment_size=200, compression='gzip')
+        manifest = read_manifest(self.manifest_filepath)
+        self.assertLess(1, len(manifest['segments']))
+        self.assertEqual(25, sum(segment['nodes'] for segment in manifest['segments']))
+        self.assertTrue(manifest['segments'][0]['filename'].endswith('.jsonl.gz'))
+        self.assert_archive()
+
+
+class TestCsvGraphOutput(unittest.TestCase):
+    def test_compile_csv_fields(self):
+        fieldnames, getters = compile_csv_fields(['id', ['metadata', 'type'], {'parent_id': ['parent', 'id']}])
+        self.assertEqual(('id', 'metadata_type', 'parent_id'), fieldnames)
+        graph = {'id': '1', 'metadata': {'type': 'comment'}, 'parent': None}
+        self.assertEqual(['1', 'comment', None], [getter(graph) for getter in getters])
+
+    def test_output_graph(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mock_fb = MagicMock()
+            mock_fb.get_definition.return_value = Definition({'fields': {}, 'csv_fields': [
+                'message', {'parent_comment': ['parent', 'id']}]})
+            with CsvGraphOutput(temp_dir, mock_fb) as output:
+                output.output_graph({'id': '1', 'metadata': {'type': 'comment'}, 'message': 'Line 1\nLine 2',
+                                     'parent': {'id': '2'}})
+            with open(os.path.join(temp_dir, 'comment.csv')) as file:
+                self.assertEqual('id,metadata_type,message,parent_comment\n1,comment,Line 1 Line 2,2\n',
+                                 file.read().replace('\r\n', '\n'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.graphs = [{'id': str(count), 'metadata': {'type': 'comment' if count % 3 else 'post'},
+                        'message': 'Message\n{}'.format(count), 'parent': {'id': '0'}} for count in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assert_export(self, filepath):
+        csv_dir = os.path.join(self.temp_dir, 'csv')
+        export_command([filepath], csv_output_dir=csv_dir, processes=2, chunk_size=1000)
+        live_csv_dir = os.path.join(self.temp_dir, 'live_csv')
+        os.makedirs(live_csv_dir)
+        with CsvGraphOutput(live_csv_dir, Fbarc()) as output:
+            for graph in self.graphs:
+                output.output_graph(graph)
+        self.assertEqual(['comment.csv', 'post.csv'], sorted(os.listdir(csv_dir)))
+        for filename in os.listdir(csv_dir):
+            with open(os.path.join(csv_dir, filename)) as file, \
+                    open(os.path.join(live_csv_dir, filename)) as live_file:
+                self.assertEqual(live_file.read(), file.read())
+
+    def write_graphs(self, filepath):
+        with JsonGraphOutput(filepath=filepath, frame_size=1000) as output:
+            for graph in self.graphs:
+                output.output_graph(graph)
+
+    def test_export(self):
+        filepath = os.path.join(self.temp_dir, 'test.jsonl')
+        self.write_graphs(filepath)
+        self.assertLess(1, len(get_archive_chunks(filepath, 1000)))
+        self.assert_export(filepath)
+
+    def test_export_compressed(self):
+        filepath = os.path.join(self.temp_dir, 'test.jsonl.gz')
+        self.write_graphs(filepath)
+        self.assertLess(1, len(get_archive_chunks(filepath, 1000)))
+        self.assert_export(filepath)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_export_parquet(self):
+        filepath = os.path.join(self.temp_dir, 'test.jsonl')
+        self.write_graphs(filepath)
+        parquet_dir = os.path.join(self.temp_dir, 'parquet')
+        export_command([filepath], parquet_output_dir=parquet_dir, processes=2, chunk_size=1000)
+        self.assertEqual(['comment', 'post'], sorted(os.listdir(parquet_dir)))
+        # A dataset for each node type, with a part for each chunk
+        self.assertTrue(all(filename.startswith('part-') for filename in os.listdir(os.path.join(parquet_dir, 'post'))))
+        for definition_name in ('comment', 'post'):
+            table = pyarrow.parquet.read_table(os.path.join(parquet_dir, definition_name))
+            self.assertEqual([graph['id'] for graph in self.graphs if graph['metadata']['type'] == definition_name],
+                             table.column('id').to_pylist())
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestParquetGraphOutput(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.mock_fb = MagicMock()
+        self.mock_fb.get_definition.return_value = Definition({'fields': {}, 'csv_fields': [
+            'created_time', 'like_count', 'message', 'object'], 'csv_types': {'created_time': 'timestamp'}})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_output_graph(self):
+        with ParquetGraphOutput(self.temp_dir, self.mock_fb, row_group_size=10, max_buffered_rows=15) as output:
+            for count in range(25):
+                output.output_graph({'id': str(count), 'metadata': {'type': 'comment' if count % 5 else 'post'},
+                                     'created_time': '2017-12-05T18:31:00+0000', 'like_count': count,
+                                     'object': {'id': '1'}})
+            # Only up to max_buffered_rows are buffered.
+            self.assertGreaterEqual(15, output.buffered_rows)
+
+        parquet_file = pyarrow.parquet.ParquetFile(os.path.join(self.temp_dir, 'comment.parquet'))
+        self.assertEqual(20, parquet_file.metadata.num_rows)
+        self.assertLess(1, parquet_file.metadata.num_row_groups)
+        table = parquet_file.read()
+        self.assertEqual('int64', str(table.schema.field('like_count').type))
+        self.assertEqual('timestamp[ms, tz=UTC]', str(table.schema.field('created_time').type))
+        # All null, so inferred as string
+        self.assertEqual('string', str(table.schema.field('message').type))
+        self.assertEqual('{"id": "1"}', table.column('object')[0].as_py())
+        self.assertEqual(5, pyarrow.parquet.read_table(os.path.join(self.temp_dir, 'post.parquet')).num_rows)
+
+
+class TestSqliteGraphOutput(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.temp_dir, 'test.db')
+        self.fbarc = Fbarc()
+        self.fbarc._definitions['post'] = Definition({'fields': {
+            'message': {},
+            'comments': {'edge_type': 'comment', 'default': True}
+        }, 'csv_fields': ['message', ['from', 'id']], 'csv_types': {'message': 'string'}})
+        self.fbarc._definitions['comment'] = Definition({'fields': {
+            'comments': {'edge_type': 'comment'}
+        }})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_output_graph(self):
+        with SqliteGraphOutput(self.filepath, self.fbarc, batch_size=3) as output:
+            for count in range(5):
+                output.output_graph({'id': 'post{}'.format(count), 'metadata': {'type': 'post'},
+                                     'message': 'Message {}'.format(count), 'from': {'id': 'page1'},
+                                     'comments': {'data': [{'id': 'comment{}'.format(count)}]}})
+            output.output_graph({'id': 'comment0', 'metadata': {'type': 'comment'},
+                                 'comments': {'data': [{'id': 'comment5'}]}})
+
+        connection = sqlite3.connect(self.filepath)
+        try:
+            self.assertEqual([('post3', 'Message 3', 'page1')], connection.execute(
+                'SELECT id, message, from_id FROM post WHERE id = ?', ('post3',)).fetchall())
+            self.assertEqual('post', json.loads(connection.execute(
+                'SELECT json FROM post WHERE id = ?', ('post3',)).fetchone()[0])['metadata']['type'])
+            self.assertEqual(5, connection.execute('SELECT COUNT(*) FROM post').fetchone()[0])
+            self.assertEqual(1, connection.execute('SELECT COUNT(*) FROM comment').fetchone()[0])
+            self.assertEqual([('post2', 'comments', 'comment2')], connection.execute(
+                'SELECT parent_id, edge, child_id FROM edges WHERE child_id = ?', ('comment2',)).fetchall())
+            self.assertEqual(6, connection.execute('SELECT COUNT(*) FROM edges').fetchone()[0])
+        finally:
+            connection.close()
+
+
+    def test_flush_error(self):
+        with SqliteGraphOutput(self.filepath, self.fbarc, batch_size=100) as output:
+            output.output_graph({'id': 'post1', 'metadata': {'type': 'post'},
+                                 'comments': {'data': [{'id': 'comment1'}]}})
+            connection = output.connection
+            output.connection = MagicMock(wraps=connection)
+            output.connection.execute.side_effect = lambda sql, *args: connection.execute(
+                'SELECT * FROM no_table' if sql == 'COMMIT' else sql, *args)
+            with self.assertRaises(sqlite3.OperationalError):
+                output.flush()
+            # The rows that were rolled back are written by the next flush.
+            output.connection = connection
+
+        connection = sqlite3.connect(self.filepath)
+        try:
+            self.assertEqual(1, connection.execute('SELECT COUNT(*) FROM post').fetchone()[0])
+            self.assertEqual(1, connection.execute('SELECT COUNT(*) FROM edges').fetchone()[0])
+        finally:
+            connection.close()
+
+
+class TestNormalizedGraphOutput(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.temp_dir, 'post1.jsonl.gz')
+        self.fbarc = Fbarc()
+        self.fbarc._definitions['post'] = Definition({'fields': {
+            'message': {'default': True},
+            'comments': {'edge_type': 'comment', 'default': True},
+            'likes': {'edge_type': 'user', 'follow_edge': False, 'default': True}
+        }})
+        self.fbarc._definitions['comment'] = Definition({'fields': {
+            'message': {'default': True},
+            'like_count': {},
+            'comments': {'edge_type': 'comment', 'default': True}
+        }})
+        self.fbarc._definitions['user'] = Definition({'fields': {}})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_normalize(self):
+        post = {'id': 'post1', 'metadata': {'type': 'post'}, 'message': 'Post',
+                'likes': {'data': [{'id': 'user1', 'name': 'User'}]},
+                'comments': {'data': [
+                    {'id': 'comment1', 'message': 'Comment 1', 'comments': {'data': [
+                        {'id': 'comment3', 'message': 'Comment 3'}]}},
+                    {'id': 'comment2', 'message': 'Comment 2'}
+                ], 'paging': {'cursors': {}}}}
+        comment1 = {'id': 'comment1', 'metadata': {'type': 'comment'}, 'message': 'Comment 1', 'like_count': 2,
+                    'comments': {'data': [{'id': 'comment3', 'message': 'Comment 3'}]}}
+        with JsonGraphOutput(filepath=self.filepath) as json_output:
+            with NormalizedGraphOutput(json_output, self.fbarc, get_edges_filepath(self.filepath)) as output:
+                output.output_graph(post)
+                output.output_graph(comment1)
+
+        graphs = [json.loads(line) for line in ArchiveReader(self.filepath).iter_lines()]
+        self.assertEqual(['post1', 'comment1', 'comment3', 'comment2'], [graph['id'] for graph in graphs])
+        self.assertEqual([{'id': 'comment1'}, {'id': 'comment2'}], graphs[0]['comments']['data'])
+        # Edges that are not followed are not normalized
+        self.assertEqual(post['likes'], graphs[0]['likes'])
+        self.assertTrue(graphs[2]['metadata']['fragment'])
+        with open(os.path.join(self.temp_dir, 'post1.edges.tsv')) as file:
+            self.assertEqual(['post1\tcomments\tcomment1', 'post1\tcomments\tcomment2',
+                              'comment1\tcomments\tcomment3'], file.read().splitlines())
+
+        archive = NormalizedArchive(self.filepath, fb=self.fbarc)
+        self.assertEqual(post, archive.get_node('post1'))
+        self.assertEqual(comment1, archive.get_node('comment1'))
+        self.assertIsNone(archive.get_node('comment4'))
+
+    def test_normalize_error(self):
+        post = {'id': 'post1', 'metadata': {'type': 'post'}, 'comments': {'data': [
+            {'id': 'comment1', 'message': 'Comment 1'}]}}
+        with JsonGraphOutput(filepath=self.filepath) as json_output:
+            with self.assertRaises(FbException):
+                with NormalizedGraphOutput(json_output, self.fbarc, get_edges_filepath(self.filepath)) as output:
+                    output.output_graph(post)
+                    raise FbException({'error': {'code': 2}})
+
+        # Embedded items are not lost when retrieving fails.
+        archive = NormalizedArchive(self.filepath, fb=self.fbarc)
+        self.assertEqual(post, archive.get_node('post1'))
+
+    def test_resume(self):
+        post = {'id': 'post1', 'metadata': {'type': 'post'}, 'comments': {'data': [
+            {'id': 'comment1', 'message': 'Comment 1', 'comments': {'data': [
+                {'id': 'comment3', 'message': 'Comment 3'}]}},
+            {'id': 'comment2', 'message': 'Comment 2'}]}}
+        with JsonGraphOutput(filepath=self.filepath) as json_output:
+            with NormalizedGraphOutput(json_output, self.fbarc, get_edges_filepath(self.filepath)) as output:
+                output.output_graph(post)
+
+        def get_node_batch(node_ids, definition_name, **kwargs):
+            return {node_id: {'id': node_id, 'metadata': {'type': 'comment'}, 'message': node_id, 'like_count': 1,
+                              'comments': {'data': [
+                {'id': 'comment3', 'message': 'Comment 3'}]}} for node_id in node_ids}
+
+        with patch.object(self.fbarc, 'get_node_batch', side_effect=get_node_batch):
+            self.fbarc.resume(self.filepath, levels=2, exclude_definition_names=[])
+
+        graphs = [json.loads(line) for line in ArchiveReader(self.filepath).iter_lines()]
+        # Fragments are not output again.
+        self.assertEqual(['post1', 'comment3', 'comment1', 'comment2', 'comment1', 'comment2'],
+                         [graph['id'] for graph in graphs])
+        self.assertEqual([{'id': 'comment3'}], graphs[4]['comments']['data'])
+        with open(os.path.join(self.temp_dir, 'post1.edges.tsv')) as file:
+            self.assertEqual('comment2\tcomments\tcomment3', file.read().splitlines()[-1])
+        archive = NormalizedArchive(self.filepath, fb=self.fbarc)
+        self.assertEqual(1, archive.get_node('comment1')['like_count'])
+        self.assertEqual('Comment 3', archive.get_node('comment1')['comments']['data'][0]['message'])
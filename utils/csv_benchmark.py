@@ -0,0 +1,112 @@
+"""
+Compares the time to write comment graphs as CSV with CsvGraphOutput against the previous
+implementation, which interpreted the CSV fields for every row and wrote with csv.DictWriter.
+
+Reports the best of --repeat runs writing --nodes comments.
+"""
+import argparse
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fbarc import Fbarc, CsvGraphOutput
+
+
+class LegacyCsvGraphOutput(CsvGraphOutput):
+    def __init__(self, dirpath, fb, mode='w'):
+        CsvGraphOutput.__init__(self, dirpath, fb, mode=mode)
+        self.fields_dict = {}
+
+    def output_graph(self, graph):
+        definition_name = graph['metadata']['type']
+        if definition_name not in self.writer_dict:
+            file = open(os.path.join(self.dirpath, '{}.csv'.format(definition_name)), mode=self.mode)
+            self.files.append(file)
+            self.writer_dict[definition_name] = csv.DictWriter(file, extrasaction='ignore',
+                                                               fieldnames=self._get_fieldnames(definition_name))
+            if self.mode != 'a':
+                self.writer_dict[definition_name].writeheader()
+        self.writer_dict[definition_name].writerow(self._get_row(graph, definition_name))
+
+    @staticmethod
+    def _flatten_field_name(field):
+        return '_'.join(field)
+
+    def _get_row(self, graph, definition_name):
+        row = {}
+        for field in self._get_fields(definition_name):
+            field_name = None
+            if isinstance(field, dict):
+                field_name, field = list(field.items())[0]
+            if isinstance(field, list):
+                graph_part = graph
+                for subfield in field:
+                    if graph_part:
+                        graph_part = graph_part.get(subfield)
+                row[field_name or self._flatten_field_name(field)] = self._clean_value(graph_part)
+            else:
+                row[field_name or field] = self._clean_value(graph.get(field))
+        return row
+
+    @staticmethod
+    def _clean_value(value):
+        if isinstance(value, str):
+            return value.replace('\n', ' ')
+        return value
+
+    def _get_fields(self, definition_name):
+        if definition_name not in self.fields_dict:
+            self.fields_dict[definition_name] = CsvGraphOutput._get_fields(self, definition_name)
+        return self.fields_dict[definition_name]
+
+    def _get_fieldnames(self, definition_name):
+        fieldnames = []
+        for field in self._get_fields(definition_name):
+            if isinstance(field, dict):
+                fieldnames.append(list(field.keys())[0])
+            elif isinstance(field, list):
+                fieldnames.append(self._flatten_field_name(field))
+            else:
+                fieldnames.append(field)
+        return fieldnames
+
+
+def comment_graphs(count):
+    for i in range(count):
+        yield {
+            'id': '1191441824276882_{}'.format(i),
+            'metadata': {'type': 'comment'},
+            'created_time': '2017-12-05T18:31:00+0000',
+            'message': 'Comment {}\nwith a second line'.format(i),
+            'permalink_url': 'https://www.facebook.com/1191441824276882?comment_id={}'.format(i),
+            'object': {'id': '1191441824276882'},
+            'parent': {'id': '1191441824276882_{}'.format(i - 1)} if i % 3 else None,
+            'comment_count': i % 7,
+            'like_count': i % 11
+        }
+
+
+def write_csv(output_class, graphs, dirpath):
+    with output_class(dirpath, Fbarc()) as output:
+        for graph in graphs:
+            output.output_graph(graph)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=200000, help='number of comments to write (default=200000)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times to repeat (default=3)')
+    args = parser.parse_args()
+
+    graphs = list(comment_graphs(args.nodes))
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for name, output_class in (('DictWriter', LegacyCsvGraphOutput), ('Compiled', CsvGraphOutput)):
+            secs = min(timeit.repeat(lambda: write_csv(output_class, graphs, temp_dir), repeat=args.repeat, number=1))
+            print('{}: {:.2f} secs ({:,.0f} rows/sec)'.format(name, secs, args.nodes / secs))
+    finally:
+        shutil.rmtree(temp_dir)
@@ -1,19 +1,35 @@
 import fileinput
 import json
+import os
 from collections import Counter
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fbarc import ArchiveReader, is_edge_chunk
+
 """
-Counts the node types provided in a list of JSON files or stdin.
+Counts the node types provided in a list of JSON files (which may be compressed) or stdin.
+
+Fragments in normalized JSON files and edge chunks are not counted.
 """
 
+
+def iter_lines(filepaths):
+    if not filepaths:
+        for line in fileinput.input():
+            yield line
+    for filepath in filepaths:
+        for line in ArchiveReader(filepath).iter_lines():
+            yield line
+
+
 if __name__ == '__main__':
     stats_counter = Counter()
 
-    for line in fileinput.input():
+    for line in iter_lines(sys.argv[1:]):
         node = json.loads(line)
         if 'id' in node:
-            if 'metadata' in node:
+            if 'metadata' in node and not node['metadata'].get('fragment') and not is_edge_chunk(node):
                 stats_counter[node['metadata']['type']] += 1
         else:
             print('Error line: {}'.format(line))